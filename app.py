@@ -40,9 +40,12 @@ from backend.utils import (
 )
 
 from backend.context.document_status_context import DocumentStatusContext
+from backend.context.chunk_vector_cache import ChunkVectorCache
 from backend.context.document_chunk_context import DocumentChunkContext
+from backend.context.user_vector_index import UserVectorIndexCache
+from backend.context.document_status_feed import DocumentStatusFeed
 from backend.routes.document_status_routes import DocumentStatusRoutes
-from backend.routes.document_chunk_routes import DocumentChunkRoutes
+from backend.routes.document_chunk_routes import DocumentChunkRoutes, MULTIPART_OVERHEAD
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 
@@ -53,6 +56,12 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    if app_settings.document_upload:
+        ## uploads are streamed and capped by the upload route, don't let the default 16 MB request limit reject them first
+        app.config["MAX_CONTENT_LENGTH"] = max(
+            app.config["MAX_CONTENT_LENGTH"],
+            app_settings.document_upload.max_file_size_mb * 1024 * 1024 + MULTIPART_OVERHEAD
+        )
     
     @app.before_serving
     async def init():
@@ -78,21 +87,61 @@ def create_app():
 
             blob_service_client = BlobServiceClient(account_url=account_url, credential=storage_credentials)
             container_client = blob_service_client.get_container_client(container_name)
+            archive_container_client = None
+            if app_settings.chat_history.archive_container:
+                archive_container_client = blob_service_client.get_container_client(app_settings.chat_history.archive_container)
             
-            document_chunk_context: DocumentChunkContext = DocumentChunkContext(cosmos_endpoint, cosmos_credential, app_settings.chat_history.database, app_settings.document_upload.document_chunks_container)
+            vector_cache = None
+            if app_settings.document_upload.enable_local_vector_search:
+                vector_cache = ChunkVectorCache(
+                    max_bytes=app_settings.document_upload.local_vector_search_cache_mb * 1024 * 1024,
+                    ttl=app_settings.document_upload.local_vector_search_ttl_seconds,
+                    max_chunks_per_document=app_settings.document_upload.local_vector_search_max_chunks
+                )
+
+            vector_index_cache = None
+            if app_settings.document_upload.vector_index_container:
+                vector_index_cache = UserVectorIndexCache(
+                    blob_service_client.get_container_client(app_settings.document_upload.vector_index_container),
+                    app_settings.document_upload.vector_index_directory,
+                    app_settings.document_upload.vector_index_refresh_seconds
+                )
+
+            document_chunk_context: DocumentChunkContext = DocumentChunkContext(cosmos_endpoint, cosmos_credential, app_settings.chat_history.database, app_settings.document_upload.document_chunks_container, vector_cache, vector_index_cache, app_settings.document_upload.legacy_chunks_migration_pending)
             document_status_context: DocumentStatusContext = DocumentStatusContext(cosmos_endpoint, cosmos_credential, app_settings.chat_history.database, app_settings.document_upload.document_status_container, document_chunk_context)
-            document_status_routes = DocumentStatusRoutes(document_status_context)
-            document_chunk_routes = DocumentChunkRoutes(container_client, document_chunk_context, document_status_context, app_settings.document_upload.valid_extensions)
+            document_status_feed = None
+            if app_settings.document_upload.enable_status_stream:
+                document_status_feed = DocumentStatusFeed(
+                    cosmos_endpoint,
+                    cosmos_credential,
+                    app_settings.chat_history.database,
+                    app_settings.document_upload.document_status_container,
+                    poll_interval=app_settings.document_upload.status_stream_poll_interval
+                )
+                await document_status_feed.start()
+            app.document_status_feed = document_status_feed
+            document_status_routes = DocumentStatusRoutes(document_status_context, document_status_feed)
+            document_chunk_routes = DocumentChunkRoutes(
+                container_client,
+                document_chunk_context,
+                document_status_context,
+                app_settings.document_upload.valid_extensions,
+                max_file_size=app_settings.document_upload.max_file_size_mb * 1024 * 1024,
+                block_size=app_settings.document_upload.block_size_mb * 1024 * 1024,
+                max_concurrency=app_settings.document_upload.max_concurrency
+            )
 
             app.cosmos_client = await init_cosmosdb_client(
                 document_status_context=document_status_context,
                 database_name=app_settings.chat_history.database,
                 chat_container_name=app_settings.chat_history.conversations_container,
                 document_chunks_container_name=app_settings.document_upload.document_chunks_container,
-                document_status_container_name=app_settings.document_upload.document_status_container
+                document_status_container_name=app_settings.document_upload.document_status_container,
+                archive_container_client=archive_container_client
             )
 
             app.document_chunk_context = document_chunk_context
+            app.document_status_context = document_status_context
             app.register_blueprint(document_status_routes.blueprint)
             app.register_blueprint(document_chunk_routes.blueprint)
             cosmos_db_ready.set()
@@ -101,6 +150,14 @@ def create_app():
             app.cosmos_client = None
             app.cosmos_client = None
             raise e
+
+    @app.after_serving
+    async def shutdown():
+        ## flush any chat history writes that are still queued
+        if getattr(app, "cosmos_client", None):
+            await app.cosmos_client.close()
+        if getattr(app, "document_status_feed", None):
+            await app.document_status_feed.close()
     
     return app
 
@@ -224,7 +281,11 @@ async def search_cosmos_documents(openAIclient: AsyncAzureOpenAI, user_id: str,
     
     try:
         embeddings = await create_embedding(openAIclient, text)
-        documents = await current_app.document_chunk_context.get_documents_by_master_ids(user_id, ragMasterDocumentIds, embeddings)
+        document_versions = None
+        if current_app.document_chunk_context.vector_cache is not None or current_app.document_chunk_context.vector_index_cache is not None:
+            statuses = await current_app.document_status_context.get_documents_statuses(user_id, ragMasterDocumentIds)
+            document_versions = { status['id']: status.get('content_hash') for status in statuses if status.get('status') == 'Indexed' }
+        documents = await current_app.document_chunk_context.get_documents_by_master_ids(user_id, ragMasterDocumentIds, embeddings, document_versions)
         return documents
 
     except Exception as e:
@@ -242,7 +303,7 @@ async def create_embedding(client: AsyncAzureOpenAI, text: str):
     return embedding
 
    
-async def init_cosmosdb_client(document_status_context: DocumentStatusContext, database_name: str, chat_container_name: str, document_chunks_container_name: str, document_status_container_name: str):
+async def init_cosmosdb_client(document_status_context: DocumentStatusContext, database_name: str, chat_container_name: str, document_chunks_container_name: str, document_status_container_name: str, archive_container_client: ContainerClient = None):
     cosmos_client = None
     if app_settings.chat_history:
         try:
@@ -264,7 +325,16 @@ async def init_cosmosdb_client(document_status_context: DocumentStatusContext, d
                 document_chunks_container_name=document_chunks_container_name,
                 document_status_container_name=document_status_container_name,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                enable_write_behind=app_settings.chat_history.enable_write_behind,
+                write_behind_flush_interval=app_settings.chat_history.write_behind_flush_interval,
+                write_behind_max_retries=app_settings.chat_history.write_behind_max_retries,
+                write_behind_spill_directory=app_settings.chat_history.write_behind_spill_directory,
+                enable_message_buckets=app_settings.chat_history.enable_message_buckets,
+                message_bucket_max_messages=app_settings.chat_history.message_bucket_max_messages,
+                message_bucket_max_kb=app_settings.chat_history.message_bucket_max_kb,
+                archive_container_client=archive_container_client,
             )
+            await cosmos_client.start()
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
             cosmos_client = None
@@ -488,16 +558,104 @@ async def stream_chat_request(request_body, request_headers):
     return generate()
 
 
-async def conversation_internal(request_body, request_headers):
+def persist_streamed_response(result, request_body, request_headers):
+    history_metadata = request_body.get("history_metadata", {})
+    authenticated_user = get_authenticated_user_details(request_headers=request_headers)
+    user_id = authenticated_user["user_principal_id"]
+    ## the generator outlives the request context, so resolve the client up front
+    cosmos_client = current_app.cosmos_client
+
+    async def generate():
+        response_id = None
+        tool_message = None
+        assistant_content = []
+
+        async for chunk in result:
+            yield chunk
+
+            if not chunk:
+                continue
+
+            response_id = chunk.get("id") or response_id
+            for message in chunk["choices"][0]["messages"]:
+                if message["role"] == "tool":
+                    tool_message = message
+                elif message.get("content"):
+                    assistant_content.append(message["content"])
+
+        response_messages = [tool_message] if tool_message else []
+        if assistant_content:
+            response_messages.append({"role": "assistant", "content": "".join(assistant_content)})
+
+        persisted = await persist_response_messages(
+            cosmos_client,
+            user_id,
+            history_metadata.get("conversation_id"),
+            response_id,
+            response_messages
+        )
+        if persisted:
+            ## a last line without choices tells the frontend to skip the /history/update round trip,
+            ## without it the frontend saves the messages itself
+            yield {"history_metadata": {**history_metadata, "persisted": True}}
+
+    return generate()
+
+
+async def persist_response_messages(cosmos_client, user_id, conversation_id, response_id, response_messages):
+    tool_message = next((message for message in response_messages if message["role"] == "tool"), None)
+    assistant_message = next((message for message in response_messages if message["role"] == "assistant"), None)
+
+    if not assistant_message or not assistant_message.get("content"):
+        logging.warning(f"No assistant message to persist for conversation {conversation_id}")
+        return False
+
+    try:
+        ## write the tool message first
+        if tool_message:
+            await cosmos_client.create_message(
+                uuid=str(uuid.uuid4()),
+                conversation_id=conversation_id,
+                user_id=user_id,
+                input_message=tool_message,
+            )
+        await cosmos_client.create_message(
+            uuid=response_id or str(uuid.uuid4()),
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message=assistant_message,
+        )
+        return True
+    except Exception:
+        logging.exception("Exception while persisting response messages")
+        return False
+
+
+async def conversation_internal(request_body, request_headers, persist_response=False):
     try:
         if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
             result = await stream_chat_request(request_body, request_headers)
+            if persist_response:
+                result = persist_streamed_response(result, request_body, request_headers)
+
             response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
             result = await complete_chat_request(request_body, request_headers)
+            if persist_response and result.get("choices"):
+                authenticated_user = get_authenticated_user_details(request_headers=request_headers)
+                persisted = await persist_response_messages(
+                    current_app.cosmos_client,
+                    authenticated_user["user_principal_id"],
+                    request_body["history_metadata"]["conversation_id"],
+                    result.get("id"),
+                    result["choices"][0]["messages"]
+                )
+                if persisted:
+                    ## lets the frontend skip the /history/update round trip
+                    result["history_metadata"] = {**result["history_metadata"], "persisted": True}
             return jsonify(result)
 
     except Exception as ex:
@@ -582,7 +740,11 @@ async def add_conversation():
         request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        return await conversation_internal(
+            request_body,
+            request.headers,
+            persist_response=app_settings.chat_history.enable_server_side_persistence
+        )
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
@@ -785,7 +947,7 @@ async def get_conversation():
 
     # get the messages for the conversation from cosmos
     conversation_messages = await current_app.cosmos_client.get_messages(
-        user_id, conversation_id
+        user_id, conversation_id, conversation
     )
 
     ## format the messages in the bot frontend format
@@ -0,0 +1,111 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class DocumentVectors():
+    def __init__(self, chunks: List[dict], vector_key: str = 'contentVector'):
+        self.texts = [chunk.get('text') for chunk in chunks]
+        self.file_names = [chunk.get('file_name') for chunk in chunks]
+        self.payloads = [chunk.get('payload') for chunk in chunks]
+
+        matrix = np.asarray([chunk[vector_key] for chunk in chunks], dtype=np.float32)
+        if matrix.size:
+            ## normalized rows turn cosine similarity into a plain dot product
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms == 0, 1, norms)
+        self.matrix = matrix
+
+    @property
+    def size_bytes(self) -> int:
+        return self.matrix.nbytes + sum(len(text or '') for text in self.texts)
+
+
+class ChunkVectorCache():
+    """LRU cache of the chunk embeddings of uploaded documents, keyed by user and
+    master document id, bounded by the memory the vectors and texts take up.
+
+    Documents with more than `max_chunks_per_document` chunks are remembered as
+    too large so that retrieval for them keeps going to Cosmos without trying to
+    load them again on every turn. Both expire after `ttl` seconds.
+    """
+
+    TOO_LARGE = object()
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl: float = 600.0, max_chunks_per_document: int = 2000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_chunks_per_document = max_chunks_per_document
+        self.size_bytes = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[object, float]]" = OrderedDict()
+
+    def get(self, user_id: str, master_document_id: str):
+        key = (user_id, master_document_id)
+        entry, loaded_at = self._entries.get(key, (None, None))
+        if entry is None:
+            return None
+
+        ## a document that was too large may have been replaced by a smaller version
+        if time.monotonic() - loaded_at > self.ttl:
+            self.evict(user_id, master_document_id)
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, user_id: str, master_document_id: str, chunks: List[dict]):
+        self.evict(user_id, master_document_id)
+        key = (user_id, master_document_id)
+        if len(chunks) > self.max_chunks_per_document:
+            self._entries[key] = (self.TOO_LARGE, time.monotonic())
+            return self.TOO_LARGE
+
+        entry = DocumentVectors(chunks)
+        if entry.size_bytes > self.max_bytes:
+            self._entries[key] = (self.TOO_LARGE, time.monotonic())
+            return self.TOO_LARGE
+
+        self._entries[key] = (entry, time.monotonic())
+        self.size_bytes += entry.size_bytes
+        while self.size_bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            if evicted is not self.TOO_LARGE:
+                self.size_bytes -= evicted.size_bytes
+
+        return entry
+
+    def evict(self, user_id: str, master_document_id: str):
+        entry, _ = self._entries.pop((user_id, master_document_id), (None, None))
+        if entry is not None and entry is not self.TOO_LARGE:
+            self.size_bytes -= entry.size_bytes
+
+
+def search_document_vectors(entries: List[DocumentVectors], embedding: List[float], top_k: int = 10) -> List[Dict]:
+    entries = [entry for entry in entries if entry.matrix.size]
+    if not entries:
+        return []
+
+    query = np.asarray(embedding, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1
+
+    scores = np.concatenate([entry.matrix @ query for entry in entries])
+    top_k = min(top_k, len(scores))
+    top_indexes = np.argpartition(-scores, top_k - 1)[:top_k]
+    top_indexes = top_indexes[np.argsort(-scores[top_indexes])]
+
+    offsets = np.cumsum([0] + [len(entry.texts) for entry in entries])
+    documents = []
+    for index in top_indexes:
+        entry_index = int(np.searchsorted(offsets, index, side='right') - 1)
+        entry = entries[entry_index]
+        row = int(index - offsets[entry_index])
+        documents.append({
+            'file_name': entry.file_names[row],
+            'text': entry.texts[row],
+            'payload': entry.payloads[row],
+            'SimilarityScore': float(scores[index])
+        })
+
+    return documents
@@ -1,43 +1,129 @@
-from typing import Dict
+import hashlib
+from typing import Dict, Optional
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.cosmos import exceptions
+from azure.cosmos.partition_key import NonePartitionKeyValue
 
+from backend.context.chunk_vector_cache import ChunkVectorCache, search_document_vectors
 from backend.context.cosmos_db_context import CosmosDBContext
+from backend.context.user_vector_index import UserVectorIndexCache
+
+# keep in sync with content_loading/IncrementalIndexing.py
+def get_chunk_id(master_document_id: str, text: str, occurrence: int = 0) -> str:
+    return hashlib.sha256(f"{master_document_id}\n{occurrence}\n{text}".encode("utf-8")).hexdigest()
 
 class DocumentChunkContext(CosmosDBContext):
-    def __init__(self, cosmosdb_endpoint: str, credential: str | Dict[str, str] | AsyncTokenCredential, database_name: str, container_name: str):
+    def __init__(self, cosmosdb_endpoint: str, credential: str | Dict[str, str] | AsyncTokenCredential, database_name: str, container_name: str, vector_cache: Optional[ChunkVectorCache] = None, vector_index_cache: Optional[UserVectorIndexCache] = None, legacy_chunks_migration_pending: bool = True):
         super().__init__(cosmosdb_endpoint, credential, database_name, container_name)
+        self.vector_cache = vector_cache
+        self.vector_index_cache = vector_index_cache
+        self.legacy_chunks_migration_pending = legacy_chunks_migration_pending
 
-    async def get_documents_by_master_ids(self, user_id: str, ragMasterDocumentIds: list[str], embeddings: list[float]):
-        documents = []
-        query=f"""SELECT TOP 10 c.metadata.file_name as file_name, c.text, c.payload, VectorDistance(c.contentVector, @embedding) AS SimilarityScore FROM c WHERE ARRAY_CONTAINS(@ids, c.metadata.master_document_id) AND c.metadata.user_principal_id = @userId ORDER BY VectorDistance(c.contentVector, @embedding)"""
+    async def get_documents_by_master_ids(self, user_id: str, ragMasterDocumentIds: list[str], embeddings: list[float], document_versions: Optional[Dict[str, Optional[str]]] = None):
+        ## the content hash of each Indexed document, documents being indexed are left out
+        indexed_document_ids = set(document_versions) if document_versions is not None else None
+        if self.vector_cache is not None:
+            entries = await self.get_cached_document_vectors(user_id, ragMasterDocumentIds, indexed_document_ids)
+            if entries is not None:
+                return search_document_vectors(entries, embeddings, top_k=10)
 
-        async for item in self.client_container.query_items(
-                query=query,
-                parameters=[
-                    {"name": "@userId", "value": user_id},
-                    {"name": "@embedding", "value": embeddings},
-                    {"name": "@ids", "value": ragMasterDocumentIds},
-                ]
-            ):
-            documents.append(item)
+        if self.vector_index_cache is not None:
+            documents = await self.get_documents_from_vector_index(user_id, ragMasterDocumentIds, embeddings, document_versions)
+            if documents is not None:
+                return documents
 
-        return documents
+        query=f"""SELECT TOP 10 c.metadata.file_name as file_name, c.text, c.payload, VectorDistance(c.contentVector, @embedding) AS SimilarityScore FROM c WHERE ARRAY_CONTAINS(@ids, c.metadata.master_document_id) AND c.metadata.user_principal_id = @userId ORDER BY VectorDistance(c.contentVector, @embedding)"""
+        parameters=[
+            {"name": "@userId", "value": user_id},
+            {"name": "@embedding", "value": embeddings},
+            {"name": "@ids", "value": ragMasterDocumentIds},
+        ]
+
+        return await self.query_user_chunks(user_id, query, parameters, top=10)
     
-    async def get_documents_by_master_id(self, user_id, master_document_id):
-        documents = []
-        query = "SELECT * FROM c WHERE c.metadata.master_document_id = @master_document_id AND c.metadata.user_principal_id = @userId"
-        async for item in self.client_container.query_items(
-                query,
+    async def get_documents_from_vector_index(self, user_id: str, master_document_ids: list[str], embeddings: list[float], document_versions: Optional[Dict[str, Optional[str]]] = None):
+        ## documents indexed, uploaded again or cloned after the last index build are not in the file yet
+        index = await self.vector_index_cache.get(user_id)
+        if index is None or not index.has_documents(master_document_ids, document_versions):
+            return None
+
+        candidates = index.search(embeddings, master_document_ids, top_k=40)
+        if not candidates:
+            return None
+
+        ## the candidates are scored again on their full precision vectors
+        query=f"""SELECT TOP 10 c.metadata.file_name as file_name, c.text, c.payload, VectorDistance(c.contentVector, @embedding) AS SimilarityScore FROM c WHERE ARRAY_CONTAINS(@chunkIds, c.id) AND c.metadata.user_principal_id = @userId ORDER BY VectorDistance(c.contentVector, @embedding)"""
+        parameters=[
+            {"name": "@userId", "value": user_id},
+            {"name": "@embedding", "value": embeddings},
+            {"name": "@chunkIds", "value": [chunk_id for chunk_id, _ in candidates]},
+        ]
+
+        return await self.query_user_chunks(user_id, query, parameters, top=10)
+
+    async def get_cached_document_vectors(self, user_id: str, master_document_ids: list[str], indexed_document_ids: Optional[set[str]] = None):
+        ## small document sets are ranked in process, a single large document sends the whole request to Cosmos
+        entries = []
+        for master_document_id in master_document_ids:
+            if indexed_document_ids is not None and master_document_id not in indexed_document_ids:
+                ## the chunks of a document being indexed are still changing, it is only cached once it is Indexed
+                self.vector_cache.evict(user_id, master_document_id)
+                return None
+
+            entry = self.vector_cache.get(user_id, master_document_id)
+            if entry is None:
+                query = f"SELECT TOP {self.vector_cache.max_chunks_per_document + 1} c.metadata.file_name as file_name, c.text, c.payload, c.contentVector FROM c WHERE c.metadata.master_document_id = @master_document_id AND c.metadata.user_principal_id = @userId"
                 parameters=[
                     {"name": "@master_document_id", "value": master_document_id},
                     {"name": "@userId", "value": user_id}
                 ]
-            ):
+                chunks = await self.query_user_chunks(user_id, query, parameters)
+                entry = self.vector_cache.put(user_id, master_document_id, chunks)
+
+            if entry is ChunkVectorCache.TOO_LARGE:
+                return None
+            entries.append(entry)
+
+        return entries
+
+    async def get_documents_by_master_id(self, user_id, master_document_id):
+        query = "SELECT * FROM c WHERE c.metadata.master_document_id = @master_document_id AND c.metadata.user_principal_id = @userId"
+        parameters=[
+            {"name": "@master_document_id", "value": master_document_id},
+            {"name": "@userId", "value": user_id}
+        ]
+
+        return await self.query_user_chunks(user_id, query, parameters)
+
+    async def query_user_chunks(self, user_id: str, query: str, parameters: list, top: Optional[int] = None):
+        ## chunks are partitioned by userId, so the query stays within a single partition
+        documents = []
+        async for item in self.client_container.query_items(query, parameters=parameters, partition_key=user_id):
             documents.append(item)
 
+        if not self.legacy_chunks_migration_pending:
+            return documents
+
+        ## chunks written before userId was set share the partition for undefined values until they are migrated,
+        ## a user can have documents in both
+        chunk_ids = {document['id'] for document in documents if 'id' in document}
+        async for item in self.client_container.query_items(query, parameters=parameters, partition_key=NonePartitionKeyValue):
+            ## a chunk that is being migrated can briefly be in both partitions
+            if item.get('id') is None or item['id'] not in chunk_ids:
+                documents.append(item)
+
+        if top is not None:
+            documents = sorted(documents, key=lambda document: document['SimilarityScore'], reverse=True)[:top]
+
         return documents
 
+    def evict_cached_vectors(self, user_id, master_document_id):
+        if self.vector_cache is not None:
+            self.vector_cache.evict(user_id, master_document_id)
+
     async def delete_document_chunks(self, user_id, master_document_id):
+        self.evict_cached_vectors(user_id, master_document_id)
+
         response_list = []
         documents = await self.get_documents_by_master_id(user_id, master_document_id)
 
@@ -48,10 +134,45 @@ class DocumentChunkContext(CosmosDBContext):
         return response_list
 
     async def delete_document_chunk(self, document_id, user_id):
-        document = await self.client_container.read_item(item=document_id, partition_key=user_id)
+        partition_key = user_id
+        try:
+            document = await self.client_container.read_item(item=document_id, partition_key=partition_key)
+        except exceptions.CosmosResourceNotFoundError:
+            ## chunks written before userId was set live in the partition for undefined values
+            partition_key = NonePartitionKeyValue
+            document = await self.client_container.read_item(item=document_id, partition_key=partition_key)
         
         if document:
-            await self.client_container.delete_item(item=document_id, partition_key=user_id)
+            await self.client_container.delete_item(item=document_id, partition_key=partition_key)
             return document
         
-        return None
\ No newline at end of file
+        return None
+
+    async def clone_document_chunks(self, user_id, source_master_document_id, master_document_id, conversation_id, file_name):
+        ## the embeddings of an identical file can be reused as is, only the document mapping changes
+        chunks = await self.get_documents_by_master_id(user_id, source_master_document_id)
+
+        ## the ids are the ones the ingestion would give these chunks, so a later version of the file is diffed against them
+        occurrences = {}
+        for chunk in chunks:
+            text = chunk.get('text', '')
+            occurrence = occurrences.get(text, 0)
+            occurrences[text] = occurrence + 1
+
+            metadata = {
+                **chunk.get('metadata', {}),
+                'master_document_id': master_document_id,
+                'conversation_id': conversation_id,
+                'file_name': file_name
+            }
+            for key in ('ref_doc_id', 'doc_id', 'document_id'):
+                if isinstance(metadata.get(key), str) and metadata[key].startswith(source_master_document_id):
+                    metadata[key] = master_document_id + metadata[key][len(source_master_document_id):]
+
+            clone = { key: value for key, value in chunk.items() if not key.startswith('_') }
+            clone['id'] = get_chunk_id(master_document_id, text, occurrence)
+            clone['userId'] = user_id
+            clone['metadata'] = metadata
+            await self.client_container.upsert_item(clone)
+
+        return len(chunks)
@@ -0,0 +1,21 @@
+## the manifests are written by the backend and by the content loading function, which can't
+## import the backend, so their layout is defined once in content_loading/DocumentManifest.py
+from content_loading.DocumentManifest import (
+    DOCUMENT_MANIFEST_TYPE,
+    EXCLUDE_MANIFESTS,
+    IN_PROGRESS_STATUSES,
+    INCOMPLETE_OPERATIONS,
+    MANIFEST_FIELDS,
+    MAX_MANIFEST_DOCUMENTS,
+    create_manifest,
+    create_manifest_entry,
+    get_add_operations,
+    get_conversation_manifest_id,
+    get_manifest_documents_query,
+    get_manifest_ids,
+    get_remove_operations,
+    get_update_operations,
+    get_user_manifest_id,
+    is_manifest_complete,
+    list_manifest_documents
+)
@@ -1,11 +1,28 @@
 from typing import Dict
 import uuid
+import logging
 from datetime import datetime, timezone
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.cosmos import PartitionKey
+from azure.cosmos import PartitionKey, exceptions
 
 from backend.context.cosmos_db_context import CosmosDBContext
 from backend.context.document_chunk_context import DocumentChunkContext
+from backend.context.document_manifest import (
+    EXCLUDE_MANIFESTS,
+    IN_PROGRESS_STATUSES,
+    INCOMPLETE_OPERATIONS,
+    create_manifest,
+    create_manifest_entry,
+    get_add_operations,
+    get_conversation_manifest_id,
+    get_manifest_documents_query,
+    get_manifest_ids,
+    get_remove_operations,
+    get_update_operations,
+    get_user_manifest_id,
+    is_manifest_complete,
+    list_manifest_documents
+)
 
 class DocumentStatusContext(CosmosDBContext):
     def __init__(self, cosmosdb_endpoint: str, credential: str | Dict[str, str] | AsyncTokenCredential, database_name: str, container_name: str, document_chunk_context: DocumentChunkContext):
@@ -22,8 +39,31 @@ class DocumentStatusContext(CosmosDBContext):
     
     async def get_documents_statuses(self, user_id: str, masterDocumentIds: list[str]):
         documents = []
-        query = "SELECT c.id, c.status, c.conversation_id, c.file_name FROM c WHERE ARRAY_CONTAINS(@ids, c.id) AND c.user_principal_id = @userId"
+        missing_ids = masterDocumentIds
+        manifest = await self.get_manifest(user_id, get_user_manifest_id(user_id))
+        if manifest and is_manifest_complete(manifest):
+            ## the progress of documents being indexed, and entries added before the manifest
+            ## recorded the content hash, are read from their status
+            manifest_documents = {
+                id: document for id, document in manifest['documents'].items()
+                if 'content_hash' in document and document.get('status') not in IN_PROGRESS_STATUSES
+            }
+            documents = [
+                { key: manifest_documents[id].get(key) for key in ('id', 'status', 'conversation_id', 'file_name', 'content_hash') }
+                for id in masterDocumentIds if id in manifest_documents
+            ]
+            missing_ids = [id for id in masterDocumentIds if id not in manifest_documents]
+
+        if not missing_ids:
+            return documents
+
+        documents.extend(await self.query_statuses(user_id, missing_ids))
+        return documents
+
+    async def query_statuses(self, user_id: str, masterDocumentIds: list[str]):
+        query = f"SELECT c.id, c.status, c.conversation_id, c.file_name, c.progress, c.content_hash FROM c WHERE ARRAY_CONTAINS(@ids, c.id) AND c.user_principal_id = @userId AND {EXCLUDE_MANIFESTS}"
 
+        documents = []
         async for item in self.client_container.query_items(
                 query=query,
                 parameters=[
@@ -36,7 +76,27 @@ class DocumentStatusContext(CosmosDBContext):
         return documents
     
     async def get_uploaded_documents(self, user_id, limit, offset = 0):
-        query = f"SELECT c.id, c.file_name, c.conversation_id, c.status FROM c WHERE c.user_principal_id = @userId"
+        manifest = await self.get_manifest(user_id, get_user_manifest_id(user_id))
+        if manifest and is_manifest_complete(manifest):
+            documents = [
+                { key: document[key] for key in ('id', 'file_name', 'conversation_id', 'status') }
+                for document in list_manifest_documents(manifest)
+            ]
+            if limit is not None:
+                documents = documents[int(offset):int(offset) + int(limit)]
+
+            ## the manifests don't carry the progress, it is read from the status of the documents being indexed
+            in_progress_ids = [document['id'] for document in documents if document['status'] in IN_PROGRESS_STATUSES]
+            if in_progress_ids:
+                statuses = { status['id']: status for status in await self.query_statuses(user_id, in_progress_ids) }
+                for document in documents:
+                    if document['id'] in statuses:
+                        document['status'] = statuses[document['id']]['status']
+                        if 'progress' in statuses[document['id']]:
+                            document['progress'] = statuses[document['id']]['progress']
+            return documents
+
+        query = f"SELECT c.id, c.file_name, c.conversation_id, c.status, c.progress FROM c WHERE c.user_principal_id = @userId AND {EXCLUDE_MANIFESTS}"
 
         if limit is not None:
             query += f" offset {offset} limit {limit}" 
@@ -50,27 +110,88 @@ class DocumentStatusContext(CosmosDBContext):
         
         return documents
     
-    async def create_document_status(self, user_id: str, conversation_id: str, file_name: str):
+    async def create_document_status(self, user_id: str, conversation_id: str, file_name: str, content_hash: str = None, status: str = 'Uploaded', document_id: str = None):
         document_status = {
-            'id': str(uuid.uuid4()),
+            'id': document_id or str(uuid.uuid4()),
             'user_principal_id': user_id,
             'conversation_id': conversation_id,
             'file_name': file_name,
-            'status': 'Uploaded',
+            'status': status,
             'createdAt': datetime.now(timezone.utc).isoformat(),  
             'updatedAt': datetime.now(timezone.utc).isoformat()            
         }
+        if content_hash:
+            document_status['content_hash'] = content_hash
         
         resp = await self.client_container.upsert_item(document_status)
 
         if resp:
+            await self.add_to_manifests(resp)
             return resp
         else:
             return False
         
+    async def get_indexed_document_by_content_hash(self, user_id: str, content_hash: str):
+        query = "SELECT TOP 1 * FROM c WHERE c.user_principal_id = @userId AND c.content_hash = @contentHash AND c.status = 'Indexed'"
+
+        async for item in self.client_container.query_items(
+                query=query,
+                parameters=[
+                    {"name": "@userId", "value": user_id},
+                    {"name": "@contentHash", "value": content_hash}
+                ],
+                partition_key=user_id
+            ):
+            return item
+
+        return None
+
+    async def get_document_by_file_name(self, user_id: str, conversation_id: str, file_name: str):
+        query = f"SELECT TOP 1 * FROM c WHERE c.user_principal_id = @userId AND c.conversation_id = @conversationId AND c.file_name = @fileName AND {EXCLUDE_MANIFESTS}"
+
+        async for item in self.client_container.query_items(
+                query=query,
+                parameters=[
+                    {"name": "@userId", "value": user_id},
+                    {"name": "@conversationId", "value": conversation_id},
+                    {"name": "@fileName", "value": file_name}
+                ],
+                partition_key=user_id
+            ):
+            return item
+
+        return None
+
+    async def update_document_status(self, user_id: str, document_id: str, status: str):
+        patch_operations = [
+            { 'op': 'replace', 'path': '/status', 'value': status },
+            { 'op': 'set', 'path': '/updatedAt', 'value': datetime.now(timezone.utc).isoformat() }
+        ]
+
+        document = await self.client_container.patch_item(
+            item=document_id,
+            partition_key=user_id,
+            patch_operations=patch_operations
+        )
+        await self.update_manifest_entry(document)
+
+        return document
+
     async def delete_document_by_conversation_id(self, user_id, conversation_id):
-        query = "SELECT * FROM c WHERE c.conversation_id = @conversation_id AND c.user_principal_id = @userId"
         response_list = []
+        manifest = await self.get_manifest(user_id, get_conversation_manifest_id(conversation_id))
+        if manifest and is_manifest_complete(manifest):
+            for document in list_manifest_documents(manifest):
+                try:
+                    response = await self.delete_document(user_id, document['id'])
+                except exceptions.CosmosResourceNotFoundError:
+                    continue
+                response_list.append(response)
+
+            await self.delete_manifest(user_id, get_conversation_manifest_id(conversation_id))
+            return response_list
+
+        query = f"SELECT * FROM c WHERE c.conversation_id = @conversation_id AND c.user_principal_id = @userId AND {EXCLUDE_MANIFESTS}"
         documents = self.client_container.query_items(
             query,
             parameters=[
@@ -91,5 +212,112 @@ class DocumentStatusContext(CosmosDBContext):
         
         await self.client_container.delete_item(item=document_id, partition_key=user_id)
         await self.__document_chunk_context.delete_document_chunks(user_id, document_id)
+        await self.remove_from_manifests(user_id, document['conversation_id'], document_id)
+
+        return document
+
+    async def get_manifest(self, user_id: str, manifest_id: str):
+        try:
+            return await self.client_container.read_item(item=manifest_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def delete_manifest(self, user_id: str, manifest_id: str):
+        try:
+            await self.client_container.delete_item(item=manifest_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def add_to_manifests(self, document_status: dict):
+        user_id = document_status['user_principal_id']
+        patch_operations, filter_predicate = get_add_operations(create_manifest_entry(document_status))
+        for manifest_id, conversation_id in get_manifest_ids(user_id, document_status['conversation_id']):
+            while True:
+                try:
+                    await self.client_container.patch_item(
+                        item=manifest_id,
+                        partition_key=user_id,
+                        patch_operations=patch_operations,
+                        filter_predicate=filter_predicate
+                    )
+                    break
+                except exceptions.CosmosAccessConditionFailedError:
+                    ## full, or already incomplete
+                    await self.mark_manifest_incomplete(user_id, manifest_id)
+                    break
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+                except exceptions.CosmosHttpResponseError as e:
+                    ## a manifest that grew past the item size limit before it was capped
+                    if e.status_code != 413:
+                        raise
+                    await self.mark_manifest_incomplete(user_id, manifest_id)
+                    break
+
+                ## first document since manifests were introduced, seed the manifest with the existing documents
+                if await self.seed_manifest(user_id, manifest_id, conversation_id):
+                    break
+
+    async def update_manifest_entry(self, document_status: dict):
+        ## status transitions only update the user manifest, the conversation manifest is only read for its document ids
+        user_id = document_status['user_principal_id']
+        manifest_id = get_user_manifest_id(user_id)
+        patch_operations, filter_predicate = get_update_operations(create_manifest_entry(document_status))
+        while True:
+            try:
+                await self.client_container.patch_item(
+                    item=manifest_id,
+                    partition_key=user_id,
+                    patch_operations=patch_operations,
+                    filter_predicate=filter_predicate
+                )
+                return
+            except exceptions.CosmosAccessConditionFailedError:
+                ## an incomplete manifest is not read
+                return
+            except exceptions.CosmosResourceNotFoundError:
+                logging.warning(f"Document manifest {manifest_id} not found, seeding it")
+
+            if await self.seed_manifest(user_id, manifest_id):
+                return
+
+    async def remove_from_manifests(self, user_id: str, conversation_id: str, document_id: str):
+        for manifest_id, _ in get_manifest_ids(user_id, conversation_id):
+            try:
+                await self.client_container.patch_item(item=manifest_id, partition_key=user_id, patch_operations=get_remove_operations(document_id))
+            except exceptions.CosmosResourceNotFoundError:
+                ## seeded from the remaining documents once one is added
+                pass
+            except exceptions.CosmosHttpResponseError as e:
+                ## 400 when the manifest does not list the document, e.g. once it is incomplete
+                if e.status_code != 400:
+                    raise
+
+    async def seed_manifest(self, user_id: str, manifest_id: str, conversation_id: str = None) -> bool:
+        """Create the manifest from the status documents. False when it was created concurrently,
+        possibly from documents read before the latest change, so the caller patches it again."""
+        documents = await self.query_documents(user_id, conversation_id)
+        try:
+            await self.client_container.create_item(create_manifest(manifest_id, user_id, documents, conversation_id))
+            return True
+        except exceptions.CosmosResourceExistsError:
+            return False
+
+    async def mark_manifest_incomplete(self, user_id: str, manifest_id: str):
+        logging.warning(f"Document manifest {manifest_id} is full, its documents are queried from now on")
+        try:
+            await self.client_container.patch_item(item=manifest_id, partition_key=user_id, patch_operations=INCOMPLETE_OPERATIONS)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def query_documents(self, user_id: str, conversation_id: str = None):
+        query = get_manifest_documents_query(conversation_id)
+        parameters = [{"name": "@userId", "value": user_id}]
+        if conversation_id:
+            parameters.append({"name": "@conversation_id", "value": conversation_id})
+
+        documents = []
+        async for item in self.client_container.query_items(query=query, parameters=parameters, partition_key=user_id):
+            documents.append(item)
 
-        return document
\ No newline at end of file
+        return documents
\ No newline at end of file
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set
+from azure.core.credentials_async import AsyncTokenCredential
+
+from backend.context.cosmos_db_context import CosmosDBContext
+from backend.context.document_manifest import DOCUMENT_MANIFEST_TYPE
+
+STATUS_FIELDS = ('id', 'status', 'conversation_id', 'file_name', 'progress')
+
+
+class DocumentStatusFeed(CosmosDBContext):
+    """Reads the change feed of the document status container and pushes
+    status changes to the connected clients of the owning user.
+
+    Each worker runs a single reader, and only while at least one client is
+    subscribed. The feed client is not shared with the request handlers
+    because the change feed continuation is read from the last response
+    headers of the client connection.
+    """
+
+    def __init__(self, cosmosdb_endpoint: str, credential: str | Dict[str, str] | AsyncTokenCredential, database_name: str, container_name: str, poll_interval: float = 1.0):
+        super().__init__(cosmosdb_endpoint, credential, database_name, container_name)
+        self.poll_interval = poll_interval
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._has_subscribers = asyncio.Event()
+        self._continuation: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.cosmosdb_client.close()
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        self._has_subscribers.set()
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        user_queues = self._subscribers.get(user_id)
+        if user_queues is None:
+            return
+
+        user_queues.discard(queue)
+        if not user_queues:
+            del self._subscribers[user_id]
+        if not self._subscribers:
+            self._has_subscribers.clear()
+
+    def dispatch(self, item: dict):
+        if item.get('type') == DOCUMENT_MANIFEST_TYPE:
+            return
+
+        for queue in self._subscribers.get(item.get('user_principal_id'), ()):
+            queue.put_nowait({ key: item.get(key) for key in STATUS_FIELDS })
+
+    async def _run(self):
+        while True:
+            if not self._subscribers:
+                ## nobody is listening, resume from "now" once somebody subscribes again
+                self._continuation = None
+                await self._has_subscribers.wait()
+
+            try:
+                await self._read_changes()
+            except Exception:
+                logging.exception("Exception while reading the document status change feed")
+
+            await asyncio.sleep(self.poll_interval)
+
+    async def _read_changes(self):
+        if self._continuation:
+            changes = self.client_container.query_items_change_feed(continuation=self._continuation)
+        else:
+            ## subscribers read the current statuses when they connect, a small overlap covers the gap
+            changes = self.client_container.query_items_change_feed(
+                start_time=datetime.now(timezone.utc) - timedelta(seconds=self.poll_interval)
+            )
+
+        async for item in changes:
+            self.dispatch(item)
+
+        self._continuation = self.client_container.client_connection.last_response_headers.get('etag', self._continuation)
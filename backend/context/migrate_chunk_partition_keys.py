@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import logging
+
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.partition_key import NonePartitionKeyValue
+from azure.identity.aio import DefaultAzureCredential
+
+from backend.settings import _DocumentUploadSettings
+
+
+async def migrate(batch_size: int = 100, dry_run: bool = False):
+    '''
+    Rewrite document chunks that were stored without a top level userId.
+    Those all share the partition for undefined partition key values, so a
+    copy is written to the user's partition before the original is removed.
+    '''
+    settings = _DocumentUploadSettings()
+    credential = settings.account_key or DefaultAzureCredential()
+    cosmos_client = CosmosClient(f"https://{settings.account}.documents.azure.com:443/", credential=credential)
+    container_client = cosmos_client.get_database_client(settings.database).get_container_client(settings.document_chunks_container)
+
+    query = f"SELECT TOP {batch_size} * FROM c WHERE NOT IS_DEFINED(c.userId) AND IS_DEFINED(c.metadata.user_principal_id)"
+    migrated = 0
+    try:
+        while True:
+            chunks = [item async for item in container_client.query_items(query=query)]
+            if not chunks:
+                break
+
+            for chunk in chunks:
+                if dry_run:
+                    print(f"Would move chunk {chunk['id']} to partition {chunk['metadata']['user_principal_id']}")
+                    continue
+
+                copy = { key: value for key, value in chunk.items() if not key.startswith('_') }
+                copy['userId'] = chunk['metadata']['user_principal_id']
+                await container_client.upsert_item(copy)
+                try:
+                    await container_client.delete_item(item=chunk['id'], partition_key=NonePartitionKeyValue)
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+
+            migrated += len(chunks)
+            if dry_run:
+                break
+    finally:
+        await cosmos_client.close()
+        if not settings.account_key:
+            await credential.close()
+
+    print(f"Moved {migrated} chunks to their user partition")
+    if not dry_run:
+        print("DOCUMENT_UPLOAD_LEGACY_CHUNKS_MIGRATION_PENDING can now be set to False")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Move document chunks written without a userId into their user's partition",
+        epilog="Example: python -m backend.context.migrate_chunk_partition_keys --dry-run",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Number of chunks moved per query round trip.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the first batch of chunks that would be moved without writing anything.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(migrate(args.batch_size, args.dry_run))
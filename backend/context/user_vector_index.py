@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob.aio import ContainerClient
+
+## written by content_loading/UserVectorIndex.py, which documents the layout
+INDEX_MAGIC = b"UVIX"
+INDEX_VERSION = 1
+HEADER_FORMAT = "<4sIIII"
+HEADER_SIZE = 64
+
+
+def _aligned(size: int) -> int:
+    return size + (-size % 4)
+
+
+class UserVectorIndex():
+    """Memory-mapped inverted file index of a user's chunk embeddings.
+
+    Only the centroids and the probed lists are touched by a search, the rest
+    of the file stays on disk until the page cache pulls it in.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, count, dim, nlist = struct.unpack_from(HEADER_FORMAT, data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path} is not a version {INDEX_VERSION} vector index")
+
+        self.count = count
+        self.dim = dim
+        self.nlist = nlist
+
+        offset = HEADER_SIZE
+        self.centroids = np.frombuffer(data, dtype=np.float32, count=nlist * dim, offset=offset).reshape(nlist, dim)
+        offset += self.centroids.nbytes
+        self.list_offsets = np.frombuffer(data, dtype=np.uint32, count=nlist + 1, offset=offset)
+        offset += self.list_offsets.nbytes
+        self.scales = np.frombuffer(data, dtype=np.float32, count=count, offset=offset)
+        offset += self.scales.nbytes
+        self.vectors = np.frombuffer(data, dtype=np.int8, count=count * dim, offset=offset).reshape(count, dim)
+        offset += _aligned(self.vectors.nbytes)
+        self.document_index = np.frombuffer(data, dtype=np.uint32, count=count, offset=offset)
+        offset += self.document_index.nbytes
+
+        id_tables = json.loads(bytes(data[offset:]).decode('utf-8'))
+        self.chunk_ids: List[str] = id_tables['chunk_ids']
+        self.master_document_ids: List[str] = id_tables['master_document_ids']
+        ## the content hash of each document when the file was built, missing in files built before they were recorded
+        self.document_versions: List[Optional[str]] = id_tables.get('document_versions') or [None] * len(self.master_document_ids)
+        self._document_positions = {document_id: position for position, document_id in enumerate(self.master_document_ids)}
+
+    def has_documents(self, master_document_ids: Iterable[str], document_versions: Optional[Dict[str, Optional[str]]] = None) -> bool:
+        """Whether the file holds the documents, and when `document_versions` is given
+        the same versions of them. A document uploaded again is not indexed until the file is rebuilt."""
+        for document_id in master_document_ids:
+            position = self._document_positions.get(document_id)
+            if position is None:
+                return False
+            if document_versions is not None and (document_id not in document_versions or document_versions[document_id] != self.document_versions[position]):
+                return False
+
+        return True
+
+    def search(self, embedding: List[float], master_document_ids: Iterable[str], top_k: int = 40, nprobe: int = 8) -> List[Tuple[str, float]]:
+        '''
+        Approximate top_k chunks of the given documents as (chunk id, cosine similarity).
+        '''
+        allowed = np.zeros(len(self.master_document_ids), dtype=bool)
+        for document_id in master_document_ids:
+            position = self._document_positions.get(document_id)
+            if position is not None:
+                allowed[position] = True
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+
+        probed = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = np.concatenate([np.arange(self.list_offsets[list_id], self.list_offsets[list_id + 1]) for list_id in probed])
+        rows = rows[allowed[self.document_index[rows]]]
+        if not len(rows):
+            return []
+
+        scores = (self.vectors[rows].astype(np.float32) @ query) * self.scales[rows]
+        top_k = min(top_k, len(rows))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+
+        return [(self.chunk_ids[rows[i]], float(scores[i])) for i in best]
+
+
+class UserVectorIndexCache():
+    """Keeps the index files of users on local disk, in sync with blob storage.
+
+    The blob etag is checked at most every `refresh_interval` seconds per user,
+    the file is only downloaded again when it changed.
+    """
+
+    def __init__(self, container_client: ContainerClient, directory: str, refresh_interval: float = 60.0):
+        self.container_client = container_client
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self._indexes: Dict[str, Tuple[Optional[UserVectorIndex], Optional[str], float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    async def get(self, user_id: str) -> Optional[UserVectorIndex]:
+        cached = self._indexes.get(user_id)
+        if cached and time.monotonic() - cached[2] < self.refresh_interval:
+            return cached[0]
+
+        async with self._locks.setdefault(user_id, asyncio.Lock()):
+            cached = self._indexes.get(user_id)
+            if cached and time.monotonic() - cached[2] < self.refresh_interval:
+                return cached[0]
+
+            index, etag = cached[:2] if cached else (None, None)
+            index, etag = await self._refresh(user_id, index, etag)
+            self._indexes[user_id] = (index, etag, time.monotonic())
+
+            return index
+
+    async def _refresh(self, user_id: str, index: Optional[UserVectorIndex], etag: Optional[str]):
+        blob_client = self.container_client.get_blob_client(f"{user_id}.ann")
+        try:
+            properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return None, None
+
+        if index is not None and properties.etag == etag:
+            return index, etag
+
+        path = os.path.join(self.directory, f"{user_id}.ann")
+        download_path = f"{path}.download"
+        downloader = await blob_client.download_blob()
+        with open(download_path, 'wb') as file:
+            async for chunk in downloader.chunks():
+                file.write(chunk)
+
+        ## searches still holding the previous map keep reading the replaced file
+        os.replace(download_path, path)
+        return UserVectorIndex(path), downloader.properties.etag
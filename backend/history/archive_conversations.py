@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import BlobServiceClient
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.settings import _ChatHistorySettings, _StorageAccountSettings
+
+
+async def archive(inactive_days: int = None, user_id: str = None, limit: int = None, dry_run: bool = False):
+    settings = _ChatHistorySettings()
+    storage_settings = _StorageAccountSettings()
+    if not settings.archive_container:
+        raise ValueError("AZURE_COSMOSDB_ARCHIVE_CONTAINER is not configured")
+
+    credential = DefaultAzureCredential()
+    blob_service_client = BlobServiceClient(
+        account_url=f"https://{storage_settings.account_name}.blob.core.windows.net",
+        credential=storage_settings.account_key or credential
+    )
+    archive_container_client = blob_service_client.get_container_client(settings.archive_container)
+    if not dry_run and not await archive_container_client.exists():
+        await archive_container_client.create_container()
+
+    cosmos_client = CosmosConversationClient(
+        None,
+        cosmosdb_endpoint=f"https://{settings.account}.documents.azure.com:443/",
+        credential=settings.account_key or credential,
+        database_name=settings.database,
+        chat_container_name=settings.conversations_container,
+        document_chunks_container_name=None,
+        document_status_container_name=None,
+        enable_message_feedback=settings.enable_feedback,
+        enable_message_buckets=settings.enable_message_buckets,
+        message_bucket_max_messages=settings.message_bucket_max_messages,
+        message_bucket_max_kb=settings.message_bucket_max_kb,
+        archive_container_client=archive_container_client
+    )
+
+    cutoff = (datetime.utcnow() - timedelta(days=inactive_days or settings.archive_after_days)).isoformat()
+    chat_container_client = cosmos_client.create_chat_container_client()
+    query = "SELECT * FROM c WHERE c.type = 'conversation' AND c.updatedAt < @cutoff AND NOT (IS_DEFINED(c.archived) AND c.archived = true)"
+    parameters = [{ 'name': '@cutoff', 'value': cutoff }]
+    if user_id:
+        query += " AND c.userId = @userId"
+        parameters.append({ 'name': '@userId', 'value': user_id })
+
+    archived_conversations = 0
+    archived_messages = 0
+    try:
+        async for conversation in chat_container_client.query_items(query=query, parameters=parameters):
+            if limit is not None and archived_conversations >= limit:
+                break
+
+            if dry_run:
+                print(f"Would archive conversation {conversation['id']} last updated {conversation['updatedAt']}")
+                archived_conversations += 1
+                continue
+
+            try:
+                message_count = await cosmos_client.archive_conversation(conversation['userId'], conversation)
+            except Exception:
+                logging.exception(f"Failed to archive conversation {conversation['id']}")
+                continue
+
+            archived_conversations += 1
+            archived_messages += message_count
+    finally:
+        await cosmos_client.close()
+        await blob_service_client.close()
+        await credential.close()
+
+    print(f"Archived {archived_messages} messages from {archived_conversations} conversations inactive since {cutoff}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Move inactive conversations from Cosmos DB to compressed blobs in the archive container",
+        epilog="Example: python -m backend.history.archive_conversations --inactive-days 180",
+    )
+    parser.add_argument(
+        "--inactive-days",
+        type=int,
+        required=False,
+        help="Archive conversations without activity for this many days. Defaults to AZURE_COSMOSDB_ARCHIVE_AFTER_DAYS.",
+    )
+    parser.add_argument(
+        "--user-id",
+        required=False,
+        help="Only archive the conversations of this user.",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        required=False,
+        help="Maximum number of conversations to archive in this run.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the conversations that would be archived without moving them.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(archive(args.inactive_days, args.user_id, args.limit, args.dry_run))
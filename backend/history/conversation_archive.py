@@ -0,0 +1,43 @@
+import gzip
+import json
+from typing import List, Tuple
+
+ARCHIVE_FIELDS = ('archived', 'archivedAt', 'archiveBlob', 'archivedMessageCount')
+
+
+def get_archive_blob_name(user_id: str, conversation_id: str) -> str:
+    return f"{user_id}/{conversation_id}.jsonl.gz"
+
+
+def strip_system_properties(item: dict) -> dict:
+    return { key: value for key, value in item.items() if not key.startswith('_') }
+
+
+def serialize_archive(conversation: dict, messages: List[dict]) -> bytes:
+    '''
+    Write a conversation as gzip compressed JSONL, the conversation document
+    on the first line followed by its messages in order.
+    '''
+    lines = [json.dumps(strip_system_properties(conversation))]
+    lines.extend(json.dumps(strip_system_properties(message)) for message in messages)
+    return gzip.compress(("\n".join(lines) + "\n").encode('utf-8'))
+
+
+def deserialize_archive(data: bytes) -> Tuple[dict, List[dict]]:
+    lines = [line for line in gzip.decompress(data).decode('utf-8').splitlines() if line.strip()]
+    conversation = json.loads(lines[0])
+    messages = [json.loads(line) for line in lines[1:]]
+    return conversation, messages
+
+
+def create_archive_stub(conversation: dict, blob_name: str, message_count: int, archived_at: str) -> dict:
+    ## the stub keeps everything the conversation list needs, messages are read back from the blob
+    stub = {
+        key: value for key, value in strip_system_properties(conversation).items()
+        if key not in ('messageLayout', 'bucketCount')
+    }
+    stub['archived'] = True
+    stub['archivedAt'] = archived_at
+    stub['archiveBlob'] = blob_name
+    stub['archivedMessageCount'] = message_count
+    return stub
@@ -1,9 +1,31 @@
 import uuid
-from typing import List
+import asyncio
+import logging
+from typing import List, Optional
 from datetime import datetime
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from azure.storage.blob.aio import ContainerClient
 from backend.context.document_status_context import DocumentStatusContext
+from backend.history.write_behind_queue import ChatHistoryWriteQueue
+from backend.history.message_buckets import (
+    MESSAGE_BUCKET_TYPE,
+    MESSAGE_LAYOUT_BUCKETED,
+    create_bucket,
+    get_bucket_id,
+    get_message_size,
+    pack_messages,
+    unpack_buckets
+)
+from backend.history.conversation_archive import (
+    ARCHIVE_FIELDS,
+    create_archive_stub,
+    deserialize_archive,
+    get_archive_blob_name,
+    serialize_archive
+)
 
 class CosmosConversationClient():
     
@@ -15,7 +37,15 @@ class CosmosConversationClient():
         chat_container_name: str,
         document_chunks_container_name: str,
         document_status_container_name: str,
-        enable_message_feedback: bool = False
+        enable_message_feedback: bool = False,
+        enable_write_behind: bool = False,
+        write_behind_flush_interval: float = 0.5,
+        write_behind_max_retries: int = 5,
+        write_behind_spill_directory: Optional[str] = None,
+        enable_message_buckets: bool = False,
+        message_bucket_max_messages: int = 100,
+        message_bucket_max_kb: int = 512,
+        archive_container_client: Optional[ContainerClient] = None
     ):
         self.document_status_context = document_status_context
         self.cosmosdb_endpoint = cosmosdb_endpoint
@@ -26,6 +56,10 @@ class CosmosConversationClient():
         self.document_status_container_name = document_status_container_name
 
         self.enable_message_feedback = enable_message_feedback
+        self.enable_message_buckets = enable_message_buckets
+        self.message_bucket_max_messages = message_bucket_max_messages
+        self.message_bucket_max_bytes = message_bucket_max_kb * 1024
+        self.archive_container_client = archive_container_client
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -38,6 +72,24 @@ class CosmosConversationClient():
             self.database_client = self.cosmosdb_client.get_database_client(database_name)
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Invalid CosmosDB database name") 
+
+        self.write_queue: Optional[ChatHistoryWriteQueue] = None
+        if enable_write_behind:
+            self.write_queue = ChatHistoryWriteQueue(
+                self.create_chat_container_client(),
+                flush_interval=write_behind_flush_interval,
+                max_retries=write_behind_max_retries,
+                spill_directory=write_behind_spill_directory
+            )
+
+    async def start(self):
+        if self.write_queue:
+            await self.write_queue.start()
+
+    async def close(self):
+        if self.write_queue:
+            await self.write_queue.close()
+        await self.cosmosdb_client.close()
         
     async def ensure(self):
         chat_container_client = self.create_chat_container_client()
@@ -65,22 +117,25 @@ class CosmosConversationClient():
             'userId': user_id,
             'title': title
         }
+        if self.enable_message_buckets:
+            conversation['messageLayout'] = MESSAGE_LAYOUT_BUCKETED
+            conversation['bucketCount'] = 0
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await chat_container_client.upsert_item(conversation)  
+        resp = await self.upsert_item(conversation)  
         if resp:
             return resp
         else:
             return False
     
     async def upsert_conversation(self, conversation):
-        chat_container_client = self.create_chat_container_client()
-        resp = await chat_container_client.upsert_item(conversation)
+        resp = await self.upsert_item(conversation)
         if resp:
             return resp
         else:
             return False
 
     async def delete_conversation(self, user_id, conversation_id):
+        await self.flush_pending_writes(user_id)
         chat_container_client = self.create_chat_container_client()
         conversation = await chat_container_client.read_item(item=conversation_id, partition_key=user_id)        
         if conversation:
@@ -94,8 +149,33 @@ class CosmosConversationClient():
         
     async def delete_messages(self, conversation_id, user_id):
         ## get a list of all the messages in the conversation
+        await self.flush_pending_writes(user_id)
         chat_container_client = self.create_chat_container_client()
-        messages = await self.get_messages(user_id, conversation_id)
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if conversation and conversation.get('archived'):
+            await self.delete_archive(conversation)
+            ## the conversation itself stays, it just no longer has any messages
+            for key in ARCHIVE_FIELDS:
+                conversation.pop(key, None)
+            if self.enable_message_buckets:
+                conversation['messageLayout'] = MESSAGE_LAYOUT_BUCKETED
+                conversation['bucketCount'] = 0
+            await chat_container_client.upsert_item(conversation)
+
+            await self.document_status_context.delete_document_by_conversation_id(user_id, conversation_id)
+            return []
+
+        if conversation and conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED:
+            buckets = await self.get_message_buckets(user_id, conversation)
+            response_list = []
+            for bucket in buckets:
+                resp = await chat_container_client.delete_item(item=bucket['id'], partition_key=user_id)
+                response_list.append(resp)
+
+            await self.document_status_context.delete_document_by_conversation_id(user_id, conversation_id)
+            return response_list
+
+        messages = await self.get_messages(user_id, conversation_id, conversation)
         response_list = []
         if messages:
             for message in messages:
@@ -107,6 +187,8 @@ class CosmosConversationClient():
 
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        ## paging and ordering happen server side, so pending writes have to land first
+        await self.flush_pending_writes(user_id)
         chat_container_client = self.create_chat_container_client()
         parameters = [
             {
@@ -125,6 +207,14 @@ class CosmosConversationClient():
         return conversations
 
     async def get_conversation(self, user_id, conversation_id):
+        if self.write_queue:
+            pending_conversations = await self.write_queue.get_items(
+                user_id,
+                lambda item: item['id'] == conversation_id and item.get('type') == 'conversation'
+            )
+            if pending_conversations:
+                return pending_conversations[0]
+
         chat_container_client = self.create_chat_container_client()
         parameters = [
             {
@@ -148,7 +238,13 @@ class CosmosConversationClient():
             return conversations[0]
  
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        chat_container_client = self.create_chat_container_client()
+        conversation = await self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return "Conversation not found"
+
+        if conversation.get('archived'):
+            conversation = await self.restore_conversation(user_id, conversation)
+
         message = {
             'id': uuid,
             'type': 'message',
@@ -163,21 +259,62 @@ class CosmosConversationClient():
         if self.enable_message_feedback:
             message['feedback'] = ''
         
-        resp = await chat_container_client.upsert_item(message)  
+        resp = await self.write_message(conversation, message)
         if resp:
             ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
+            await self.update_conversation_timestamp(user_id, conversation, message)
             return resp
         else:
             return False
+
+    async def write_message(self, conversation, message):
+        if conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED:
+            return await self.append_to_bucket(conversation, message)
+
+        return await self.upsert_item(message)
+
+    async def update_conversation_timestamp(self, user_id, conversation, message):
+        ## conditional on the conversation that was read, so an archive stub swapped in since is never overwritten
+        chat_container_client = self.create_chat_container_client()
+        while True:
+            conversation['updatedAt'] = max(conversation.get('updatedAt') or '', message['createdAt'])
+            if '_etag' not in conversation:
+                ## still waiting in the write queue, so it can't have been archived
+                return await self.upsert_conversation(conversation)
+
+            try:
+                return await chat_container_client.replace_item(
+                    item=conversation['id'],
+                    body=conversation,
+                    etag=conversation['_etag'],
+                    match_condition=MatchConditions.IfNotModified
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                ## deleted in the meantime
+                return None
+            except exceptions.CosmosAccessConditionFailedError:
+                message_layout = conversation.get('messageLayout')
+                bucket_count = conversation.get('bucketCount', 0)
+                conversation = await chat_container_client.read_item(item=conversation['id'], partition_key=user_id)
+
+            if conversation.get('archived'):
+                ## archived after it was read, the message may have been removed with the others
+                conversation = await self.restore_conversation(user_id, conversation)
+                await self.write_message(conversation, message)
+            elif conversation.get('messageLayout') != message_layout:
+                ## migrated to buckets after it was read, the buckets were written without the message
+                await self.write_message(conversation, message)
+            elif conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED:
+                conversation['bucketCount'] = max(conversation.get('bucketCount', 0), bucket_count)
     
     async def update_message_feedback(self, user_id, message_id, feedback):
+        await self.flush_pending_writes(user_id)
         chat_container_client = self.create_chat_container_client()
-        message = await chat_container_client.read_item(item=message_id, partition_key=user_id)
+        try:
+            message = await chat_container_client.read_item(item=message_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return await self.update_bucket_message_feedback(user_id, message_id, feedback)
+
         if message:
             message['feedback'] = feedback
             resp = await chat_container_client.upsert_item(message)
@@ -185,7 +322,17 @@ class CosmosConversationClient():
         else:
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+    async def get_messages(self, user_id, conversation_id, conversation = None):
+        if conversation is None:
+            conversation = await self.get_conversation(user_id, conversation_id)
+
+        if conversation and conversation.get('archived'):
+            return await self.get_archived_messages(conversation)
+
+        if conversation and conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED:
+            buckets = await self.get_message_buckets(user_id, conversation)
+            return unpack_buckets(buckets)
+
         chat_container_client = self.create_chat_container_client()
         parameters = [
             {
@@ -198,18 +345,280 @@ class CosmosConversationClient():
             }
         ]
         query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+
+        ## overlay writes that are still queued, by any worker, so readers see their latest messages.
+        ## they are read first, the queue only forgets an item once it is written
+        pending_messages = []
+        if self.write_queue:
+            pending_messages = await self.write_queue.get_items(
+                user_id,
+                lambda item: item.get('type') == 'message' and item.get('conversationId') == conversation_id
+            )
+
         messages = []
         async for item in chat_container_client.query_items(query=query, parameters=parameters):
             messages.append(item)
 
+        if pending_messages:
+            pending_ids = {message['id'] for message in pending_messages}
+            messages = [message for message in messages if message['id'] not in pending_ids]
+            messages.extend(sorted(pending_messages, key=lambda message: message['createdAt']))
+
         return messages
 
-    
+    async def append_to_bucket(self, conversation, message):
+        ## appends are single patch operations so concurrent writers never overwrite each other,
+        ## the filter predicate rejects the patch once the active bucket is full
+        chat_container_client = self.create_chat_container_client()
+        user_id = conversation['userId']
+        message_size = get_message_size(message)
+        filter_predicate = (
+            f"FROM c WHERE ARRAY_LENGTH(c.messages) < {self.message_bucket_max_messages} "
+            f"AND c.sizeBytes + {message_size} <= {self.message_bucket_max_bytes}"
+        )
+        patch_operations = [
+            { 'op': 'add', 'path': '/messages/-', 'value': message },
+            { 'op': 'incr', 'path': '/sizeBytes', 'value': message_size },
+            { 'op': 'set', 'path': '/updatedAt', 'value': message['createdAt'] }
+        ]
+
+        index = max(conversation.get('bucketCount', 0) - 1, 0)
+        while True:
+            try:
+                resp = await chat_container_client.patch_item(
+                    item=get_bucket_id(conversation['id'], index),
+                    partition_key=user_id,
+                    patch_operations=patch_operations,
+                    filter_predicate=filter_predicate
+                )
+                break
+            except exceptions.CosmosAccessConditionFailedError:
+                index += 1
+            except exceptions.CosmosResourceNotFoundError:
+                try:
+                    resp = await chat_container_client.create_item(
+                        create_bucket(user_id, conversation['id'], index, [message])
+                    )
+                    break
+                except exceptions.CosmosResourceExistsError:
+                    ## another writer opened this bucket first, append to it instead
+                    continue
+
+        conversation['bucketCount'] = max(conversation.get('bucketCount', 0), index + 1)
+        return resp
+
+    async def get_message_buckets(self, user_id, conversation):
+        chat_container_client = self.create_chat_container_client()
+
+        async def read_bucket(index):
+            try:
+                return await chat_container_client.read_item(
+                    item=get_bucket_id(conversation['id'], index),
+                    partition_key=user_id
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+        bucket_count = conversation.get('bucketCount', 0)
+        buckets = await asyncio.gather(*(read_bucket(index) for index in range(bucket_count)))
+        buckets = [bucket for bucket in buckets if bucket]
+
+        ## the conversation's bucketCount can lag behind a concurrent append, so probe for newer buckets
+        index = bucket_count
+        while True:
+            bucket = await read_bucket(index)
+            if not bucket:
+                break
+            buckets.append(bucket)
+            index += 1
+
+        return buckets
+
+    async def update_bucket_message_feedback(self, user_id, message_id, feedback):
+        chat_container_client = self.create_chat_container_client()
+        parameters = [
+            {
+                'name': '@messageId',
+                'value': message_id
+            }
+        ]
+        query = f"SELECT * FROM c WHERE c.type = '{MESSAGE_BUCKET_TYPE}' AND EXISTS(SELECT VALUE m FROM m IN c.messages WHERE m.id = @messageId)"
+        async for bucket in chat_container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            ## a message that was appended twice keeps its last copy, see unpack_buckets
+            position = max(index for index, message in enumerate(bucket['messages']) if message['id'] == message_id)
+            await chat_container_client.patch_item(
+                item=bucket['id'],
+                partition_key=user_id,
+                patch_operations=[{ 'op': 'set', 'path': f"/messages/{position}/feedback", 'value': feedback }]
+            )
+            message = bucket['messages'][position]
+            message['feedback'] = feedback
+            return message
+
+        return False
+
+    async def migrate_conversation_to_buckets(self, user_id, conversation, delete_source = True):
+        if conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED or conversation.get('archived'):
+            ## an archived conversation gets the layout of new conversations when it is restored
+            return 0
+
+        chat_container_client = self.create_chat_container_client()
+        messages = await self.get_messages(user_id, conversation['id'], conversation)
+        messages = sorted(messages, key=lambda message: message['createdAt'])
+        message_groups = pack_messages(
+            [{ key: value for key, value in message.items() if not key.startswith('_') } for message in messages],
+            self.message_bucket_max_messages,
+            self.message_bucket_max_bytes
+        )
+
+        for index, message_group in enumerate(message_groups):
+            await chat_container_client.upsert_item(create_bucket(user_id, conversation['id'], index, message_group))
+
+        ## the layout only switches once every bucket is written, so a failed run can be repeated,
+        ## and only if no message was added to the conversation while its buckets were written
+        bucketed = { **conversation, 'messageLayout': MESSAGE_LAYOUT_BUCKETED, 'bucketCount': len(message_groups) }
+        try:
+            await chat_container_client.replace_item(
+                item=conversation['id'],
+                body=bucketed,
+                etag=conversation['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            for index in range(len(message_groups)):
+                try:
+                    await chat_container_client.delete_item(item=get_bucket_id(conversation['id'], index), partition_key=user_id)
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+
+            conversation = await chat_container_client.read_item(item=conversation['id'], partition_key=user_id)
+            return await self.migrate_conversation_to_buckets(user_id, conversation, delete_source)
+
+        if delete_source:
+            for message in messages:
+                await chat_container_client.delete_item(item=message['id'], partition_key=user_id)
+
+        return len(messages)
+
+    async def archive_conversation(self, user_id, conversation, archived_at = None):
+        if not self.archive_container_client:
+            raise ValueError("Conversation archive container not configured")
+
+        if conversation.get('archived'):
+            return 0
+
+        await self.flush_pending_writes(user_id)
+        chat_container_client = self.create_chat_container_client()
+        messages = await self.get_messages(user_id, conversation['id'], conversation)
+        if conversation.get('messageLayout') == MESSAGE_LAYOUT_BUCKETED:
+            document_ids = [bucket['id'] for bucket in await self.get_message_buckets(user_id, conversation)]
+        else:
+            document_ids = [message['id'] for message in messages]
+
+        blob_name = get_archive_blob_name(user_id, conversation['id'])
+        blob_client = self.archive_container_client.get_blob_client(blob_name)
+        await blob_client.upload_blob(serialize_archive(conversation, messages), overwrite=True)
+
+        stub = create_archive_stub(conversation, blob_name, len(messages), archived_at or datetime.utcnow().isoformat())
+        try:
+            ## only swap in the stub if the conversation was not touched while its messages were copied
+            await chat_container_client.replace_item(
+                item=conversation['id'],
+                body=stub,
+                etag=conversation['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            await blob_client.delete_blob()
+            return 0
+
+        for document_id in document_ids:
+            try:
+                await chat_container_client.delete_item(item=document_id, partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+        return len(messages)
+
+    async def get_archived_messages(self, conversation, missing_ok = True):
+        if not self.archive_container_client:
+            raise ValueError("Conversation archive container not configured")
+
+        blob_client = self.archive_container_client.get_blob_client(conversation['archiveBlob'])
+        try:
+            downloader = await blob_client.download_blob()
+            data = await downloader.readall()
+        except ResourceNotFoundError:
+            if not missing_ok:
+                raise ValueError(f"Archive {conversation['archiveBlob']} of conversation {conversation['id']} not found")
+            logging.warning(f"Archive {conversation['archiveBlob']} of conversation {conversation['id']} not found")
+            return []
+
+        _, messages = deserialize_archive(data)
+        return messages
+
+    async def restore_conversation(self, user_id, conversation):
+        ## move the messages back into the chat container, e.g. before the conversation is continued.
+        ## the stub and the archive are only replaced once every message is written back, so a missing
+        ## or unreadable archive or a failed write leaves the conversation archived
+        chat_container_client = self.create_chat_container_client()
+        messages = await self.get_archived_messages(conversation, missing_ok=False)
+        restored = { key: value for key, value in conversation.items() if key not in ARCHIVE_FIELDS }
+
+        ## documents a concurrent restore already wrote back are kept, messages may have been added to them since
+        async def create_item(item):
+            try:
+                await chat_container_client.create_item(item)
+            except exceptions.CosmosResourceExistsError:
+                pass
+
+        if self.enable_message_buckets:
+            message_groups = pack_messages(messages, self.message_bucket_max_messages, self.message_bucket_max_bytes)
+            for index, message_group in enumerate(message_groups):
+                await create_item(create_bucket(user_id, conversation['id'], index, message_group))
+            restored['messageLayout'] = MESSAGE_LAYOUT_BUCKETED
+            restored['bucketCount'] = len(message_groups)
+        else:
+            for message in messages:
+                await create_item(message)
+
+        try:
+            restored = await chat_container_client.replace_item(
+                item=conversation['id'],
+                body=restored,
+                etag=conversation['_etag'],
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            ## restored concurrently, that restore removes the archive
+            current = await chat_container_client.read_item(item=conversation['id'], partition_key=user_id)
+            if current.get('archived'):
+                return await self.restore_conversation(user_id, current)
+            return current
+
+        await self.delete_archive(conversation)
+        return restored
+
+    async def delete_archive(self, conversation):
+        if not self.archive_container_client:
+            return
+
+        try:
+            await self.archive_container_client.delete_blob(conversation['archiveBlob'])
+        except ResourceNotFoundError:
+            pass
+
+    async def upsert_item(self, item: dict):
+        if self.write_queue:
+            return await self.write_queue.enqueue(item)
+
+        chat_container_client = self.create_chat_container_client()
+        return await chat_container_client.upsert_item(item)
+
+    async def flush_pending_writes(self, user_id):
+        if self.write_queue and self.write_queue.has_pending(user_id):
+            await self.write_queue.flush_user(user_id)
 
-    
-    
-    
-    
     def create_chat_container_client(self):
         try:
             return self.database_client.get_container_client(self.chat_container_name)
@@ -0,0 +1,66 @@
+import json
+from datetime import datetime
+from typing import List
+
+MESSAGE_LAYOUT_BUCKETED = 'bucketed'
+MESSAGE_BUCKET_TYPE = 'message_bucket'
+
+
+def get_bucket_id(conversation_id: str, index: int) -> str:
+    return f"{conversation_id}-bucket-{index}"
+
+
+def get_message_size(message: dict) -> int:
+    return len(json.dumps(message).encode('utf-8'))
+
+
+def create_bucket(user_id: str, conversation_id: str, index: int, messages: List[dict]) -> dict:
+    return {
+        'id': get_bucket_id(conversation_id, index),
+        'type': MESSAGE_BUCKET_TYPE,
+        'userId': user_id,
+        'conversationId': conversation_id,
+        'index': index,
+        'createdAt': datetime.utcnow().isoformat(),
+        'updatedAt': datetime.utcnow().isoformat(),
+        'sizeBytes': sum(get_message_size(message) for message in messages),
+        'messages': messages
+    }
+
+
+def pack_messages(messages: List[dict], max_messages: int, max_bytes: int) -> List[List[dict]]:
+    '''
+    Split messages, in order, into groups that fit within the bucket limits.
+    A message larger than max_bytes gets a bucket of its own.
+    '''
+    buckets = []
+    current = []
+    current_size = 0
+    for message in messages:
+        size = get_message_size(message)
+        if current and (len(current) >= max_messages or current_size + size > max_bytes):
+            buckets.append(current)
+            current = []
+            current_size = 0
+
+        current.append(message)
+        current_size += size
+
+    if current:
+        buckets.append(current)
+
+    return buckets
+
+
+def unpack_buckets(buckets: List[dict]) -> List[dict]:
+    '''
+    Flatten bucket documents into a single ordered message list. Appends are
+    not idempotent, so a message id that was written twice keeps its last copy.
+    '''
+    messages = {}
+    for bucket in sorted(buckets, key=lambda bucket: bucket['index']):
+        for message in bucket['messages']:
+            messages.pop(message['id'], None)
+            messages[message['id']] = message
+
+    return list(messages.values())
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import logging
+
+from azure.identity.aio import DefaultAzureCredential
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.message_buckets import MESSAGE_LAYOUT_BUCKETED
+from backend.settings import _ChatHistorySettings
+
+
+async def migrate(user_id: str = None, dry_run: bool = False, delete_source: bool = False):
+    settings = _ChatHistorySettings()
+    credential = settings.account_key or DefaultAzureCredential()
+    cosmos_client = CosmosConversationClient(
+        None,
+        cosmosdb_endpoint=f"https://{settings.account}.documents.azure.com:443/",
+        credential=credential,
+        database_name=settings.database,
+        chat_container_name=settings.conversations_container,
+        document_chunks_container_name=None,
+        document_status_container_name=None,
+        enable_message_feedback=settings.enable_feedback,
+        enable_message_buckets=True,
+        message_bucket_max_messages=settings.message_bucket_max_messages,
+        message_bucket_max_kb=settings.message_bucket_max_kb
+    )
+
+    chat_container_client = cosmos_client.create_chat_container_client()
+    query = "SELECT * FROM c WHERE c.type = 'conversation' AND (NOT IS_DEFINED(c.messageLayout) OR c.messageLayout != @layout)"
+    parameters = [{ 'name': '@layout', 'value': MESSAGE_LAYOUT_BUCKETED }]
+    if user_id:
+        query += " AND c.userId = @userId"
+        parameters.append({ 'name': '@userId', 'value': user_id })
+
+    conversations = [item async for item in chat_container_client.query_items(query=query, parameters=parameters)]
+    migrated_messages = 0
+    try:
+        for conversation in conversations:
+            if dry_run:
+                messages = await cosmos_client.get_messages(conversation['userId'], conversation['id'], conversation)
+                print(f"Would migrate conversation {conversation['id']} with {len(messages)} messages")
+                continue
+
+            message_count = await cosmos_client.migrate_conversation_to_buckets(
+                conversation['userId'],
+                conversation,
+                delete_source=delete_source
+            )
+            migrated_messages += message_count
+            print(f"Migrated conversation {conversation['id']} with {message_count} messages")
+    finally:
+        await cosmos_client.close()
+        if not settings.account_key:
+            await credential.close()
+
+    print(f"Migrated {migrated_messages} messages from {len(conversations)} conversations")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Move the messages of existing conversations into bucket documents",
+        epilog="Example: python -m backend.history.migrate_message_buckets --user-id 123 --delete-source",
+    )
+    parser.add_argument(
+        "--user-id",
+        required=False,
+        help="Only migrate the conversations of this user.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the conversations that would be migrated without writing anything.",
+    )
+    parser.add_argument(
+        "--delete-source",
+        action="store_true",
+        help="Delete the individual message documents once their bucket has been written.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(migrate(args.user_id, args.dry_run, args.delete_source))
@@ -0,0 +1,415 @@
+import os
+import json
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+import tempfile
+from typing import Callable, Dict, IO, List, Optional, Tuple
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.cosmos.aio import ContainerProxy
+
+try:
+    import fcntl
+except ImportError:
+    ## without file locks, e.g. on Windows, the app is expected to run as a single worker
+    fcntl = None
+
+# Cosmos DB rejects transactional batches with more than 100 operations or 2 MB of payload
+MAX_BATCH_OPERATIONS = 100
+MAX_BATCH_BYTES = 1_800_000
+RETRYABLE_STATUS_CODES = {408, 429, 449, 500, 502, 503, 504}
+
+
+def get_user_key(user_id: str) -> str:
+    return hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:32]
+
+
+class ChatHistoryWriteQueue():
+    """Write-behind buffer for the chat history container.
+
+    Items are acknowledged as soon as they are enqueued and are written to Cosmos
+    in the background as transactional batches grouped by the user partition.
+    Failed batches are retried with exponential backoff and, once the retries
+    are exhausted, kept in JSONL files on local disk so that they can be
+    replayed when Cosmos is reachable again (including after a restart).
+    Items Cosmos rejects outright are moved to the `rejected` directory instead,
+    replaying them would fail the same way.
+
+    Every worker process journals the items it has not written yet to its own
+    locked directory under `spill_directory`. `get_items` overlays them, and
+    those of the other workers of the host, on top of query results so readers
+    see their latest writes whichever worker handles the request. The journals
+    are written and read in worker threads to keep disk I/O off the event loop. The directory
+    of a worker that exited is taken over by the next one that starts.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerProxy,
+        flush_interval: float = 0.5,
+        max_retries: int = 5,
+        retry_backoff: float = 0.5,
+        spill_directory: Optional[str] = None,
+        spill_replay_interval: float = 30.0
+    ):
+        self.container_client = container_client
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.spill_directory = spill_directory or os.path.join(tempfile.gettempdir(), "chat_history_spill")
+        self.spill_replay_interval = spill_replay_interval
+        self.rejected_directory = os.path.join(self.spill_directory, "rejected")
+
+        self._pending: Dict[str, Dict[str, dict]] = {}
+        self._in_flight: Dict[str, Dict[str, dict]] = {}
+        self._spilled: Dict[str, Dict[str, dict]] = {}
+        self._spill_files: Dict[str, List[str]] = {}
+        self._journals: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._journal_locks: Dict[str, asyncio.Lock] = {}
+        self._other_worker_files: Dict[str, Tuple[Tuple[int, int], List[dict]]] = {}
+        self._wakeup = asyncio.Event()
+        self._next_replay = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._worker_directory: Optional[str] = None
+        self._worker_lock: Optional[IO] = None
+
+    async def start(self):
+        self._adopt_orphaned_files()
+        self._load_spill_files()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+
+        ## final flush, anything that still fails stays on disk for the next start
+        await self.flush(include_spilled=True)
+        if self._worker_lock:
+            self._worker_lock.close()
+            self._worker_lock = None
+            if not self._spilled:
+                try:
+                    os.remove(os.path.join(self._worker_directory, ".lock"))
+                    os.rmdir(self._worker_directory)
+                except OSError:
+                    pass
+
+    async def enqueue(self, item: dict) -> dict:
+        user_id = item['userId']
+        ## the journal is appended to off the event loop, the lock keeps the appends in order
+        ## and the item out of a flush until it is journaled
+        async with self._journal_locks.setdefault(user_id, asyncio.Lock()):
+            await self._append_to_journal(user_id, item)
+            user_items = self._pending.setdefault(user_id, {})
+            user_items[item['id']] = item
+
+        if len(user_items) >= MAX_BATCH_OPERATIONS:
+            self._wakeup.set()
+
+        return item
+
+    def has_pending(self, user_id: str) -> bool:
+        return bool(self._pending.get(user_id) or self._in_flight.get(user_id) or self._spilled.get(user_id))
+
+    async def get_items(self, user_id: str, predicate: Callable[[dict], bool]) -> List[dict]:
+        ## newest version of each item wins: other workers < spilled < in flight < pending.
+        ## read before querying Cosmos, a worker only removes its files once their items are written
+        other_worker_items = await asyncio.to_thread(self._read_other_workers, user_id)
+        items = { item['id']: item for item in other_worker_items }
+        for source in (self._spilled, self._in_flight, self._pending):
+            items.update(source.get(user_id, {}))
+
+        return [item for item in items.values() if predicate(item)]
+
+    async def flush(self, include_spilled: bool = False):
+        user_ids = set(self._pending.keys())
+        if include_spilled:
+            user_ids.update(self._spilled.keys())
+
+        if user_ids:
+            await asyncio.gather(*(self.flush_user(user_id) for user_id in user_ids))
+
+    async def flush_user(self, user_id: str) -> bool:
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            spill_files = self._spill_files.pop(user_id, [])
+            async with self._journal_locks.setdefault(user_id, asyncio.Lock()):
+                ## items enqueued while this batch is written go to a new journal
+                journal = self._journals.pop(user_id, None)
+                if journal:
+                    spill_files.append(journal)
+                items = {
+                    **self._spilled.pop(user_id, {}),
+                    **self._pending.pop(user_id, {})
+                }
+            if not items:
+                self._remove_spill_files(spill_files)
+                return True
+
+            self._in_flight[user_id] = items
+            success = False
+            try:
+                rejected_items = await self._write_items(user_id, list(items.values()))
+                if rejected_items:
+                    self._reject(user_id, rejected_items)
+                success = not rejected_items
+            except Exception:
+                logging.exception(f"Spilling {len(items)} chat history writes to disk")
+                spill_files = self._spill(user_id, items, spill_files)
+            finally:
+                self._in_flight.pop(user_id, None)
+
+            self._remove_spill_files(spill_files)
+            return success
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            replay_spilled = bool(self._spilled) and loop.time() >= self._next_replay
+            if replay_spilled:
+                self._next_replay = loop.time() + self.spill_replay_interval
+
+            try:
+                await self.flush(include_spilled=replay_spilled)
+            except Exception:
+                logging.exception("Exception while flushing chat history writes")
+
+    async def _write_items(self, user_id: str, items: List[dict]) -> List[dict]:
+        """Write the items in batches. Returns the items Cosmos rejected, retryable errors are raised."""
+        rejected_items = []
+        for batch in self._prepare_batches(items):
+            try:
+                await self._execute_batch(user_id, [("upsert", (item,)) for item in batch])
+            except HttpResponseError as e:
+                if e.status_code is None or e.status_code in RETRYABLE_STATUS_CODES:
+                    raise
+                if len(batch) == 1:
+                    logging.error(f"CosmosDB rejected chat history write {batch[0]['id']} with status {e.status_code}")
+                    rejected_items.extend(batch)
+                    continue
+
+                ## a batch fails as a whole, write its items one by one so only the ones Cosmos rejects are set aside
+                for item in batch:
+                    rejected_items.extend(await self._write_items(user_id, [item]))
+
+        return rejected_items
+
+    @staticmethod
+    def _prepare_batches(items: List[dict]) -> List[List[dict]]:
+        batches = []
+        batch: List[dict] = []
+        batch_bytes = 0
+        for item in items:
+            item_bytes = len(json.dumps(item))
+            if batch and (len(batch) >= MAX_BATCH_OPERATIONS or batch_bytes + item_bytes > MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(item)
+            batch_bytes += item_bytes
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    async def _execute_batch(self, user_id: str, operations: list):
+        attempt = 0
+        while True:
+            try:
+                return await self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+            except (HttpResponseError, ServiceRequestError, ServiceResponseError) as e:
+                status_code = getattr(e, 'status_code', None)
+                if attempt >= self.max_retries or (status_code is not None and status_code not in RETRYABLE_STATUS_CODES):
+                    raise
+
+                delay = self.retry_backoff * (2 ** attempt)
+                await asyncio.sleep(delay + random.uniform(0, delay))
+                attempt += 1
+
+    def _get_worker_directory(self) -> str:
+        if self._worker_directory is None:
+            worker_directory = os.path.join(self.spill_directory, f"worker-{uuid.uuid4().hex}")
+            os.makedirs(worker_directory, exist_ok=True)
+            self._worker_lock = open(os.path.join(worker_directory, ".lock"), "w")
+            if fcntl:
+                ## held until the worker exits, the lock tells the other workers this directory is in use
+                fcntl.flock(self._worker_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._worker_directory = worker_directory
+        return self._worker_directory
+
+    def _new_spill_file(self, user_id: str) -> str:
+        return os.path.join(self._get_worker_directory(), f"{get_user_key(user_id)}-{uuid.uuid4()}.jsonl")
+
+    async def _append_to_journal(self, user_id: str, item: dict):
+        try:
+            journal = self._journals.get(user_id) or self._new_spill_file(user_id)
+            await asyncio.to_thread(self._append_line, journal, json.dumps(item))
+            self._journals[user_id] = journal
+        except OSError:
+            logging.exception("Unable to journal a chat history write, it is only readable from this worker until it is written")
+
+    @staticmethod
+    def _append_line(journal: str, line: str):
+        with open(journal, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def _spill(self, user_id: str, items: Dict[str, dict], spill_files: List[str]) -> List[str]:
+        """Keep the items of a failed batch in a single file. Returns the files it replaces."""
+        ## keep the items readable even when they could not be written to disk
+        self._spilled.setdefault(user_id, {}).update(items)
+
+        try:
+            spill_file = self._new_spill_file(user_id)
+            with open(spill_file, "w", encoding="utf-8") as f:
+                for item in items.values():
+                    f.write(json.dumps(item) + "\n")
+        except OSError:
+            logging.exception("Unable to spill chat history writes to disk")
+            self._spill_files.setdefault(user_id, []).extend(spill_files)
+            return []
+
+        self._spill_files.setdefault(user_id, []).append(spill_file)
+        return spill_files
+
+    def _reject(self, user_id: str, items: List[dict]):
+        """Keep the items Cosmos rejected on disk for inspection, they are not replayed."""
+        try:
+            os.makedirs(self.rejected_directory, exist_ok=True)
+            rejected_file = os.path.join(self.rejected_directory, f"{get_user_key(user_id)}-{uuid.uuid4()}.jsonl")
+            with open(rejected_file, "w", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item) + "\n")
+            logging.error(f"Moved {len(items)} chat history writes rejected by CosmosDB to {rejected_file}")
+        except OSError:
+            logging.exception(f"Unable to keep chat history writes rejected by CosmosDB: {json.dumps(items)}")
+
+    def _adopt_orphaned_files(self):
+        """Move the files of workers that exited, and of versions that shared a single
+        directory, into the directory of this worker so they are replayed once."""
+        worker_directory = self._get_worker_directory()
+        for entry in os.scandir(self.spill_directory):
+            if entry.is_file() and entry.name.endswith(".jsonl"):
+                self._adopt_file(entry.path, worker_directory)
+            elif entry.is_dir() and entry.path not in (worker_directory, self.rejected_directory):
+                lock_path = os.path.join(entry.path, ".lock")
+                try:
+                    with open(lock_path, "a") as lock:
+                        if fcntl:
+                            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        for file_name in os.listdir(entry.path):
+                            if file_name.endswith(".jsonl"):
+                                self._adopt_file(os.path.join(entry.path, file_name), worker_directory)
+                    os.remove(lock_path)
+                    os.rmdir(entry.path)
+                except BlockingIOError:
+                    ## the worker is still running
+                    continue
+                except FileNotFoundError:
+                    ## another worker took it over first
+                    continue
+                except OSError:
+                    logging.exception(f"Unable to take over the chat history spill files in {entry.path}")
+
+    def _adopt_file(self, spill_file: str, worker_directory: str):
+        try:
+            os.rename(spill_file, os.path.join(worker_directory, os.path.basename(spill_file)))
+        except FileNotFoundError:
+            ## another worker took it first
+            pass
+
+    def _read_other_workers(self, user_id: str) -> List[dict]:
+        try:
+            directories = [
+                entry.path for entry in os.scandir(self.spill_directory)
+                if entry.is_dir() and entry.path not in (self._worker_directory, self.rejected_directory)
+            ]
+        except OSError:
+            return []
+
+        prefix = f"{get_user_key(user_id)}-"
+        spill_files = []
+        for directory in directories:
+            try:
+                for entry in os.scandir(directory):
+                    if entry.name.startswith(prefix) and entry.name.endswith(".jsonl"):
+                        stat = entry.stat()
+                        spill_files.append(((stat.st_mtime_ns, stat.st_size), entry.path))
+            except OSError:
+                ## written and removed by its worker in the meantime
+                continue
+
+        items = []
+        for version, spill_file in sorted(spill_files):
+            ## only read the files that were appended to since the last read
+            cached = self._other_worker_files.get(spill_file)
+            if cached and cached[0] == version:
+                items.extend(cached[1])
+                continue
+            try:
+                file_items = self._read_spill_file(spill_file)
+            except OSError:
+                continue
+            self._other_worker_files[spill_file] = (version, file_items)
+            items.extend(file_items)
+
+        ## forget the files their workers removed once the items were written
+        current_files = {spill_file for _, spill_file in spill_files}
+        for spill_file in list(self._other_worker_files):
+            if os.path.basename(spill_file).startswith(prefix) and spill_file not in current_files:
+                self._other_worker_files.pop(spill_file, None)
+
+        return [item for item in items if item.get('userId') == user_id]
+
+    def _read_spill_file(self, spill_file: str) -> List[dict]:
+        items = []
+        with open(spill_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    ## the last line of a journal that is being appended to, or of a worker that crashed
+                    continue
+        return items
+
+    def _load_spill_files(self):
+        worker_directory = self._get_worker_directory()
+        for file_name in sorted(os.listdir(worker_directory)):
+            if not file_name.endswith(".jsonl"):
+                continue
+
+            spill_file = os.path.join(worker_directory, file_name)
+            try:
+                items = self._read_spill_file(spill_file)
+            except OSError:
+                logging.exception(f"Unable to read chat history spill file {spill_file}")
+                continue
+
+            for item in items:
+                self._spilled.setdefault(item['userId'], {})[item['id']] = item
+                user_files = self._spill_files.setdefault(item['userId'], [])
+                if spill_file not in user_files:
+                    user_files.append(spill_file)
+
+    def _remove_spill_files(self, spill_files: List[str]):
+        for spill_file in spill_files:
+            ## a file can hold items for several users, only remove it once all of them are flushed
+            if any(spill_file in files for files in self._spill_files.values()):
+                continue
+            try:
+                os.remove(spill_file)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.exception(f"Unable to remove chat history spill file {spill_file}")
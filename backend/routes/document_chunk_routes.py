@@ -1,13 +1,31 @@
 import uuid
+import logging
 
 from typing import List
-from quart import (Blueprint, jsonify, request)
+from quart import (Blueprint, current_app, jsonify, request)
 from azure.storage.blob import BlobServiceClient, BlobClient
 from pathlib import Path
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.context.document_status_context import DocumentStatusContext
 from backend.context.document_chunk_context import DocumentChunkContext
+from backend.storage.streaming_upload import IncompleteUploadError, StreamingBlockUploader, UploadTooLargeError, iter_multipart
+
+# allowance for the multipart boundaries, part headers and form fields around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+def format_upload_response(document_status: dict) -> dict:
+    return {
+        'message': 'File uploaded successfully', 
+        'isUploaded': True,
+        'document_status': {
+            'id': document_status['id'],
+            'conversation_id': document_status['conversation_id'],
+            'file_name': document_status['file_name'],
+            'status': document_status['status']
+        }
+    }
 
 class DocumentChunkRoutes:
     def __init__(
@@ -15,74 +33,141 @@ class DocumentChunkRoutes:
         upload_container_client: BlobServiceClient,
         document_chunk_context: DocumentChunkContext,
         document_status_context: DocumentStatusContext,
-        valid_extensions: List[str]
+        valid_extensions: List[str],
+        max_file_size: int = 100 * 1024 * 1024,
+        block_size: int = 4 * 1024 * 1024,
+        max_concurrency: int = 4
     ):
         self.blueprint = Blueprint('document_chunks', __name__)
         self._upload_container_client = upload_container_client
         self.document_chunk_context = document_chunk_context
         self.document_status_context = document_status_context
         self.valid_extensions = valid_extensions
+        self.max_file_size = max_file_size
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
         self.register_routes()
 
+    async def clone_document(self, user_id: str, source_document_id: str, document_status: dict, replace_chunks: bool = False):
+        try:
+            if replace_chunks:
+                ## the chunks of the previous version of the file are swapped for the copied ones
+                await self.document_chunk_context.delete_document_chunks(user_id, document_status['id'])
+            await self.document_chunk_context.clone_document_chunks(
+                user_id,
+                source_document_id,
+                document_status['id'],
+                document_status['conversation_id'],
+                document_status['file_name']
+            )
+            await self.document_status_context.update_document_status(user_id, document_status['id'], 'Indexed')
+        except Exception:
+            logging.exception(f"Failed to reuse the chunks of document {source_document_id} for {document_status['id']}")
+            await self.document_status_context.update_document_status(user_id, document_status['id'], 'Failed')
+
     def register_routes(self):
         @self.blueprint.route('/upload', methods=['POST'])
         async def upload_file():
-            data = await request.files
-            form = await request.form
-            conversation_id = form.get('conversationId')
+            boundary = request.mimetype_params.get('boundary')
+            if request.mimetype != 'multipart/form-data' or not boundary:
+                return jsonify({'error': 'Expected a multipart/form-data request'}), 400
 
-            if not conversation_id:
-                return jsonify({'error': 'conversationId is required'}), 400
-            
-            if 'file' not in data:
-                return jsonify({'error': 'No file part'}), 400
-            
-            file = data['file']
+            if request.content_length is not None and request.content_length > self.max_file_size + MULTIPART_OVERHEAD:
+                return jsonify({'message': f'File exceeds the maximum upload size of {self.max_file_size} bytes', 'isUploaded': False}), 413
 
-            if file.filename == '':
-                return jsonify({'error': 'No selected file'})
-            
-            if file:
-                extension = Path(file.filename).suffix
-
-                if extension not in self.valid_extensions:
-                    return jsonify({'error': 'Invalid file extension'})
-                
-                authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-                user_principal_id = authenticated_user["user_principal_id"]
-                user_name = authenticated_user["user_name"]
+            authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+            user_principal_id = authenticated_user["user_principal_id"]
+            user_name = authenticated_user["user_name"]
+
+            ## the body is streamed straight into staged blocks, so conversationId has to be sent before the file
+            conversation_id = None
+            file_name = None
+            uploader = None
+            receiving_file = False
+            try:
+                async for event, value in iter_multipart(request.body, boundary):
+                    if event == 'field':
+                        receiving_file = False
+                        name, field_value = value
+                        if name == 'conversationId':
+                            conversation_id = field_value
+                    elif event == 'file':
+                        name, filename = value
+                        receiving_file = False
+                        if name != 'file' or uploader:
+                            continue
+
+                        if not conversation_id:
+                            return jsonify({'error': 'conversationId is required'}), 400
+
+                        if not filename:
+                            return jsonify({'error': 'No selected file'})
+
+                        if Path(filename).suffix not in self.valid_extensions:
+                            return jsonify({'error': 'Invalid file extension'})
+
+                        file_name = filename
+                        blob_client = self._upload_container_client.get_blob_client(f"{conversation_id}/{file_name}")
+                        uploader = StreamingBlockUploader(blob_client, self.block_size, self.max_concurrency, self.max_file_size)
+                        receiving_file = True
+                    elif event == 'data' and receiving_file:
+                        await uploader.write(value)
+
+                if not conversation_id:
+                    return jsonify({'error': 'conversationId is required'}), 400
+
+                if not uploader:
+                    return jsonify({'error': 'No file part'}), 400
+
+                ## a new version of a file keeps its document id, so ingestion only rewrites the chunks that changed
+                previous = await self.document_status_context.get_document_by_file_name(user_principal_id, conversation_id, file_name)
+                document_id = previous['id'] if previous else None
+                if previous and previous.get('content_hash') == uploader.content_hash and previous.get('status') == 'Indexed':
+                    await uploader.abort()
+                    return jsonify(format_upload_response(previous)), 200
+                if previous:
+                    self.document_chunk_context.evict_cached_vectors(user_principal_id, document_id)
+
+                duplicate = await self.document_status_context.get_indexed_document_by_content_hash(user_principal_id, uploader.content_hash)
+                if duplicate and duplicate['id'] != document_id:
+                    ## same content was already indexed for this user, reuse its chunks instead of running the ingestion again
+                    await uploader.abort()
+                    document_status = await self.document_status_context.create_document_status(
+                        user_principal_id, conversation_id, file_name, content_hash=uploader.content_hash, status='Indexing', document_id=document_id
+                    )
+                    current_app.add_background_task(self.clone_document, user_principal_id, duplicate['id'], document_status, previous is not None)
+                    return jsonify(format_upload_response(document_status)), 200
+
+                document_status = await self.document_status_context.create_document_status(
+                    user_principal_id, conversation_id, file_name, content_hash=uploader.content_hash, document_id=document_id
+                )
                 metadata = {
                     'author': user_name,
                     'user_principal_id': user_principal_id,
                     'conversation_id': conversation_id,
-                    'master_document_id': str(uuid.uuid4())
+                    'master_document_id': document_status['id'],
+                    'content_hash': uploader.content_hash
                 }
 
-                try:
-                    document_status = await self.document_status_context.create_document_status(user_principal_id, conversation_id, file.filename)
-                    blob_client = self._upload_container_client.get_blob_client(f"{conversation_id}/{file.filename}")
-                    metadata = {
-                        'author': user_name,
-                        'user_principal_id': user_principal_id,
-                        'conversation_id': conversation_id,
-                        'master_document_id': document_status['id']
-                    }
-
-                    await blob_client.upload_blob(file, metadata=metadata, overwrite=True)
-                    
-                    return jsonify({
-                        'message': 'File uploaded successfully', 
-                        'isUploaded': True,
-                        'document_status': {
-                            'id': document_status['id'],
-                            'conversation_id': document_status['conversation_id'],
-                            'file_name': document_status['file_name'],
-                            'status': document_status['status']
-                        }
-                        }), 200
-                
-                except Exception as e:
-                    return jsonify({'message': str(e), 'isUploaded': False}), 500
+                await uploader.commit(metadata=metadata)
+
+                return jsonify(format_upload_response(document_status)), 200
+
+            except (UploadTooLargeError, RequestEntityTooLarge) as e:
+                if uploader:
+                    await uploader.abort()
+                return jsonify({'message': str(e), 'isUploaded': False}), 413
+
+            except IncompleteUploadError as e:
+                ## the staged blocks of a truncated file are never committed
+                if uploader:
+                    await uploader.abort()
+                return jsonify({'message': str(e), 'isUploaded': False}), 400
+
+            except Exception as e:
+                if uploader:
+                    await uploader.abort()
+                return jsonify({'message': str(e), 'isUploaded': False}), 500
 
         @self.blueprint.route('/document/delete', methods=["DELETE"])
         async def delete_document():
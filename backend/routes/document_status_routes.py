@@ -1,11 +1,21 @@
-from quart import (Blueprint, jsonify, request)
+import json
+import asyncio
+from quart import (Blueprint, jsonify, make_response, request)
 from backend.auth.auth_utils import get_authenticated_user_details
 from backend.context.document_status_context import DocumentStatusContext
+from backend.context.document_status_feed import DocumentStatusFeed
+
+# proxies tend to drop idle connections, so send a comment line now and then
+KEEPALIVE_INTERVAL = 15
+
+def format_as_server_sent_event(documents: list) -> str:
+    return f"data: {json.dumps(documents)}\n\n"
 
 class DocumentStatusRoutes:
-    def __init__(self, document_status_context: DocumentStatusContext):
+    def __init__(self, document_status_context: DocumentStatusContext, document_status_feed: DocumentStatusFeed = None):
         self.blueprint = Blueprint('document_status', __name__)
         self.document_status_context = document_status_context
+        self.document_status_feed = document_status_feed
         self.register_routes()
 
     def register_routes(self):
@@ -23,4 +33,44 @@ class DocumentStatusRoutes:
                 return jsonify({"error": f"No documents are uploaded for {user_id}"}), 404
 
             ## return the documents
-            return jsonify(documents), 200
\ No newline at end of file
+            return jsonify(documents), 200
+
+        @self.blueprint.route("/documents/statuses/stream", methods=["GET"])
+        async def stream_document_statuses():
+            if not self.document_status_feed:
+                return jsonify({"error": "Document status streaming is not enabled"}), 404
+
+            authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+            user_id = authenticated_user["user_principal_id"]
+            document_ids = [id for id in request.args.get("documentIds", "").split(",") if id]
+
+            ## subscribe before reading the current statuses so no transition falls in between
+            queue = self.document_status_feed.subscribe(user_id)
+
+            async def send_events():
+                try:
+                    if document_ids:
+                        documents = await self.document_status_context.get_documents_statuses(user_id, document_ids)
+                        yield format_as_server_sent_event(documents)
+
+                    while True:
+                        try:
+                            document = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                        except asyncio.TimeoutError:
+                            yield ": keep-alive\n\n"
+                            continue
+
+                        documents = [document]
+                        while not queue.empty():
+                            documents.append(queue.get_nowait())
+                        yield format_as_server_sent_event(documents)
+                finally:
+                    self.document_status_feed.unsubscribe(user_id, queue)
+
+            response = await make_response(send_events(), 200, {
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no"
+            })
+            response.timeout = None
+            return response
@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+import tempfile
 from abc import ABC, abstractmethod
 from pydantic import (
     BaseModel,
@@ -65,6 +66,16 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    enable_write_behind: bool = False
+    write_behind_flush_interval: float = 0.5
+    write_behind_max_retries: int = 5
+    write_behind_spill_directory: Optional[str] = None
+    enable_server_side_persistence: bool = False
+    enable_message_buckets: bool = False
+    message_bucket_max_messages: int = 100
+    message_bucket_max_kb: int = 512
+    archive_container: Optional[str] = None
+    archive_after_days: int = 90
 
 class _DocumentUploadSettings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -82,6 +93,19 @@ class _DocumentUploadSettings(BaseSettings):
     enable_feedback: bool = False
     valid_extensions: Optional[List[str]]
     minimum_similarity_score: float
+    max_file_size_mb: int = 100
+    block_size_mb: int = 4
+    max_concurrency: int = 4
+    enable_status_stream: bool = False
+    status_stream_poll_interval: float = 1.0
+    enable_local_vector_search: bool = False
+    local_vector_search_max_chunks: int = 2000
+    local_vector_search_cache_mb: int = 256
+    local_vector_search_ttl_seconds: int = 600
+    vector_index_container: Optional[str] = None
+    vector_index_directory: str = os.path.join(tempfile.gettempdir(), "vector-indexes")
+    vector_index_refresh_seconds: int = 60
+    legacy_chunks_migration_pending: bool = True
 
     @field_validator('valid_extensions', mode="before")
     @classmethod
@@ -0,0 +1,147 @@
+import base64
+import asyncio
+import hashlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from azure.storage.blob.aio import BlobClient
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+class IncompleteUploadError(Exception):
+    pass
+
+
+class StreamingBlockUploader():
+    """Upload a stream to a block blob without holding the whole file in memory.
+
+    Incoming bytes are cut into blocks of `block_size` that are staged in the
+    background, with at most `max_concurrency` blocks in flight. `write` waits
+    for a free slot before it accepts more data, so memory stays bounded by
+    roughly `block_size * (max_concurrency + 1)`. The SHA-256 of the content
+    is computed while the data passes through.
+    """
+
+    def __init__(self, blob_client: BlobClient, block_size: int, max_concurrency: int, max_size: int):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.max_size = max_size
+        self.size = 0
+
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._block_ids: List[str] = []
+        self._tasks: List[asyncio.Task] = []
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def content_hash(self) -> str:
+        return self._hash.hexdigest()
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadTooLargeError(f"File exceeds the maximum upload size of {self.max_size} bytes")
+
+        self._hash.update(data)
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            await self._stage(block)
+
+    async def commit(self, metadata: Optional[Dict[str, str]] = None):
+        if self._buffer:
+            await self._stage(bytes(self._buffer))
+            self._buffer.clear()
+
+        await asyncio.gather(*self._tasks)
+        return await self.blob_client.commit_block_list(self._block_ids, metadata=metadata)
+
+    async def abort(self):
+        ## staged blocks that are never committed are discarded by the storage service
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _stage(self, block: bytes):
+        ## block ids of a blob must all have the same length
+        block_id = base64.b64encode(f"{len(self._block_ids):08d}".encode()).decode()
+        self._block_ids.append(block_id)
+
+        await self._semaphore.acquire()
+        self._tasks.append(asyncio.create_task(self._stage_block(block_id, block)))
+
+        ## surface a failed block right away instead of at commit time
+        for task in self._tasks:
+            if task.done() and task.exception():
+                raise task.exception()
+
+    async def _stage_block(self, block_id: str, block: bytes):
+        try:
+            await self.blob_client.stage_block(block_id, block, length=len(block))
+        finally:
+            self._semaphore.release()
+
+
+async def _until_end(body: AsyncIterator[bytes]) -> AsyncIterator[Optional[bytes]]:
+    async for chunk in body:
+        yield chunk
+    ## None tells the decoder the body has ended
+    yield None
+
+
+async def iter_multipart(body: AsyncIterator[bytes], boundary: str) -> AsyncIterator[Tuple[str, object]]:
+    """Parse a multipart/form-data body as it arrives.
+
+    Yields ("field", (name, value)) for regular form fields once they are
+    complete, ("file", (name, filename)) when a file part starts and
+    ("data", bytes) for each piece of that file's content. Raises
+    IncompleteUploadError when the body ends before its closing boundary,
+    so a truncated file is never committed.
+    """
+    decoder = MultipartDecoder(boundary.encode())
+    field_name = None
+    field_value = bytearray()
+    in_file = False
+    more_data = False
+
+    async for chunk in _until_end(body):
+        decoder.receive_data(chunk)
+        event = _next_event(decoder)
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                in_file = True
+                yield "file", (event.name, event.filename)
+            elif isinstance(event, Field):
+                in_file = False
+                field_name = event.name
+                field_value.clear()
+            elif isinstance(event, Data):
+                more_data = event.more_data
+                if in_file:
+                    if event.data:
+                        yield "data", event.data
+                else:
+                    field_value.extend(event.data)
+                    if not event.more_data:
+                        yield "field", (field_name, field_value.decode('utf-8'))
+            elif isinstance(event, Epilogue):
+                if more_data:
+                    raise IncompleteUploadError("The last part of the upload ended before its data")
+                return
+
+            event = _next_event(decoder)
+
+    raise IncompleteUploadError("The upload ended before its closing boundary")
+
+
+def _next_event(decoder: MultipartDecoder):
+    try:
+        return decoder.next_event()
+    except ValueError as e:
+        ## the decoder can't parse past the point where a truncated body ended
+        raise IncompleteUploadError("The upload ended before its closing boundary") from e
@@ -4,13 +4,21 @@ Azure Storage Blob file and directory reader.
 A loader that fetches a file or iterates through a directory from Azure Storage Blob.
 
 """
+import inspect
+import io
 import logging
 import math
 import os
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import tempfile
+import threading
 import time
-from typing import Any, Dict, List, Optional, Union
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import pypdf
+
+from fsspec.implementations.memory import MemoryFileSystem
 
 from azure.storage.blob import BlobClient
 from azure.storage.blob._models import BlobProperties
@@ -25,8 +33,30 @@ from llama_index.core.readers.base import (
     ResourcesReaderMixin,
 )
 
+from IngestionTelemetry import ingestion_stage
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_IN_MEMORY_MAX_SIZE = 32 * 1024 * 1024
+
+# the default readers are created once per host instead of once per blob
+_default_readers: Dict[str, BaseReader] = {}
+_default_readers_lock = threading.Lock()
+
+def _get_default_reader(file_suffix: str) -> Optional[BaseReader]:
+    with _default_readers_lock:
+        if file_suffix not in _default_readers:
+            reader_cls = SimpleDirectoryReader.supported_suffix_fn().get(file_suffix)
+            if reader_cls is None:
+                return None
+            _default_readers[file_suffix] = reader_cls()
+        return _default_readers[file_suffix]
+
+def _supports_fs(reader: Optional[BaseReader]) -> bool:
+    # without a reader the file is read as text through the file system
+    return reader is None or "fs" in inspect.signature(reader.load_data).parameters
+
 class AzStorageBlobReader(
     BasePydanticReader, ResourcesReaderMixin, FileSystemReaderMixin
 ):
@@ -35,6 +65,10 @@ class AzStorageBlobReader(
 
     Args:
         blob_client (BlobClient): The Azure Storage Blob client.
+        max_concurrency (int): Number of parallel range requests used to download the blob.
+        in_memory_max_size (int): Blobs up to this size are parsed from memory when their
+            reader can read from a file system or they are PDFs read page by page, larger
+            ones go through a temporary file.
         file_extractor (Optional[Dict[str, Union[str, BaseReader]]]): A mapping of file
             extension to a BaseReader class that specifies how to convert that file
             to text. See `SimpleDirectoryReader` for more details, or call this path ```llama_index.readers.file.base.DEFAULT_FILE_READER_CLS```.
@@ -46,6 +80,8 @@ class AzStorageBlobReader(
     )
     is_remote: bool = True
     blob_properties: BlobProperties
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    in_memory_max_size: int = DEFAULT_IN_MEMORY_MAX_SIZE
 
     def __init__(self, blob_client, **kwargs: Any):
         blob_properties = blob_client.get_blob_properties()
@@ -61,27 +97,6 @@ class AzStorageBlobReader(
     def _sanitize_file_name(self, prop: str) -> str:
         return prop.replace("/", "-")
     
-    def _download_blob_and_extract_metadata(self, temp_dir: str) -> Dict[str, Any]:
-        """Download blob from Azure Storage and extract metadata."""
-        blob_meta = {}
-
-        sanitized_file_name = self._sanitize_file_name(self.blob_properties.name)
-
-        download_file_path = os.path.join(temp_dir, sanitized_file_name)
-        logger.info(f"Start download of {sanitized_file_name}")
-        start_time = time.time()
-        stream = self.blob_client.download_blob()
-        with open(file=download_file_path, mode="wb") as download_file:
-            stream.readinto(download_file)
-
-        blob_meta[sanitized_file_name] = self._extract_blob_metadata(self.blob_properties)
-        end_time = time.time()
-        logger.debug(
-            f"{sanitized_file_name} downloaded in {end_time - start_time} seconds."
-        )
-
-        return blob_meta
-
     def _extract_blob_metadata(self, file_metadata: Dict[str, Any]) -> Dict[str, Any]:
         meta: dict = file_metadata
 
@@ -111,26 +126,53 @@ class AzStorageBlobReader(
 
         return extracted_meta
 
-    def _load_documents_with_metadata(
-        self, files_metadata: Dict[str, Any], temp_dir: str
-    ) -> List[Document]:
-        """Load documents from a directory and extract metadata."""
+    def _get_reader(self, file_suffix: str) -> Optional[BaseReader]:
+        if self.file_extractor and file_suffix in self.file_extractor:
+            return self.file_extractor[file_suffix]
+        return _get_default_reader(file_suffix)
+
+    def _load_blob(self, file_name: str) -> List[Document]:
+        """Download the blob with parallel range requests and parse it."""
+        file_name = self._sanitize_file_name(file_name)
+        file_suffix = Path(file_name).suffix.lower()
+        reader = self._get_reader(file_suffix)
+        file_extractor = {file_suffix: reader} if reader else {}
+        metadata = self._extract_blob_metadata(self.blob_properties)
 
-        def get_metadata(file_name: str) -> Dict[str, Any]:
-            file_name = file_name.split("\\")[-1]
-            file_name = file_name.split("/")[-1]
-            file_name = self._sanitize_file_name(file_name)
+        logger.info(f"Start download of {file_name}")
+        start_time = time.time()
 
-            return files_metadata.get(file_name, {})
+        if self.blob_properties.size <= self.in_memory_max_size and _supports_fs(reader):
+            # small blobs never touch the disk, the reader gets the bytes through an in memory file system
+            fs = MemoryFileSystem()
+            input_file = PurePosixPath(f"/{uuid.uuid4()}/{file_name}")
+            with ingestion_stage("download") as counts:
+                stream = self.blob_client.download_blob(max_concurrency=self.max_concurrency)
+                fs.pipe_file(str(input_file), stream.readall())
+                counts["bytes"] = self.blob_properties.size
+            logger.debug(f"{file_name} downloaded in {time.time() - start_time} seconds.")
+            try:
+                return self._parse(input_file, metadata, file_extractor, fs=fs)
+            finally:
+                fs.rm(str(input_file.parent), recursive=True)
 
-        loader = SimpleDirectoryReader(
-            temp_dir, 
-            file_extractor=self.file_extractor, 
-            input_files=[os.path.join(temp_dir, self.blob_properties.name)], 
-            file_metadata=get_metadata,
-        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_file = Path(temp_dir) / file_name
+            with ingestion_stage("download") as counts:
+                stream = self.blob_client.download_blob(max_concurrency=self.max_concurrency)
+                with open(file=input_file, mode="wb") as download_file:
+                    stream.readinto(download_file)
+                counts["bytes"] = self.blob_properties.size
+            logger.debug(f"{file_name} downloaded in {time.time() - start_time} seconds.")
 
-        return loader.load_data()
+            return self._parse(input_file, metadata, file_extractor)
+
+    def _parse(self, input_file: Union[Path, PurePosixPath], metadata: Dict[str, Any], file_extractor: Dict[str, BaseReader], **kwargs: Any) -> List[Document]:
+        with ingestion_stage("parse") as counts:
+            documents = SimpleDirectoryReader.load_file(input_file, lambda _: metadata, file_extractor, **kwargs)
+            counts["pages"] = len(documents)
+            counts["characters"] = sum(len(document.text) for document in documents)
+        return documents
 
     def list_resources(self, *args: Any, **kwargs: Any) -> List[str]:
         """There's only one blob, so return it."""
@@ -151,16 +193,7 @@ class AzStorageBlobReader(
 
     def load_resource(self, resource_id: str, **kwargs: Any) -> List[Document]:
         try:
-            stream = self.blob_client.download_blob()
-            with tempfile.TemporaryDirectory() as temp_dir:
-                download_file_path = os.path.join(
-                    temp_dir, resource_id.replace("/", "-")
-                )
-                with open(file=download_file_path, mode="wb") as download_file:
-                    stream.readinto(download_file)
-                return self._load_documents_with_metadata(
-                    {resource_id: self.blob_properties}, temp_dir
-                )
+            return self._load_blob(resource_id)
         except Exception as e:
             logger.error(
                 f"Error loading resource {resource_id} from AzStorageBlob: {e}"
@@ -169,27 +202,63 @@ class AzStorageBlobReader(
 
     def read_file_content(self, input_file: Path, **kwargs) -> bytes:
         """Read the content of a file from Azure Storage Blob."""
-        stream = self.blob_client.download_blob()
+        stream = self.blob_client.download_blob(max_concurrency=self.max_concurrency)
         return stream.readall()
 
-    def load_data(self) -> List[Document]:
-        """Load file(s) from Azure Storage Blob."""
-        total_download_start_time = time.time()
+    def _lazy_load_pdf(self, file_name: str) -> Iterator[Document]:
+        """Download a PDF and parse it one page at a time, like the default PDFReader does
+        for the whole file, so only the page being read is held in memory."""
+        metadata = self._extract_blob_metadata(self.blob_properties)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            files_metadata = self._download_blob_and_extract_metadata(temp_dir)
+        if self.blob_properties.size <= self.in_memory_max_size:
+            # like in _load_blob, small blobs never touch the disk
+            with ingestion_stage("download") as counts:
+                stream = self.blob_client.download_blob(max_concurrency=self.max_concurrency)
+                pdf_file = io.BytesIO(stream.readall())
+                counts["bytes"] = self.blob_properties.size
+            yield from self._read_pdf_pages(pdf_file, file_name, metadata)
+            return
 
-            total_download_end_time = time.time()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_file = Path(temp_dir) / file_name
+            with ingestion_stage("download") as counts:
+                stream = self.blob_client.download_blob(max_concurrency=self.max_concurrency)
+                with open(file=input_file, mode="wb") as download_file:
+                    stream.readinto(download_file)
+                counts["bytes"] = self.blob_properties.size
+
+            with open(input_file, "rb") as pdf_file:
+                yield from self._read_pdf_pages(pdf_file, file_name, metadata)
+
+    def _read_pdf_pages(self, pdf_file: io.IOBase, file_name: str, metadata: Dict[str, Any]) -> Iterator[Document]:
+        pdf = pypdf.PdfReader(pdf_file)
+        for page in range(len(pdf.pages)):
+            with ingestion_stage("parse") as counts:
+                page_text = pdf.pages[page].extract_text()
+                counts["pages"] = 1
+                counts["characters"] = len(page_text)
+            yield Document(text=page_text, metadata={"page_label": pdf.page_labels[page], "file_name": file_name, **metadata})
+
+    def lazy_load_data(self) -> Iterator[Document]:
+        """Load the blob as a stream of documents. PDFs read by the default
+        reader are parsed page by page, other files are parsed whole."""
+        file_name = self._sanitize_file_name(self.blob_properties.name)
+        file_suffix = Path(file_name).suffix.lower()
+        if file_suffix == ".pdf" and not (self.file_extractor and file_suffix in self.file_extractor):
+            yield from self._lazy_load_pdf(file_name)
+        else:
+            yield from self._load_blob(self.blob_properties.name)
 
-            total_elapsed_time = math.ceil(
-                total_download_end_time - total_download_start_time
-            )
+    def load_data(self) -> List[Document]:
+        """Load file(s) from Azure Storage Blob."""
+        total_download_start_time = time.time()
 
-            logger.info(
-                f"Downloading completed in approximately {total_elapsed_time // 60}min"
-                f" {total_elapsed_time % 60}s."
-            )
+        documents = self._load_blob(self.blob_properties.name)
 
-            logger.info("Document creation starting")
+        total_elapsed_time = math.ceil(time.time() - total_download_start_time)
+        logger.info(
+            f"Download and document creation completed in approximately {total_elapsed_time // 60}min"
+            f" {total_elapsed_time % 60}s."
+        )
 
-            return self._load_documents_with_metadata(files_metadata, temp_dir)
\ No newline at end of file
+        return documents
@@ -1,9 +1,13 @@
+import asyncio
+import json
 import logging
-from typing import Any, Optional, Dict, cast, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Dict, Tuple, cast, List
 from datetime import date
 
 from azure.identity import ClientSecretCredential
-from azure.cosmos import CosmosClient
+from azure.cosmos import CosmosClient, exceptions
 from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.schema import BaseNode, MetadataMode
 from llama_index.core.vector_stores.types import (
@@ -19,6 +23,11 @@ from llama_index.core.vector_stores.utils import (
 logger = logging.getLogger(__name__)
 USER_AGENT = ("LlamaIndex-CDBNoSql-VectorStore-Python",)
 
+# limits of a transactional batch, the payload limit is 2 MB including the request envelope
+MAX_BATCH_OPERATIONS = 100
+MAX_BATCH_BYTES = 1_800_000
+MAX_THROTTLE_RETRIES = 5
+
 
 class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
     """Azure CosmosDB NoSQL vCore Vector Store.
@@ -45,6 +54,13 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
     _id_key: Any = PrivateAttr()
     _text_key: Any = PrivateAttr()
     _metadata_key: Any = PrivateAttr()
+    _partition_key_key: Any = PrivateAttr()
+    _partition_key_metadata_key: Any = PrivateAttr()
+    _partition_key_path: Any = PrivateAttr()
+    _async_cosmos_client: Any = PrivateAttr()
+    _async_container: Any = PrivateAttr()
+    _bulk_batch_size: Any = PrivateAttr()
+    _bulk_max_concurrency: Any = PrivateAttr()
 
     def __init__(
         self,
@@ -59,6 +75,10 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
         id_key: str = "id",
         text_key: str = "text",
         metadata_key: str = "metadata",
+        partition_key_metadata_key: str = "user_principal_id",
+        async_cosmos_client: Any = None,
+        bulk_batch_size: int = MAX_BATCH_OPERATIONS,
+        bulk_max_concurrency: int = 4,
         **kwargs: Any,
     ) -> None:
         """Initialize the vector store.
@@ -72,6 +92,12 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
             indexing_policy: Indexing Policy for the container.
             cosmos_container_properties: Container Properties for the container.
             cosmos_database_properties: Database Properties for the container.
+            partition_key_metadata_key: Node metadata field whose value is written to the
+                container's partition key path, so that every chunk of a user shares a partition.
+            async_cosmos_client: Optional azure.cosmos.aio client for async_add, aquery and adelete,
+                without it those run the synchronous methods in a worker thread.
+            bulk_batch_size: Maximum number of upserts per transactional batch.
+            bulk_max_concurrency: Number of batches written in parallel.
         """
         super().__init__()
 
@@ -111,9 +137,28 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
         self._id_key = id_key
         self._text_key = text_key
         self._metadata_key = metadata_key
+        # only a top level partition key has to be written explicitly, nested paths such as
+        # /metadata/user_principal_id are already covered by the node metadata
+        partition_key_path = self._cosmos_container_properties["partition_key"]["paths"][0].strip("/").split("/")
+        self._partition_key_key = partition_key_path[0] if len(partition_key_path) == 1 else None
+        self._partition_key_path = partition_key_path
+        self._partition_key_metadata_key = partition_key_metadata_key
         self._embedding_key = self._vector_embedding_policy["vectorEmbeddings"][0][
             "path"
         ][1:]
+        self._bulk_batch_size = min(bulk_batch_size, MAX_BATCH_OPERATIONS)
+        self._bulk_max_concurrency = bulk_max_concurrency
+        self._async_cosmos_client = async_cosmos_client
+        self._async_container = None
+        if async_cosmos_client is not None:
+            self._async_container = async_cosmos_client.get_database_client(database_name).get_container_client(container_name)
+
+        if not create_container:
+            # the database and container are provisioned ahead of time, getting the proxies
+            # doesn't make any request so no management plane call is made per instance
+            self._database = self._cosmos_client.get_database_client(self._database_name)
+            self._container = self._database.get_container_client(self._container_name)
+            return
 
         self._database = self._cosmos_client.create_database_if_not_exists(
             id=self._database_name,
@@ -261,6 +306,9 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
     ) -> List[str]:
         """Add nodes to index.
 
+        The nodes are written in transactional batches per partition key,
+        with up to `bulk_max_concurrency` batches in flight.
+
         Args:
             nodes: List[BaseNode]: list of nodes with embeddings
 
@@ -268,35 +316,177 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
             A List of ids for successfully added nodes.
 
         """
-        ids = []
-        data_to_insert = []
+        ids, batches = self._prepare_batches(nodes)
+        self._run_batches([(partition_key, [("upsert", (item,)) for item in items]) for partition_key, items in batches])
+
+        return ids
+
+    async def async_add(
+        self,
+        nodes: List[BaseNode],
+        **add_kwargs: Any,
+    ) -> List[str]:
+        """Asynchronously add nodes to index, see add."""
+        if self._async_container is None:
+            return await asyncio.to_thread(self.add, nodes, **add_kwargs)
+
+        ids, batches = self._prepare_batches(nodes)
+        await self._arun_batches([(partition_key, [("upsert", (item,)) for item in items]) for partition_key, items in batches])
 
+        return ids
+
+    def _to_entry(self, node: BaseNode) -> Dict[str, Any]:
+        node_dict = node.dict()
+        metadata: Dict[str, Any] = node_dict.get("metadata", {})
+
+        metadata["document_id"] = node.ref_doc_id or "None"
+        metadata["doc_id"] = node.ref_doc_id or "None"
+        metadata["ref_doc_id"] = node.ref_doc_id or "None"
+
+        entry = {
+            self._id_key: node.node_id,
+            self._embedding_key: node.get_embedding(),
+            self._text_key: node.get_content(metadata_mode=MetadataMode.NONE) or "",
+            self._metadata_key: metadata,
+            "timeStamp": date.today().isoformat(),
+        }
+        if self._partition_key_key:
+            entry[self._partition_key_key] = metadata.get(self._partition_key_metadata_key)
+
+        return entry
+
+    def _get_partition_key_value(self, entry: Dict[str, Any]) -> Any:
+        value: Any = entry
+        for key in self._partition_key_path:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    def _prepare_batches(self, nodes: List[BaseNode]) -> Tuple[List[str], List[Tuple[Any, List[Dict[str, Any]]]]]:
         if not nodes:
             raise Exception("Texts can not be null or empty")
 
+        ids = []
+        partitions: Dict[Any, List[Dict[str, Any]]] = {}
         for node in nodes:
-            node_dict = node.dict()
-            metadata: Dict[str, Any] = node_dict.get("metadata", {})
-
-            metadata["document_id"] = node.ref_doc_id or "None"
-            metadata["doc_id"] = node.ref_doc_id or "None"
-            metadata["ref_doc_id"] = node.ref_doc_id or "None"
-
-            entry = {
-                self._id_key: node.node_id,
-                self._embedding_key: node.get_embedding(),
-                self._text_key: node.get_content(metadata_mode=MetadataMode.NONE) or "",
-                self._metadata_key: metadata,
-                "timeStamp": date.today().isoformat(),
-            }
-            
-            data_to_insert.append(entry)
+            entry = self._to_entry(node)
+            partitions.setdefault(self._get_partition_key_value(entry), []).append(entry)
             ids.append(node.node_id)
 
-        for item in data_to_insert:
-            self._container.upsert_item(item)
+        # a transactional batch is scoped to one partition and limited in operations and size
+        batches = []
+        for partition_key, entries in partitions.items():
+            batch: List[Dict[str, Any]] = []
+            batch_bytes = 0
+            for entry in entries:
+                entry_bytes = len(json.dumps(entry))
+                if batch and (len(batch) >= self._bulk_batch_size or batch_bytes + entry_bytes > MAX_BATCH_BYTES):
+                    batches.append((partition_key, batch))
+                    batch, batch_bytes = [], 0
+                batch.append(entry)
+                batch_bytes += entry_bytes
+            batches.append((partition_key, batch))
+
+        return ids, batches
+
+    @staticmethod
+    def _get_retry_after(error: exceptions.CosmosHttpResponseError) -> Optional[float]:
+        """Seconds to wait before retrying a throttled batch, None when the error is not a throttle."""
+        if error.status_code != 429:
+            return None
+        headers = error.response.headers if error.response is not None else {}
+        return int(headers.get("x-ms-retry-after-ms", 1000)) / 1000
+
+    def _run_batches(self, batches: List[Tuple[Any, List[Tuple[str, Tuple]]]]):
+        with ThreadPoolExecutor(max_workers=self._bulk_max_concurrency) as executor:
+            # list() surfaces the first failed batch
+            list(executor.map(lambda batch: self._execute_batch(*batch), batches))
+
+    async def _arun_batches(self, batches: List[Tuple[Any, List[Tuple[str, Tuple]]]]):
+        semaphore = asyncio.Semaphore(self._bulk_max_concurrency)
+
+        async def execute(partition_key: Any, operations: List[Tuple[str, Tuple]]):
+            async with semaphore:
+                await self._aexecute_batch(partition_key, operations)
+
+        await asyncio.gather(*[execute(*batch) for batch in batches])
+
+    def _execute_batch(self, partition_key: Any, operations: List[Tuple[str, Tuple]]):
+        # a transactional batch either applies every operation or none, so after a throttle
+        # only this batch is sent again, the batches that succeeded are left alone
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            try:
+                self._container.execute_item_batch(batch_operations=operations, partition_key=partition_key)
+                return
+            except exceptions.CosmosHttpResponseError as e:
+                retry_after = self._get_retry_after(e)
+                if retry_after is None or attempt == MAX_THROTTLE_RETRIES:
+                    raise
+                logger.warning(f"Batch of {len(operations)} operations throttled, retrying in {retry_after} seconds")
+                time.sleep(retry_after)
+
+    async def _aexecute_batch(self, partition_key: Any, operations: List[Tuple[str, Tuple]]):
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            try:
+                await self._async_container.execute_item_batch(batch_operations=operations, partition_key=partition_key)
+                return
+            except exceptions.CosmosHttpResponseError as e:
+                retry_after = self._get_retry_after(e)
+                if retry_after is None or attempt == MAX_THROTTLE_RETRIES:
+                    raise
+                logger.warning(f"Batch of {len(operations)} operations throttled, retrying in {retry_after} seconds")
+                await asyncio.sleep(retry_after)
+
+    def _delete_batches(self, items: List[Dict[str, Any]]) -> List[Tuple[Any, List[Tuple[str, Tuple]]]]:
+        partitions: Dict[Any, List[str]] = {}
+        for item in items:
+            partitions.setdefault(item["partitionKey"], []).append(item["id"])
+
+        return [
+            (partition_key, [("delete", (node_id,)) for node_id in node_ids[start:start + self._bulk_batch_size]])
+            for partition_key, node_ids in partitions.items()
+            for start in range(0, len(node_ids), self._bulk_batch_size)
+        ]
+
+    def _ref_doc_query(self, ref_doc_id: str, **delete_kwargs: Any) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+        partition_key_expression = "c." + ".".join(self._partition_key_path)
+        query_text = f"SELECT c.id, {partition_key_expression} AS partitionKey FROM c WHERE c.{self._metadata_key}.ref_doc_id = @refDocId"
+        parameters = [{"name": "@refDocId", "value": ref_doc_id}]
+        partition_key = delete_kwargs.get("partition_key")
+        scope = {"partition_key": partition_key} if partition_key is not None else {"enable_cross_partition_query": True}
 
-        return ids
+        return query_text, parameters, scope
+
+    def get_node_ids(self, master_document_id: str, partition_key: Any) -> List[str]:
+        """Return the ids of the stored chunks of a document."""
+        query_text = f"SELECT VALUE c.id FROM c WHERE c.{self._metadata_key}.master_document_id = @masterDocumentId"
+        parameters = [{"name": "@masterDocumentId", "value": master_document_id}]
+
+        return list(self._container.query_items(query=query_text, parameters=parameters, partition_key=partition_key))
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Any = None, **delete_kwargs: Any) -> None:
+        """
+        Delete nodes by id.
+
+        Args:
+            node_ids: Ids of the nodes to delete.
+            partition_key: Optional partition of the nodes, their partitions are
+                looked up across partitions otherwise.
+
+        """
+        if filters is not None:
+            raise NotImplementedError("Deleting nodes by metadata filters is not supported")
+        if not node_ids:
+            return
+
+        partition_key = delete_kwargs.get("partition_key")
+        if partition_key is not None:
+            items = [{"id": node_id, "partitionKey": partition_key} for node_id in node_ids]
+        else:
+            partition_key_expression = "c." + ".".join(self._partition_key_path)
+            query_text = f"SELECT c.id, {partition_key_expression} AS partitionKey FROM c WHERE ARRAY_CONTAINS(@nodeIds, c.id)"
+            parameters = [{"name": "@nodeIds", "value": list(node_ids)}]
+            items = list(self._container.query_items(query=query_text, parameters=parameters, enable_cross_partition_query=True))
+        self._run_batches(self._delete_batches(items))
 
     def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
         """
@@ -304,16 +494,30 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
 
         Args:
             ref_doc_id (str): The doc_id of the document to delete.
+            partition_key: Optional partition of the nodes, they are looked up
+                across partitions otherwise.
 
         """
-        self._container.delete_item(ref_doc_id, partition_key=ref_doc_id)
+        query_text, parameters, scope = self._ref_doc_query(ref_doc_id, **delete_kwargs)
+        items = list(self._container.query_items(query=query_text, parameters=parameters, **scope))
+        self._run_batches(self._delete_batches(items))
+
+    async def adelete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Asynchronously delete nodes using with ref_doc_id, see delete."""
+        if self._async_container is None:
+            return await asyncio.to_thread(self.delete, ref_doc_id, **delete_kwargs)
+
+        query_text, parameters, scope = self._ref_doc_query(ref_doc_id, **delete_kwargs)
+        scope.pop("enable_cross_partition_query", None)
+        items = [item async for item in self._async_container.query_items(query=query_text, parameters=parameters, **scope)]
+        await self._arun_batches(self._delete_batches(items))
 
     @property
     def client(self) -> Any:
         """Return CosmosDB client."""
         return self._cosmos_client
 
-    def _query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+    def _build_query(self, query: VectorStoreQuery, **kwargs: Any) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
         params: Dict[str, Any] = {
             "vector": query.query_embedding,
             "path": self._embedding_key,
@@ -322,41 +526,47 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
 
         pre_filter = kwargs.get("pre_filter", {})
 
-        query = "SELECT "
+        query_text = "SELECT "
 
         # If limit_offset_clause is not specified, add TOP clause
         if pre_filter is None or pre_filter.get("limit_offset_clause") is None:
-            query += "TOP @limit "
+            query_text += "TOP @limit "
 
-        query += (
+        query_text += (
             "c.id, c.{}, c.text, c.metadata, "
             "VectorDistance(c.@embeddingKey, @embeddings) AS SimilarityScore FROM c"
         )
 
         # Add where_clause if specified
         if pre_filter is not None and pre_filter.get("where_clause") is not None:
-            query += " {}".format(pre_filter["where_clause"])
+            query_text += " {}".format(pre_filter["where_clause"])
 
-        query += " ORDER BY VectorDistance(c.@embeddingKey, @embeddings)"
+        query_text += " ORDER BY VectorDistance(c.@embeddingKey, @embeddings)"
 
         # Add limit_offset_clause if specified
         if pre_filter is not None and pre_filter.get("limit_offset_clause") is not None:
-            query += " {}".format(pre_filter["limit_offset_clause"])
+            query_text += " {}".format(pre_filter["limit_offset_clause"])
         parameters = [
             {"name": "@limit", "value": params["k"]},
             {"name": "@embeddingKey", "value": self._embedding_key},
             {"name": "@embeddings", "value": params["vector"]},
         ]
 
+        # scope the query to a single partition when the caller knows it
+        partition_key = kwargs.get("partition_key")
+        if partition_key is not None:
+            scope = {"partition_key": partition_key}
+        else:
+            scope = {"enable_cross_partition_query": True}
+
+        return query_text, parameters, scope
+
+    def _to_query_result(self, items: List[Dict[str, Any]]) -> VectorStoreQueryResult:
         top_k_nodes = []
         top_k_ids = []
         top_k_scores = []
 
-        for item in self._container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True,
-        ):
+        for item in items:
             node = metadata_dict_to_node(item[self._metadata_key])
             node.set_content(item[self._text_key])
 
@@ -371,6 +581,24 @@ class AzureCosmosDBNoSqlVectorSearch(BasePydanticVectorStore):
             nodes=top_k_nodes, similarities=top_k_scores, ids=top_k_ids
         )
 
+    def _query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        query_text, parameters, scope = self._build_query(query, **kwargs)
+        items = list(self._container.query_items(query=query_text, parameters=parameters, **scope))
+
+        return self._to_query_result(items)
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Asynchronously query index for top k most similar nodes, see query."""
+        if self._async_container is None:
+            return await asyncio.to_thread(self._query, query, **kwargs)
+
+        query_text, parameters, scope = self._build_query(query, **kwargs)
+        # the async client scopes queries without a partition key across partitions on its own
+        scope.pop("enable_cross_partition_query", None)
+        items = [item async for item in self._async_container.query_items(query=query_text, parameters=parameters, **scope)]
+
+        return self._to_query_result(items)
+
     def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
         """Query index for top k most similar nodes.
 
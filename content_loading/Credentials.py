@@ -6,24 +6,28 @@ from Settings import ContentLoadingSettings, CosmosSettings, OpenAISettings, Sto
 class ContentLoadingCredentials():
     def __init__(self, settings: ContentLoadingSettings):
         self.settings = settings
+        # one credential caches the tokens for every service instead of each fetching its own
+        default_credential = None
+        if not (settings.cosmos.key and settings.openai.apiKey and settings.storage.key and settings.pii.apiKey):
+            default_credential = DefaultAzureCredential()
 
         if (settings.cosmos.key):
             self.cosmos_credential = settings.cosmos.key
         else:
-            self.cosmos_credential = DefaultAzureCredential()
+            self.cosmos_credential = default_credential
 
         if (settings.openai.apiKey):
             self.openai_credential = settings.openai.apiKey
         else:
-            self.openai_credential = DefaultAzureCredential()
+            self.openai_credential = default_credential
             self.openai_token_provider = get_bearer_token_provider(self.openai_credential, "https://cognitiveservices.azure.com/.default")
 
         if (settings.storage.key):
             self.storage_credential = settings.storage.key
         else:
-            self.storage_credential = DefaultAzureCredential()
+            self.storage_credential = default_credential
 
         if (settings.pii.apiKey):
             self.pii_credential = AzureKeyCredential(settings.pii.apiKey)
         else:
-            self.pii_credential = DefaultAzureCredential()
\ No newline at end of file
+            self.pii_credential = default_credential
\ No newline at end of file
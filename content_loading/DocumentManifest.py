@@ -0,0 +1,101 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+# Manifests list the documents of a user, and of a conversation, in one item of
+# the status container so they are read with a point read instead of a query.
+# This module is their single definition, backend/context/document_manifest.py
+# imports it, so it must not depend on anything outside the standard library.
+#
+# Only the user manifest is read for statuses, the conversation manifest is read
+# for the ids of its documents. Status transitions therefore only update the user
+# manifest, and progress is always read from the status documents.
+DOCUMENT_MANIFEST_TYPE = 'document_manifest'
+MANIFEST_FIELDS = ('id', 'file_name', 'conversation_id', 'status', 'createdAt', 'content_hash')
+# statuses whose progress changes, their entries are read from the status documents
+IN_PROGRESS_STATUSES = ('Uploaded', 'Indexing')
+# keeps a manifest far below the 2 MB item limit, a full manifest is marked
+# incomplete and the documents of its user or conversation are queried instead
+MAX_MANIFEST_DOCUMENTS = 2000
+
+# status documents share the container with the manifests
+EXCLUDE_MANIFESTS = f"(NOT IS_DEFINED(c.type) OR c.type != '{DOCUMENT_MANIFEST_TYPE}')"
+COMPLETE_MANIFEST = "(NOT IS_DEFINED(c.complete) OR c.complete = true)"
+
+
+def get_user_manifest_id(user_id: str) -> str:
+    return f"manifest-user-{user_id}"
+
+
+def get_conversation_manifest_id(conversation_id: str) -> str:
+    return f"manifest-conversation-{conversation_id}"
+
+
+def get_manifest_ids(user_id: str, conversation_id: Optional[str]) -> List[Tuple[str, Optional[str]]]:
+    """The manifests listing a document, as (manifest id, conversation id of the manifest)."""
+    manifest_ids = [(get_user_manifest_id(user_id), None)]
+    if conversation_id:
+        manifest_ids.append((get_conversation_manifest_id(conversation_id), conversation_id))
+    return manifest_ids
+
+
+def get_manifest_documents_query(conversation_id: Optional[str] = None) -> str:
+    """Query for the status documents a manifest is seeded with, parameters @userId and @conversation_id."""
+    query = f"SELECT * FROM c WHERE c.user_principal_id = @userId AND {EXCLUDE_MANIFESTS}"
+    if conversation_id:
+        query += " AND c.conversation_id = @conversation_id"
+    return query
+
+
+def create_manifest_entry(document_status: Dict[str, Any]) -> Dict[str, Any]:
+    return { key: document_status.get(key) for key in MANIFEST_FIELDS }
+
+
+def create_manifest(manifest_id: str, user_id: str, documents: List[Dict[str, Any]], conversation_id: Optional[str] = None) -> Dict[str, Any]:
+    complete = len(documents) <= MAX_MANIFEST_DOCUMENTS
+    manifest = {
+        'id': manifest_id,
+        'type': DOCUMENT_MANIFEST_TYPE,
+        'user_principal_id': user_id,
+        'complete': complete,
+        'documentCount': len(documents) if complete else 0,
+        'documents': { document['id']: create_manifest_entry(document) for document in documents } if complete else {}
+    }
+    if conversation_id:
+        manifest['conversation_id'] = conversation_id
+
+    return manifest
+
+
+def is_manifest_complete(manifest: Dict[str, Any]) -> bool:
+    return manifest.get('complete', True)
+
+
+def list_manifest_documents(manifest: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return sorted(manifest.get('documents', {}).values(), key=lambda document: document.get('createdAt') or '')
+
+
+def get_add_operations(entry: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], str]:
+    """Patch operations and filter predicate adding a document, the filter rejects the patch once the manifest is full."""
+    patch_operations = [
+        { 'op': 'set', 'path': f"/documents/{entry['id']}", 'value': entry },
+        { 'op': 'incr', 'path': '/documentCount', 'value': 1 }
+    ]
+    return patch_operations, f"FROM c WHERE {COMPLETE_MANIFEST} AND (NOT IS_DEFINED(c.documentCount) OR c.documentCount < {MAX_MANIFEST_DOCUMENTS})"
+
+
+def get_update_operations(entry: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], str]:
+    """Patch operations and filter predicate replacing the entry of a document, an incomplete manifest is left as is."""
+    return [{ 'op': 'set', 'path': f"/documents/{entry['id']}", 'value': entry }], f"FROM c WHERE {COMPLETE_MANIFEST}"
+
+
+def get_remove_operations(document_id: str) -> List[Dict[str, Any]]:
+    return [
+        { 'op': 'remove', 'path': f"/documents/{document_id}" },
+        { 'op': 'incr', 'path': '/documentCount', 'value': -1 }
+    ]
+
+
+# readers ignore an incomplete manifest, so its entries are dropped
+INCOMPLETE_OPERATIONS = [
+    { 'op': 'set', 'path': '/complete', 'value': False },
+    { 'op': 'set', 'path': '/documents', 'value': {} }
+]
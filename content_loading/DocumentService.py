@@ -1,27 +1,143 @@
-from typing import List
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from azure.cosmos import ContainerProxy
+from azure.cosmos import ContainerProxy, exceptions
 from llama_index.core.schema import Document
 
+from DocumentManifest import create_manifest, create_manifest_entry, get_manifest_documents_query, get_update_operations, get_user_manifest_id
+
 class DocumentService:
     def __init__(self, container_proxy: ContainerProxy):
         self.__container_proxy = container_proxy
 
-    def update_documents_status(self, documents: List[Document], status: str):
+    def update_documents_status(self, documents: List[Document], status: str, ingestion: Optional[Dict[str, Any]] = None):
         master_documents = list({ (document.metadata['master_document_id'], document.metadata['user_principal_id']): document for document in documents }.values())
         
         for document in master_documents:
-            self.update_document_status(document, status)
+            self.update_document_status(document, status, ingestion)
 
-    def update_document_status(self, document: Document, status: str):
+    def update_document_status(self, document: Document, status: str, ingestion: Optional[Dict[str, Any]] = None):
         document_id: str = document.metadata['master_document_id']
         user_id: str = document.metadata['user_principal_id']
         patch_operations = [
             { 'op': 'replace', 'path': '/status', 'value': status }
         ]
+        # the stage timings of IngestionTelemetry, written with the final status in the same patch
+        if ingestion:
+            patch_operations.append({ 'op': 'set', 'path': '/ingestion', 'value': ingestion })
 
-        self.__container_proxy.patch_item(
+        document_status = self.__container_proxy.patch_item(
             item=document_id,
             partition_key=user_id,
             patch_operations=patch_operations
-        )
\ No newline at end of file
+        )
+        self.update_manifest(document_status)
+
+    def update_documents_progress(self, documents: List[Document], progress: Dict[str, int]):
+        master_documents = list({ (document.metadata['master_document_id'], document.metadata['user_principal_id']): document for document in documents }.values())
+
+        for document in master_documents:
+            document_id: str = document.metadata['master_document_id']
+            user_id: str = document.metadata['user_principal_id']
+            self.__container_proxy.patch_item(
+                item=document_id,
+                partition_key=user_id,
+                patch_operations=[{ 'op': 'set', 'path': '/progress', 'value': progress }]
+            )
+
+    def update_manifest(self, document_status: Dict[str, Any]):
+        # status transitions only update the user manifest, see DocumentManifest.py
+        user_id: str = document_status['user_principal_id']
+        manifest_id = get_user_manifest_id(user_id)
+        patch_operations, filter_predicate = get_update_operations(create_manifest_entry(document_status))
+        while True:
+            try:
+                self.__container_proxy.patch_item(
+                    item=manifest_id,
+                    partition_key=user_id,
+                    patch_operations=patch_operations,
+                    filter_predicate=filter_predicate
+                )
+                return
+            except exceptions.CosmosAccessConditionFailedError:
+                # an incomplete manifest is not read
+                return
+            except exceptions.CosmosResourceNotFoundError:
+                logging.warning(f"Document manifest {manifest_id} not found, seeding it")
+
+            if self.seed_manifest(user_id, manifest_id):
+                return
+
+    def seed_manifest(self, user_id: str, manifest_id: str) -> bool:
+        """Create the user manifest from the status documents, False when it was created concurrently."""
+        documents = list(self.__container_proxy.query_items(
+            get_manifest_documents_query(),
+            parameters=[{ 'name': '@userId', 'value': user_id }],
+            partition_key=user_id
+        ))
+        try:
+            self.__container_proxy.create_item(create_manifest(manifest_id, user_id, documents))
+            return True
+        except exceptions.CosmosResourceExistsError:
+            return False
+
+# progress patches are written in the background, in the order they were made, so the
+# embedding batches that report progress never wait on Cosmos
+_progress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress")
+
+class ProgressReporter:
+    """Reports the chunks embedded out of the total on the status of the documents being indexed.
+
+    Updates are coalesced, only the latest count is written and at most once
+    every `interval` seconds, by a background thread. `flush` writes the final
+    count and waits for it. When a document is indexed as a stream the total
+    grows as its pages are read.
+    """
+
+    def __init__(self, document_service: DocumentService, documents: List[Document], total: int, interval: float = 2.0, clock: Callable[[], float] = time.monotonic):
+        self.__document_service = document_service
+        self.documents = documents
+        self.total = total
+        self.interval = interval
+        self.completed = 0
+        self._clock = clock
+        self._written: Optional[Tuple[int, int]] = None
+        self._written_at = -math.inf
+        self._pending: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def advance(self, count: int):
+        with self._lock:
+            self.completed += count
+            if self._clock() - self._written_at >= self.interval:
+                self._write()
+
+    def add_total(self, count: int):
+        with self._lock:
+            self.total += count
+
+    def flush(self):
+        with self._lock:
+            if self._written != (self.completed, self.total):
+                self._write()
+            pending = self._pending
+
+        if pending is not None:
+            pending.result()
+
+    def _write(self):
+        # called with the lock held, the executor runs the patches in the order they are submitted
+        self._written_at = self._clock()
+        self._written = (self.completed, self.total)
+        self._pending = _progress_executor.submit(self._update, list(self.documents), { 'embeddedChunks': self.completed, 'totalChunks': self.total })
+
+    def _update(self, documents: List[Document], progress: Dict[str, int]):
+        # progress is informational, a failed patch is followed by the next one
+        try:
+            self.__document_service.update_documents_progress(documents, progress)
+        except Exception as e:
+            logging.warning(f"Error reporting indexing progress: {e}")
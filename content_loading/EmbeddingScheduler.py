@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, List, Mapping, Optional, Sequence
+
+from llama_index.core.schema import BaseNode, MetadataMode
+from openai import APIConnectionError, AsyncAzureOpenAI, InternalServerError, RateLimitError
+
+MAX_RETRIES = 5
+# connection errors, timeouts and 5xx responses back off only the batch that failed
+TRANSIENT_RETRY_DELAY = 1.0
+MAX_TRANSIENT_RETRY_DELAY = 30.0
+
+
+def estimate_tokens(text: str) -> int:
+    # about four characters per token for English text with the cl100k encodings
+    return max(1, len(text) // 4)
+
+
+class TokenBucket():
+    """Token bucket shared by every invocation on a host.
+
+    The bucket can be used from several threads, each with its own event loop,
+    so it is guarded by a thread lock and waiting happens outside of it. When
+    the capacity is unknown the bucket lets everything through until the rate
+    limit headers of a response fill it in.
+    """
+
+    def __init__(self, per_minute: Optional[int] = None, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.capacity = float(per_minute) if per_minute else None
+        self.configured = self.capacity is not None
+        self.tokens = self.capacity or 0.0
+        self._updated_at = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.capacity / 60)
+        self._updated_at = now
+
+    def try_acquire(self, amount: float) -> float:
+        """Take `amount` tokens, or return the seconds to wait before trying again."""
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._refill(now)
+            if self.capacity is None:
+                return 0.0
+
+            ## a request larger than the bucket would never fit, let it through once the bucket is full
+            amount = min(amount, self.capacity)
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+
+            return (amount - self.tokens) * 60 / self.capacity
+
+    async def acquire(self, amount: float):
+        while (wait := self.try_acquire(amount)) > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, remaining: Optional[float], limit: Optional[float] = None):
+        with self._lock:
+            self._refill(self._clock())
+            if limit:
+                self.capacity = float(limit)
+            elif remaining is not None and not self.configured and remaining > (self.capacity or 0):
+                ## without a limit header the largest remaining count seen is the best guess for it
+                self.capacity = float(remaining)
+                self.tokens = float(remaining)
+            if remaining is not None and self.capacity is not None:
+                ## the service also counts the requests of other clients of the deployment
+                self.tokens = min(self.tokens, float(remaining))
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self.tokens = 0.0
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def get_retry_after(headers: Mapping[str, str], default: float = 10.0) -> float:
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_number(headers, "retry-after") or default
+
+
+def get_backoff(attempt: int) -> float:
+    return min(MAX_TRANSIENT_RETRY_DELAY, TRANSIENT_RETRY_DELAY * 2 ** attempt)
+
+
+class EmbeddingScheduler():
+    """Embeds nodes in batches with bounded concurrency, paced by token buckets
+    for the tokens and requests per minute of the embedding deployment.
+
+    The buckets start from the configured limits and follow the
+    x-ratelimit-* headers of every response, a 429 pauses all batches for
+    the time the service asks for. Connection errors, timeouts and 5xx
+    responses are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], AsyncAzureOpenAI],
+        deployment_name: str,
+        batch_size: int = 16,
+        concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None
+    ):
+        self.client_factory = client_factory
+        self.deployment_name = deployment_name
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.request_bucket = TokenBucket(requests_per_minute)
+
+    def embed_nodes(self, nodes: Sequence[BaseNode], on_progress: Optional[Callable[[int], None]] = None):
+        asyncio.run(self.aembed_nodes(nodes, on_progress))
+
+    async def aembed_nodes(self, nodes: Sequence[BaseNode], on_progress: Optional[Callable[[int], None]] = None):
+        pending = [node for node in nodes if node.embedding is None]
+        batches = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        ## the client is bound to the event loop of this call, the buckets are shared between calls
+        async with self.client_factory() as client:
+            async def embed_batch(batch: List[BaseNode]):
+                async with semaphore:
+                    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+                    embeddings = await self.embed_texts(client, texts)
+                    for node, embedding in zip(batch, embeddings):
+                        node.embedding = embedding
+                    if on_progress:
+                        on_progress(len(batch))
+
+            await asyncio.gather(*[embed_batch(batch) for batch in batches])
+
+    async def embed_texts(self, client: AsyncAzureOpenAI, texts: List[str]) -> List[List[float]]:
+        tokens = sum(estimate_tokens(text) for text in texts)
+        for attempt in range(MAX_RETRIES + 1):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(tokens)
+            try:
+                response = await client.embeddings.with_raw_response.create(input=texts, model=self.deployment_name)
+            except RateLimitError as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                retry_after = get_retry_after(e.response.headers)
+                logging.warning(f"Embedding deployment is rate limited, retrying in {retry_after} seconds")
+                self.token_bucket.pause(retry_after)
+                self.request_bucket.pause(retry_after)
+                continue
+            except (APIConnectionError, InternalServerError) as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = get_backoff(attempt)
+                logging.warning(f"Embedding request failed with {e}, retrying in {delay} seconds")
+                await asyncio.sleep(delay)
+                continue
+
+            self.update_limits(response.headers)
+            return [item.embedding for item in sorted(response.parse().data, key=lambda item: item.index)]
+
+    def update_limits(self, headers: Mapping[str, str]):
+        self.token_bucket.update(
+            _header_number(headers, "x-ratelimit-remaining-tokens"),
+            _header_number(headers, "x-ratelimit-limit-tokens")
+        )
+        self.request_bucket.update(
+            _header_number(headers, "x-ratelimit-remaining-requests"),
+            _header_number(headers, "x-ratelimit-limit-requests")
+        )
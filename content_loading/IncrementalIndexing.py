@@ -0,0 +1,43 @@
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from llama_index.core.schema import BaseNode, MetadataMode
+
+# (master document id, chunk text) -> times the text was seen in the document so far
+ChunkOccurrences = Dict[Tuple[str, str], int]
+
+# keep in sync with backend/context/document_chunk_context.py
+def get_chunk_id(master_document_id: str, text: str, occurrence: int = 0) -> str:
+    return hashlib.sha256(f"{master_document_id}\n{occurrence}\n{text}".encode("utf-8")).hexdigest()
+
+
+def assign_chunk_ids(nodes: Iterable[BaseNode], occurrences: Optional[ChunkOccurrences] = None):
+    """Give every node an id derived from its document and its text, so an
+    unchanged chunk keeps its id when a new version of the file is indexed.
+    Repeated texts, such as page headers, are told apart by their occurrence.
+    Pass the same `occurrences` for every window of a document that is indexed as a stream.
+    """
+    occurrences = {} if occurrences is None else occurrences
+    for node in nodes:
+        master_document_id = node.metadata["master_document_id"]
+        text = node.get_content(metadata_mode=MetadataMode.NONE)
+        occurrence = occurrences.get((master_document_id, text), 0)
+        occurrences[(master_document_id, text)] = occurrence + 1
+        node.id_ = get_chunk_id(master_document_id, text, occurrence)
+
+
+def group_nodes_by_document(nodes: Iterable[BaseNode]) -> Dict[Tuple[str, str], List[BaseNode]]:
+    documents: Dict[Tuple[str, str], List[BaseNode]] = {}
+    for node in nodes:
+        key = (node.metadata["user_principal_id"], node.metadata["master_document_id"])
+        documents.setdefault(key, []).append(node)
+    return documents
+
+
+def diff_chunks(nodes: List[BaseNode], existing_ids: Set[str]) -> Tuple[List[BaseNode], List[str]]:
+    """Split the chunks of a new version into those that still have to be
+    embedded and written, and the ids of stored chunks that are gone."""
+    node_ids = {node.node_id for node in nodes}
+    new_nodes = [node for node in nodes if node.node_id not in existing_ids]
+    vanished_ids = [node_id for node_id in existing_ids if node_id not in node_ids]
+    return new_nodes, vanished_ids
@@ -0,0 +1,162 @@
+import argparse
+import base64
+import binascii
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import unquote, urlparse
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.queue import QueueClient, QueueMessage
+
+BLOB_CREATED_EVENT = "Microsoft.Storage.BlobCreated"
+# a message that failed this many times is moved to the poison queue, like the queue trigger does
+MAX_DEQUEUE_COUNT = 5
+# the most messages the queue service returns for one request
+MAX_MESSAGES_PER_REQUEST = 32
+
+def decode_message(content: str) -> Dict[str, Any]:
+    """Parse a queue message, Event Grid writes it as base64 encoded JSON."""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        pass
+
+    try:
+        return json.loads(base64.b64decode(content, validate=True))
+    except (binascii.Error, json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Queue message is not an event: {content[:100]}") from e
+
+def get_blob_path(event: Dict[str, Any]) -> Optional[str]:
+    """The `container/blob` path of a BlobCreated event in the Event Grid or the
+    CloudEvents schema, None for other events."""
+    if event.get("eventType", event.get("type")) != BLOB_CREATED_EVENT:
+        return None
+
+    # https://account.blob.core.windows.net/container/blob, or http://127.0.0.1:10000/account/container/blob on Azurite
+    path = unquote(urlparse(event["data"]["url"]).path).lstrip("/")
+    subject = event.get("subject", "")
+    if "/containers/" in subject:
+        container = subject.split("/containers/", 1)[1].split("/", 1)[0]
+        path = path[path.index(f"{container}/"):]
+    return path
+
+def get_message_blob_path(content: str) -> Optional[str]:
+    """The blob of a queue message, None when it is not a BlobCreated event."""
+    try:
+        return get_blob_path(decode_message(content))
+    except (ValueError, KeyError) as e:
+        logging.error(f"Ignoring queue message: {e}")
+        return None
+
+def process_blobs(blob_paths: List[str], process: Callable[[str], None], max_concurrency: int) -> Dict[str, Optional[Exception]]:
+    """Process the blobs with at most `max_concurrency` at a time. Returns the
+    exception each blob failed with, None for the ones that succeeded."""
+    def run(blob_path: str) -> Optional[Exception]:
+        try:
+            process(blob_path)
+            return None
+        except Exception as e:
+            logging.error(f"Error processing blob {blob_path}: {e}")
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        return dict(zip(blob_paths, executor.map(run, blob_paths)))
+
+def receive_messages(queue_client: QueueClient, max_messages: int, visibility_timeout: int) -> List[QueueMessage]:
+    if max_messages <= 0:
+        return []
+    return list(queue_client.receive_messages(
+        max_messages=max_messages,
+        messages_per_page=min(max_messages, MAX_MESSAGES_PER_REQUEST),
+        visibility_timeout=visibility_timeout
+    ))
+
+@contextmanager
+def keep_invisible(queue_client: QueueClient, messages: List[QueueMessage], visibility_timeout: int) -> Iterator[None]:
+    """Extend the visibility timeout of the received messages every half of it while
+    their blobs are processed, so a slow batch isn't handed to another invocation."""
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(visibility_timeout / 2):
+            for message in messages:
+                try:
+                    updated = queue_client.update_message(message, visibility_timeout=visibility_timeout)
+                    # the old pop receipt is no longer valid for deleting the message
+                    message.pop_receipt = updated.pop_receipt
+                    message.next_visible_on = updated.next_visible_on
+                except Exception as e:
+                    logging.warning(f"Could not extend the visibility of message {message.id}: {e}")
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    if messages:
+        renewer.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        if messages:
+            renewer.join()
+
+def is_last_attempt(dequeue_count: int) -> bool:
+    return dequeue_count >= MAX_DEQUEUE_COUNT
+
+def complete_message(queue_client: QueueClient, poison_queue_client: QueueClient, message: QueueMessage, error: Optional[Exception]):
+    """Delete a processed message. A failed one becomes visible again when its
+    visibility timeout ends, and is moved to the poison queue after the last attempt."""
+    if error is None:
+        queue_client.delete_message(message)
+        return
+
+    if is_last_attempt(message.dequeue_count):
+        logging.error(f"Moving message {message.id} to the poison queue after {message.dequeue_count} attempts")
+        try:
+            poison_queue_client.create_queue()
+        except ResourceExistsError:
+            pass
+        poison_queue_client.send_message(message.content)
+        queue_client.delete_message(message)
+
+def create_blob_created_event(account_url: str, container_name: str, blob_name: str) -> Dict[str, Any]:
+    """A BlobCreated event like the one Event Grid sends, for the storage emulator which has no Event Grid."""
+    return {
+        "eventType": BLOB_CREATED_EVENT,
+        "subject": f"/blobServices/default/containers/{container_name}/blobs/{blob_name}",
+        "data": { "url": f"{account_url.rstrip('/')}/{container_name}/{blob_name}" }
+    }
+
+if __name__ == "__main__":
+    from azure.storage.blob import BlobServiceClient
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Upload a file and enqueue its BlobCreated event, to run the queue trigger locally against Azurite",
+        epilog="Example: python IngestionQueue.py --connection-string UseDevelopmentStorage=true --queue ingestion --file report.pdf --metadata user_principal_id=00000000-0000-0000-0000-000000000000 master_document_id=1",
+    )
+    parser.add_argument("--connection-string", default="UseDevelopmentStorage=true")
+    parser.add_argument("--queue", required=True)
+    parser.add_argument("--container", default="documents")
+    parser.add_argument("--file", required=True)
+    parser.add_argument("--metadata", nargs="*", default=[], help="key=value pairs set on the blob, the pipeline reads the document ids from them.")
+    args = parser.parse_args()
+
+    blob_name = args.file.replace("\\", "/").split("/")[-1]
+    blob_service_client = BlobServiceClient.from_connection_string(args.connection_string)
+    container_client = blob_service_client.get_container_client(args.container)
+    if not container_client.exists():
+        container_client.create_container()
+    with open(args.file, "rb") as data:
+        container_client.upload_blob(blob_name, data, overwrite=True, metadata=dict(pair.split("=", 1) for pair in args.metadata))
+
+    queue_client = QueueClient.from_connection_string(args.connection_string, args.queue)
+    try:
+        queue_client.create_queue()
+    except ResourceExistsError:
+        pass
+    event = create_blob_created_event(blob_service_client.url, args.container, blob_name)
+    queue_client.send_message(base64.b64encode(json.dumps(event).encode("utf-8")).decode("utf-8"))
+    print(f"Enqueued {args.container}/{blob_name}")
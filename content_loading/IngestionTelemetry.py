@@ -0,0 +1,174 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from pathlib import PurePosixPath
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+STAGES = ["download", "parse", "pii", "chunk", "embed", "upsert"]
+
+_current: ContextVar[Optional["IngestionTelemetry"]] = ContextVar("ingestion_telemetry", default=None)
+
+# OpenTelemetry is optional, without it the timings only go to the status document and the log
+_instruments: Optional[Dict[str, Any]] = None
+_instruments_lock = threading.Lock()
+
+def _get_instruments() -> Dict[str, Any]:
+    global _instruments
+    with _instruments_lock:
+        if _instruments is None:
+            _instruments = {}
+            try:
+                from opentelemetry import metrics
+                if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+                    from azure.monitor.opentelemetry import configure_azure_monitor
+                    configure_azure_monitor()
+                meter = metrics.get_meter("content_loading.ingestion")
+                _instruments = {
+                    "seconds": meter.create_histogram("ingestion.stage.duration", unit="s", description="Time spent in an ingestion stage"),
+                    "bytes": meter.create_counter("ingestion.stage.bytes", unit="By"),
+                    "chunks": meter.create_counter("ingestion.stage.chunks"),
+                    "tokens": meter.create_counter("ingestion.stage.tokens"),
+                }
+            except ImportError:
+                logging.info("OpenTelemetry is not installed, ingestion metrics are only written to the document status")
+        return _instruments
+
+class IngestionTelemetry():
+    """Timings and counts of the stages of ingesting one blob.
+
+    A stage entered more than once, such as embedding the chunks of several
+    documents, accumulates its time and counts.
+    """
+
+    def __init__(self, blob_name: str, clock=time.perf_counter):
+        self.blob_name = blob_name
+        self.file_type = PurePosixPath(blob_name).suffix.lower() or "none"
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._clock = clock
+        self._started_at = clock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, float]]:
+        counts: Dict[str, float] = {}
+        start = self._clock()
+        try:
+            yield counts
+        finally:
+            recorded = self.stages.setdefault(name, {"seconds": 0.0})
+            recorded["seconds"] += self._clock() - start
+            for key, value in counts.items():
+                recorded[key] = recorded.get(key, 0) + value
+
+    def to_status(self) -> Dict[str, Any]:
+        return {
+            "fileType": self.file_type,
+            "totalSeconds": round(self._clock() - self._started_at, 3),
+            "stages": { name: { key: round(value, 3) for key, value in counts.items() } for name, counts in self.stages.items() },
+        }
+
+    def record_metrics(self):
+        status = self.to_status()
+        logging.info(f"Ingestion of {self.blob_name} took {status['totalSeconds']}s: {status['stages']}")
+
+        instruments = _get_instruments()
+        for name, counts in self.stages.items():
+            attributes = {"stage": name, "file_type": self.file_type}
+            for key, instrument in instruments.items():
+                if key not in counts:
+                    continue
+                if key == "seconds":
+                    instrument.record(counts[key], attributes)
+                else:
+                    instrument.add(counts[key], attributes)
+
+@contextmanager
+def track_ingestion(blob_name: str) -> Iterator[IngestionTelemetry]:
+    """Make the telemetry of a blob the current one for the stages run while ingesting it."""
+    telemetry = IngestionTelemetry(blob_name)
+    token = _current.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        _current.reset(token)
+
+def current_ingestion() -> Optional[IngestionTelemetry]:
+    return _current.get()
+
+@contextmanager
+def ingestion_stage(name: str) -> Iterator[Dict[str, float]]:
+    """Time a stage of the current ingestion, the caller adds its counts to the yielded dict.
+    Outside of an ingestion, such as in tests and scripts, nothing is recorded."""
+    telemetry = _current.get()
+    if telemetry is None:
+        yield {}
+        return
+
+    with telemetry.stage(name) as counts:
+        yield counts
+
+def _percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percentile * (len(ordered) - 1))))]
+
+def summarize(ingestions: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Aggregate the `ingestion` records of status documents per file type and stage."""
+    samples: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+    for ingestion in ingestions:
+        file_type = samples.setdefault(ingestion.get("fileType", "none"), {})
+        file_type.setdefault("total", {}).setdefault("seconds", []).append(ingestion.get("totalSeconds", 0.0))
+        for name, counts in (ingestion.get("stages") or {}).items():
+            for key, value in counts.items():
+                file_type.setdefault(name, {}).setdefault(key, []).append(value)
+
+    summary: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for file_type, stages in samples.items():
+        summary[file_type] = {}
+        for name, counts in stages.items():
+            seconds = counts.get("seconds", [])
+            stats = {
+                "count": len(seconds),
+                "p50Seconds": _percentile(seconds, 0.5) if seconds else 0.0,
+                "p95Seconds": _percentile(seconds, 0.95) if seconds else 0.0,
+            }
+            for key, values in counts.items():
+                if key != "seconds":
+                    stats[f"mean{key[0].upper()}{key[1:]}"] = sum(values) / len(values)
+            if "bytes" in counts and sum(seconds) > 0:
+                stats["mbPerSecond"] = sum(counts["bytes"]) / sum(seconds) / (1024 * 1024)
+            summary[file_type][name] = stats
+    return summary
+
+if __name__ == "__main__":
+    from azure.cosmos import CosmosClient
+    from Settings import ContentLoadingSettings
+    from Credentials import ContentLoadingCredentials
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Report the ingestion stage timings recorded on the document statuses, per file type",
+        epilog="Example: python IngestionTelemetry.py --days 7",
+    )
+    parser.add_argument("--days", type=int, default=7, help="Only include documents updated in this many days.")
+    args = parser.parse_args()
+
+    config = ContentLoadingSettings()
+    auth = ContentLoadingCredentials(config)
+    status_container = CosmosClient(config.cosmos.endpoint, auth.cosmos_credential).get_database_client(config.cosmos.database).get_container_client(config.cosmos.statusContainer)
+
+    since = int((datetime.now(timezone.utc) - timedelta(days=args.days)).timestamp())
+    ingestions = status_container.query_items(
+        query="SELECT VALUE c.ingestion FROM c WHERE IS_DEFINED(c.ingestion) AND c._ts >= @since",
+        parameters=[{"name": "@since", "value": since}],
+        enable_cross_partition_query=True
+    )
+
+    for file_type, stages in sorted(summarize(ingestions).items()):
+        print(file_type)
+        for name in ["total"] + STAGES:
+            if name in stages:
+                print(f"  {name:<9}" + "  ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in stages[name].items()))
@@ -1,4 +1,6 @@
-from typing import List, Optional
+import re
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
 from llama_index.core.schema import Document
 
 class PIIDetectedEntity:
@@ -14,4 +16,39 @@ class PIIDetectionError(Exception):
     def __init__(self, detected_entities: List[PIIDetectedEntity], document: Document, message: Optional[str] = None):
         super().__init__(message)
         self.detected_entities = detected_entities
-        self.document = document
\ No newline at end of file
+        self.document = document
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?\n])\s+")
+
+def segment_text(text: str, max_chars: int) -> List[str]:
+    """Split text into segments of at most `max_chars` characters, cutting on
+    sentence boundaries where possible and on whitespace otherwise."""
+    segments = []
+    current = ""
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                segments.append(current)
+                current = ""
+            segments.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            segments.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+
+    if current.strip():
+        segments.append(current)
+
+    return segments
+
+def batched(items: List, size: int) -> List[List]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def iter_windows(items: Iterable, size: int) -> Iterator[List]:
+    """Like `batched`, for a stream that is only read one window ahead."""
+    iterator = iter(items)
+    while window := list(islice(iterator, size)):
+        yield window
@@ -0,0 +1,108 @@
+import logging
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from llama_index.core.schema import Document
+
+# categories of the Language service and of Presidio that a pattern can find
+PATTERN_CATEGORIES: Dict[str, str] = {
+    "Email": "email",
+    "EMAIL_ADDRESS": "email",
+    "PhoneNumber": "phone",
+    "PHONE_NUMBER": "phone",
+    "CreditCardNumber": "card",
+    "CREDIT_CARD": "card",
+    "USSocialSecurityNumber": "ssn",
+    "US_SSN": "ssn",
+    "InternationalBankingAccountNumber": "iban",
+    "IBAN_CODE": "iban",
+}
+
+# The patterns err on the side of matching, a page is only cleared when none of them match
+PATTERNS: Dict[str, str] = {
+    "email": r"[\w.+-]+@[\w-]+\.[\w.-]+",
+    "card": r"(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)",
+    "ssn": r"(?<!\d)\d{3}[- ]?\d{2}[- ]?\d{4}(?!\d)",
+    "iban": r"\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]){11,30}\b",
+    "phone": r"(?<!\w)\+?(?:\(?\d{1,4}\)?[ .-]?){2,5}\d{2,4}(?!\w)",
+}
+
+def luhn_valid(number: str) -> bool:
+    digits = [int(d) for d in number if d.isdigit()]
+    checksum = 0
+    for position, digit in enumerate(reversed(digits)):
+        if position % 2 == 1:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        checksum += digit
+    return checksum % 10 == 0
+
+def iban_valid(iban: str) -> bool:
+    iban = iban.replace(" ", "")
+    rearranged = iban[4:] + iban[:4]
+    return int("".join(str(int(char, 36)) for char in rearranged)) % 97 == 1
+
+def ssn_valid(ssn: str) -> bool:
+    digits = "".join(d for d in ssn if d.isdigit())
+    area, group, serial = digits[:3], digits[3:5], digits[5:]
+    return area not in ("000", "666") and not area.startswith("9") and group != "00" and serial != "0000"
+
+VALIDATORS = {
+    "card": luhn_valid,
+    "iban": iban_valid,
+    "ssn": ssn_valid,
+    "phone": lambda phone: sum(d.isdigit() for d in phone) >= 7,
+}
+
+class PrefilterMetrics():
+    """Pages screened and cleared by the prefilter since the host started."""
+
+    def __init__(self):
+        self.pages_screened = 0
+        self.pages_cleared = 0
+        self._lock = threading.Lock()
+
+    def record(self, screened: int, cleared: int):
+        with self._lock:
+            self.pages_screened += screened
+            self.pages_cleared += cleared
+
+metrics = PrefilterMetrics()
+
+class PIIPrefilter():
+    """Cheap first tier of the PII screening.
+
+    Pages without a regex and checksum candidate for any configured category
+    are cleared without calling the PII detector. When a configured category
+    can only be found by NLP, such as Person or Address, every page is
+    escalated.
+    """
+
+    def __init__(self, pii_categories: Optional[List[str]]):
+        pattern_names = {PATTERN_CATEGORIES[category] for category in pii_categories or [] if category in PATTERN_CATEGORIES}
+        self.requires_nlp = not pii_categories or any(category not in PATTERN_CATEGORIES for category in pii_categories)
+        # each category is searched on its own, so a span rejected by the validator of one
+        # category, such as an invalid SSN, can still be a candidate of another, such as a phone number
+        self.patterns = [(name, re.compile(pattern)) for name, pattern in PATTERNS.items() if name in pattern_names]
+
+    def find_candidates(self, text: str) -> List[Tuple[str, str]]:
+        candidates = []
+        for name, pattern in self.patterns:
+            validator = VALIDATORS.get(name)
+            for match in pattern.finditer(text):
+                if validator is None or validator(match.group()):
+                    candidates.append((name, match.group()))
+        return candidates
+
+    def needs_escalation(self, text: str) -> bool:
+        return self.requires_nlp or bool(self.find_candidates(text))
+
+    def screen(self, documents: List[Document]) -> List[Document]:
+        """Return the documents that have to go through the PII detector."""
+        escalated = [doc for doc in documents if self.needs_escalation(doc.text)]
+
+        metrics.record(len(documents), len(documents) - len(escalated))
+        logging.info(f"PII prefilter cleared {len(documents) - len(escalated)} of {len(documents)} pages, {metrics.pages_cleared} of {metrics.pages_screened} since start")
+
+        return escalated
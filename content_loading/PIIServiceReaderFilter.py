@@ -1,23 +1,67 @@
-from azure.ai.textanalytics import TextAnalyticsClient, PiiEntity
+import asyncio
+import threading
+from azure.ai.textanalytics import PiiEntity
+from azure.ai.textanalytics.aio import TextAnalyticsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.identity.aio import DefaultAzureCredential
 from Credentials import ContentLoadingCredentials
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 from llama_index.core.schema import Document
 from llama_index.core.readers.base import BaseReader, BasePydanticReader
-from PIIDetection import PIIDetectionError, PIIDetectedEntity
+from PIIPrefilter import PIIPrefilter
+from IngestionTelemetry import ingestion_stage
+from PIIDetection import PIIDetectionError, PIIDetectedEntity, batched, iter_windows, segment_text
+
+# limits of the synchronous PII endpoint of the Language service
+MAX_DOCUMENT_CHARACTERS = 5120
+MAX_DOCUMENTS_PER_REQUEST = 5
+
+# The async client lives on a loop of its own for the lifetime of the host, so its
+# connections and tokens are reused by every blob instead of being set up per document
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_clients: Dict[str, TextAnalyticsClient] = {}
+_lock = threading.Lock()
+
+def _run(coroutine):
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="pii-detection", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+def _get_client(endpoint: str, credential: Any) -> TextAnalyticsClient:
+    # only called on the background loop
+    if endpoint not in _clients:
+        if not isinstance(credential, AzureKeyCredential):
+            credential = DefaultAzureCredential()
+        _clients[endpoint] = TextAnalyticsClient(endpoint=endpoint, credential=credential)
+    return _clients[endpoint]
 
 class PIIServiceReaderFilter(BasePydanticReader):
     """Filter for ensuring that documents containing PII are not indexed.
 
+    The text of the documents is cut into segments within the service's
+    character limit on sentence boundaries. Segments are sent in full
+    batches, with at most `max_concurrency` requests in flight, and no more
+    requests are sent once an entity above `min_confidence` is found.
+
     Args:
         reader (BaseReader): The reader to filter.
         min_confidence (float): The minimum confidence level for PII detection.
+        prefilter (PIIPrefilter): Optional pattern screening, only the pages it escalates are checked.
+        window_pages (int): The number of pages checked at a time when the data is loaded as a stream.
+        max_concurrency (int): The number of concurrent requests to the service.
     """
     reader: BaseReader
     endpoint: str
     pii_categories: Optional[List[str]] = None
     min_confidence: float = 0.8
+    prefilter: Optional[PIIPrefilter] = None
+    window_pages: int = 16
+    max_concurrency: int = 4
     credentials: ContentLoadingCredentials
-    
+
     def load_data(self) -> List[Document]:
         """Load the data from the reader and filter out any documents containing PII.
 
@@ -25,36 +69,70 @@ class PIIServiceReaderFilter(BasePydanticReader):
             List[Document]: The list of documents with PII removed.
         """
         documents = self.reader.load_data()
-        for doc in documents:
-            detected_pii_entities = self.__detect_pii(doc)
-            if detected_pii_entities:
-                raise PIIDetectionError(
-                    detected_entities=map(lambda entity: PIIDetectedEntity(category=entity.category, confidence_score=entity.confidence_score), detected_pii_entities), 
-                    document=doc, message=f"Document contains PII: {doc.text}")
-                        
+        self.__check_documents(documents)
         return documents
 
-    def __detect_pii(self, document: Document) -> List[PiiEntity]:
-        """Check if a document contains PII.
+    def lazy_load_data(self) -> Iterator[Document]:
+        """Load the data from the reader as a stream, checking `window_pages` pages at a time.
+        The pages of a window are only yielded once the whole window is checked."""
+        for window in iter_windows(self.reader.lazy_load_data(), self.window_pages):
+            self.__check_documents(window)
+            yield from window
+
+    def __check_documents(self, documents: List[Document]):
+        with ingestion_stage("pii") as counts:
+            escalated = self.prefilter.screen(documents) if self.prefilter else documents
+            detected = _run(self.__detect_pii(escalated))
+            counts["pages"] = len(documents)
+            counts["escalatedPages"] = len(escalated)
+        if detected:
+            doc, detected_pii_entities = detected
+            raise PIIDetectionError(
+                detected_entities=map(lambda entity: PIIDetectedEntity(category=entity.category, confidence_score=entity.confidence_score), detected_pii_entities),
+                document=doc, message=f"Document contains PII: {doc.text}")
+
+    async def __detect_pii(self, documents: List[Document]) -> Optional[Tuple[Document, List[PiiEntity]]]:
+        """Check if any of the documents contains PII.
 
         Args:
-            document (Document): The document to check.
+            documents (List[Document]): The documents to check.
 
         Returns:
-            bool: True if the document contains PII, False otherwise.
+            The first document found to contain PII with its entities, None otherwise.
         """
+        client = _get_client(self.endpoint, self.credentials.pii_credential)
+        segments = [(doc, segment) for doc in documents for segment in segment_text(doc.text, MAX_DOCUMENT_CHARACTERS)]
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        found = asyncio.Event()
+
+        async def detect_batch(batch: List[Tuple[Document, str]]):
+            async with semaphore:
+                if found.is_set():
+                    return None
+
+                response = await client.recognize_pii_entities(
+                    [segment for _, segment in batch], language="en", categories_filter=self.pii_categories
+                )
+                for (doc, _), result in zip(batch, response):
+                    if result.is_error:
+                        continue
 
-        client = TextAnalyticsClient(endpoint=self.endpoint, credential=self.credentials.pii_credential)
-        response = client.recognize_pii_entities([document.text], language="en", categories_filter=self.pii_categories)
-        
-        result = [doc for doc in response if not doc.is_error]
-        detected_pii = []
-        for doc in result:
-            for entity in doc.entities:
-                if entity.confidence_score > self.min_confidence:
-                    detected_pii.append(entity)
+                    entities = [entity for entity in result.entities if entity.confidence_score > self.min_confidence]
+                    if entities:
+                        found.set()
+                        return doc, entities
 
-        return detected_pii
-    
+                return None
 
+        tasks = [asyncio.create_task(detect_batch(batch)) for batch in batched(segments, MAX_DOCUMENTS_PER_REQUEST)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                detected = await task
+                if detected:
+                    return detected
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
+        return None
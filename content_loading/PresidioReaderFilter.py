@@ -1,23 +1,46 @@
-from typing import Any, Dict, List, Optional, Union
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 from llama_index.core.schema import Document
 from llama_index.core.readers.base import BaseReader, BasePydanticReader
 from presidio_analyzer import AnalyzerEngine, RecognizerResult
-from PIIDetection import PIIDetectionError, PIIDetectedEntity
+from PIIPrefilter import PIIPrefilter
+from IngestionTelemetry import ingestion_stage
+from PIIDetection import PIIDetectionError, PIIDetectedEntity, iter_windows
 import logging
 
+# The analyzer loads the spaCy model, which takes seconds. It is created on first
+# use instead of at import, so hosts using the PII service never load it, and
+# shared by every blob processed on the host.
+_analyzer: Optional[AnalyzerEngine] = None
+_analyzer_lock = threading.Lock()
+
+def get_analyzer() -> AnalyzerEngine:
+    global _analyzer
+    with _analyzer_lock:
+        if _analyzer is None:
+            logging.info("Loading the Presidio analyzer")
+            _analyzer = AnalyzerEngine()
+        return _analyzer
+
 class PresidioReaderFilter(BasePydanticReader):
     """Filter for ensuring that documents containing PII are not indexed, using Presidio.
 
+    The pages are run through the NLP pipeline as one batch and analysis stops
+    at the first page with an entity above `min_confidence`.
+
     Args:
         reader (BaseReader): The reader to filter.
         min_confidence (float): The minimum confidence level for PII detection.
+        prefilter (PIIPrefilter): Optional pattern screening, only the pages it escalates are checked.
+        window_pages (int): The number of pages checked at a time when the data is loaded as a stream.
     """
     reader: BaseReader
-    endpoint: str
+    endpoint: Optional[str] = None
     pii_categories: Optional[List[str]] = None
     min_confidence: float = 0.8
-    analyzer: AnalyzerEngine = AnalyzerEngine()
-    
+    prefilter: Optional[PIIPrefilter] = None
+    window_pages: int = 16
+
     def load_data(self) -> List[Document]:
         """Load the data from the reader and filter out any documents containing PII.
 
@@ -25,30 +48,45 @@ class PresidioReaderFilter(BasePydanticReader):
             List[Document]: The list of documents with PII removed.
         """
         documents = self.reader.load_data()
-        for doc in documents:
-            detected_pii_entities = self.__detect_pii(doc)
-            if detected_pii_entities:
-                raise PIIDetectionError(
-                    detected_entities=map(lambda entity: PIIDetectedEntity(category=entity.entity_type, confidence_score=entity.score), detected_pii_entities),
-                    document=doc, message=f"Document contains PII: {doc.text}")
-            
+        self.__check_documents(documents)
         return documents
 
-    def __detect_pii(self, document: Document) -> List[RecognizerResult]:
-        """Check if a document contains PII.
+    def lazy_load_data(self) -> Iterator[Document]:
+        """Load the data from the reader as a stream, checking `window_pages` pages at a time.
+        The pages of a window are only yielded once the whole window is checked."""
+        for window in iter_windows(self.reader.lazy_load_data(), self.window_pages):
+            self.__check_documents(window)
+            yield from window
+
+    def __check_documents(self, documents: List[Document]):
+        with ingestion_stage("pii") as counts:
+            escalated = self.prefilter.screen(documents) if self.prefilter else documents
+            detected = self.__detect_pii(escalated)
+            counts["pages"] = len(documents)
+            counts["escalatedPages"] = len(escalated)
+        if detected:
+            doc, detected_pii_entities = detected
+            raise PIIDetectionError(
+                detected_entities=map(lambda entity: PIIDetectedEntity(category=entity.entity_type, confidence_score=entity.score), detected_pii_entities),
+                document=doc, message=f"Document contains PII: {doc.text}")
+
+    def __detect_pii(self, documents: List[Document]) -> Optional[Tuple[Document, List[RecognizerResult]]]:
+        """Check if any of the documents contains PII.
 
         Args:
-            document (Document): The document to check.
+            documents (List[Document]): The documents to check.
 
         Returns:
-            A list of PII entities detected in the document.
-        """       
-        results = self.analyzer.analyze(text=document.text, entities=self.pii_categories, language='en')
-        
-        detected_pii = []
-        for result in results:
-            if result.score > self.min_confidence:
-                detected_pii.append(result)
-
-        return detected_pii
-    
\ No newline at end of file
+            The first document found to contain PII with its entities, None otherwise.
+        """
+        analyzer = get_analyzer()
+        # spaCy processes the texts lazily in batches, so breaking out skips the remaining pages
+        nlp_artifacts_batch = analyzer.nlp_engine.process_batch(texts=[doc.text for doc in documents], language='en')
+
+        for doc, (text, nlp_artifacts) in zip(documents, nlp_artifacts_batch):
+            results = analyzer.analyze(text=text, nlp_artifacts=nlp_artifacts, entities=self.pii_categories, language='en')
+            detected_pii = [result for result in results if result.score > self.min_confidence]
+            if detected_pii:
+                return doc, detected_pii
+
+        return None
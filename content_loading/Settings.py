@@ -17,6 +17,11 @@ class CosmosSettings(BaseSettings):
     database: str
     chunkContainer: str = Field(validation_alias='CosmosDBContainer')
     statusContainer: str = Field(validation_alias='CosmosDBDocumentStatusContainer')
+    vectorIndexType: str = "quantizedFlat"
+    vectorDistanceFunction: str = "cosine"
+    bulkBatchSize: int = 100
+    bulkConcurrency: int = 4
+    progressIntervalSeconds: float = 2.0
 
 class OpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix='OpenAI', extra='ignore')
@@ -27,11 +32,30 @@ class OpenAISettings(BaseSettings):
     deploymentName: str
     embeddingModelName: str
     embeddingDeploymentName: str
+    embeddingDimensions: Optional[int] = None
+    embeddingBatchSize: int = 16
+    embeddingConcurrency: int = 4
+    embeddingTokensPerMinute: Optional[int] = None
+    embeddingRequestsPerMinute: Optional[int] = None
+    visionDeploymentName: Optional[str] = None
+    visionMaxTokens: int = 2000
+    visionConcurrency: int = 4
 
 class StorageSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix='StorageAccount', extra='ignore')
     accountName: str = Field(validation_alias='StorageAccountName')
     key: Optional[str] = None
+    indexContainer: Optional[str] = None
+    indexMinChunks: int = 5000
+    downloadMaxConcurrency: int = 4
+    inMemoryMaxMb: int = 32
+    blobServiceUri: Optional[str] = None
+    queueServiceUri: Optional[str] = None
+    ingestionQueue: Optional[str] = None
+    ingestionBatchSize: int = 16
+    ingestionMaxConcurrency: int = 4
+    ingestionVisibilityTimeout: int = 600
+    ingestionWindowPages: int = 16
 
 class PIISettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix='PII', extra='ignore')
@@ -40,9 +64,14 @@ class PIISettings(BaseSettings):
     apiKey: Optional[str] = None
     categories: str
     minimumConfidence: float
+    maxConcurrency: int = 4
+    enablePrefilter: bool = False
 
 class ImageSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix='SupportedImage', extra='ignore')
     fileTypes: str
+    maxLongSide: int = Field(2048, validation_alias='ImageMaxLongSide')
+    maxShortSide: int = Field(768, validation_alias='ImageMaxShortSide')
+    descriptionCacheSize: int = Field(256, validation_alias='ImageDescriptionCacheSize')
 
 
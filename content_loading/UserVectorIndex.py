@@ -0,0 +1,223 @@
+import argparse
+import hashlib
+import json
+import logging
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.cosmos import ContainerProxy
+from azure.storage.blob import ContainerClient
+
+# File layout, read by backend/context/user_vector_index.py. Sections follow
+# the 64 byte header in this order, each padded to a multiple of 4 bytes:
+#   centroids       float32[nlist, dim]
+#   list offsets    uint32[nlist + 1], rows of list i are offsets[i]:offsets[i+1]
+#   scales          float32[count], dequantizes the int8 rows
+#   vectors         int8[count, dim], normalized and grouped by list
+#   document index  uint32[count], position in the master document id table
+#   id tables       utf-8 JSON {"chunk_ids": [...], "master_document_ids": [...], "document_versions": [...]}
+# The document versions are the content hashes of the documents when the file
+# was built, the backend ignores the file for a document uploaded again since.
+INDEX_MAGIC = b"UVIX"
+INDEX_VERSION = 1
+HEADER_FORMAT = "<4sIIII"
+HEADER_SIZE = 64
+
+# below this many chunks the in process or Cosmos DB search is cheap enough
+DEFAULT_MIN_CHUNKS = 5000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 256
+# a concurrent rebuild replaced the file while this one read the chunks
+MAX_UPLOAD_ATTEMPTS = 5
+VECTOR_BLOCK_ROWS = 4096
+
+
+def get_index_blob_name(user_id: str) -> str:
+    return f"{user_id}.ann"
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % 4)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 4096) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        assignments[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of the normalized vectors."""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if len(vectors) > nlist * KMEANS_SAMPLE_PER_LIST:
+        sample = vectors[rng.choice(len(vectors), nlist * KMEANS_SAMPLE_PER_LIST, replace=False)]
+
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _assign(sample, centroids)
+        for list_id in range(nlist):
+            members = sample[assignments == list_id]
+            if len(members):
+                centroids[list_id] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+
+    return centroids.astype(np.float32)
+
+
+def get_documents_hash(document_versions: Dict[str, Optional[str]]) -> str:
+    return hashlib.sha256(json.dumps(sorted(document_versions.items())).encode("utf-8")).hexdigest()
+
+
+def build_index(vectors, chunk_ids: List[str], master_document_ids: List[str], nlist: Optional[int] = None, document_versions: Optional[Dict[str, Optional[str]]] = None) -> bytes:
+    """Build the inverted file index of a user's chunks with int8 quantized vectors."""
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    count, dim = vectors.shape
+    nlist = nlist or int(np.clip(np.sqrt(count), 1, 1024))
+    nlist = min(nlist, count)
+
+    centroids = train_centroids(vectors, nlist)
+    assignments = _assign(vectors, centroids)
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.uint32)
+
+    vectors = vectors[order]
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+
+    document_table = list(dict.fromkeys(master_document_ids))
+    document_positions = {document_id: position for position, document_id in enumerate(document_table)}
+    document_index = np.asarray([document_positions[master_document_ids[i]] for i in order], dtype=np.uint32)
+    id_tables = json.dumps({
+        "chunk_ids": [chunk_ids[i] for i in order],
+        "master_document_ids": document_table,
+        "document_versions": [(document_versions or {}).get(document_id) for document_id in document_table],
+    }).encode("utf-8")
+
+    header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, count, dim, nlist)
+    sections = [
+        header + b"\0" * (HEADER_SIZE - len(header)),
+        centroids.tobytes(),
+        offsets.tobytes(),
+        scales.astype(np.float32).tobytes(),
+        quantized.tobytes() + _padding(quantized.nbytes),
+        document_index.tobytes(),
+        id_tables,
+    ]
+    return b"".join(sections)
+
+
+def read_document_versions(status_container: ContainerProxy, user_id: str) -> Dict[str, Optional[str]]:
+    """Content hash of each indexed document of the user, by master document id."""
+    query = "SELECT c.id, c.content_hash FROM c WHERE c.user_principal_id = @userId AND c.status = 'Indexed'"
+    parameters = [{"name": "@userId", "value": user_id}]
+
+    return { item["id"]: item.get("content_hash") for item in status_container.query_items(query, parameters=parameters, partition_key=user_id) }
+
+
+def read_user_vectors(chunk_container: ContainerProxy, user_id: str, document_ids) -> Tuple[np.ndarray, List[str], List[str]]:
+    """Read the chunks of the given documents, the vectors straight into a float32 array."""
+    query = "SELECT c.id, c.metadata.master_document_id, c.contentVector FROM c WHERE c.metadata.user_principal_id = @userId"
+    parameters = [{"name": "@userId", "value": user_id}]
+
+    chunk_ids = []
+    master_document_ids = []
+    vectors = None
+    for item in chunk_container.query_items(query, parameters=parameters, partition_key=user_id):
+        # the chunks of a document that is still being indexed are left for its own rebuild
+        if item.get("master_document_id") not in document_ids:
+            continue
+
+        vector = item["contentVector"]
+        if vectors is None:
+            vectors = np.empty((VECTOR_BLOCK_ROWS, len(vector)), dtype=np.float32)
+        elif len(chunk_ids) == len(vectors):
+            vectors = np.concatenate([vectors, np.empty_like(vectors)])
+        vectors[len(chunk_ids)] = vector
+        chunk_ids.append(item["id"])
+        master_document_ids.append(item["master_document_id"])
+
+    if vectors is None:
+        return np.empty((0, 0), dtype=np.float32), chunk_ids, master_document_ids
+    return vectors[:len(chunk_ids)], chunk_ids, master_document_ids
+
+
+def rebuild_user_index(chunk_container: ContainerProxy, status_container: ContainerProxy, index_container: ContainerClient, user_id: str, min_chunks: int = DEFAULT_MIN_CHUNKS) -> int:
+    """Rebuild the index file of a user from the chunks of their indexed documents in Cosmos DB.
+
+    Users with fewer than `min_chunks` chunks get no index file, an existing
+    one is removed so that retrieval goes back to the exact search. The file
+    is only replaced if it did not change while it was built, otherwise the
+    rebuild starts over so a concurrent one never overwrites newer documents.
+    """
+    blob_client = index_container.get_blob_client(get_index_blob_name(user_id))
+    for _ in range(MAX_UPLOAD_ATTEMPTS):
+        try:
+            properties = blob_client.get_blob_properties()
+            etag, metadata = properties.etag, properties.metadata or {}
+        except ResourceNotFoundError:
+            etag, metadata = None, {}
+
+        document_versions = read_document_versions(status_container, user_id)
+        documents_hash = get_documents_hash(document_versions)
+        if etag and metadata.get("documents_hash") == documents_hash:
+            # the file already holds these versions of the documents
+            return int(metadata.get("chunks", 0))
+
+        vectors, chunk_ids, master_document_ids = read_user_vectors(chunk_container, user_id, document_versions)
+        try:
+            if len(chunk_ids) < min_chunks:
+                if etag:
+                    blob_client.delete_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+                return 0
+
+            data = build_index(vectors, chunk_ids, master_document_ids, document_versions=document_versions)
+            metadata = {"documents_hash": documents_hash, "chunks": str(len(chunk_ids))}
+            if etag:
+                blob_client.upload_blob(data, overwrite=True, metadata=metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+            else:
+                blob_client.upload_blob(data, overwrite=False, metadata=metadata)
+        except (ResourceModifiedError, ResourceExistsError, ResourceNotFoundError):
+            logging.info(f"Vector index of user {user_id} changed while it was rebuilt, starting over")
+            continue
+
+        logging.info(f"Uploaded vector index with {len(chunk_ids)} chunks for user {user_id}")
+        return len(chunk_ids)
+
+    raise RuntimeError(f"Vector index of user {user_id} kept changing, gave up after {MAX_UPLOAD_ATTEMPTS} attempts")
+
+
+if __name__ == "__main__":
+    from azure.cosmos import CosmosClient
+    from Settings import ContentLoadingSettings
+    from Credentials import ContentLoadingCredentials
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Rebuild the vector index file of a user",
+        epilog="Example: python UserVectorIndex.py --user-id 00000000-0000-0000-0000-000000000000",
+    )
+    parser.add_argument("--user-id", required=True)
+    args = parser.parse_args()
+
+    config = ContentLoadingSettings()
+    auth = ContentLoadingCredentials(config)
+    if not config.storage.indexContainer:
+        raise SystemExit("Set StorageAccountIndexContainer")
+
+    database = CosmosClient(config.cosmos.endpoint, auth.cosmos_credential).get_database_client(config.cosmos.database)
+    chunk_container = database.get_container_client(config.cosmos.chunkContainer)
+    status_container = database.get_container_client(config.cosmos.statusContainer)
+    index_container = ContainerClient(f"https://{config.storage.accountName}.blob.core.windows.net", config.storage.indexContainer, credential=auth.storage_credential)
+    count = rebuild_user_index(chunk_container, status_container, index_container, args.user_id, config.storage.indexMinChunks)
+    print(f"Indexed {count} chunks")
@@ -0,0 +1,195 @@
+import argparse
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from azure.cosmos import ContainerProxy, CosmosClient, DatabaseProxy, PartitionKey
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+VECTOR_PATH = "/contentVector"
+DEFAULT_DISTANCE_FUNCTION = "cosine"
+
+# quantizedFlat scans every quantized vector of the partition, past this many
+# chunks diskANN keeps query RU and latency flat
+DISKANN_THRESHOLD = 50_000
+
+KNOWN_EMBEDDING_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+
+def get_embedding_dimensions(embedding_model_name: str, configured_dimensions: Optional[int] = None, embed_model: Optional[BaseEmbedding] = None) -> int:
+    if configured_dimensions:
+        return configured_dimensions
+
+    if embed_model is not None:
+        # ask the deployment itself
+        return len(embed_model.get_text_embedding("dimension probe"))
+
+    if embedding_model_name in KNOWN_EMBEDDING_DIMENSIONS:
+        return KNOWN_EMBEDDING_DIMENSIONS[embedding_model_name]
+
+    raise ValueError(f"Unknown dimensions for embedding model {embedding_model_name}, set OpenAIEmbeddingDimensions")
+
+
+def choose_vector_index_type(expected_chunks: int) -> str:
+    return "diskANN" if expected_chunks >= DISKANN_THRESHOLD else "quantizedFlat"
+
+
+def build_vector_policies(dimensions: int, index_type: str = "quantizedFlat", distance_function: str = DEFAULT_DISTANCE_FUNCTION) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    vector_embedding_policy = {
+        "vectorEmbeddings": [
+            {
+                "path": VECTOR_PATH,
+                "dataType": "float32",
+                "distanceFunction": distance_function,
+                "dimensions": dimensions,
+            }
+        ]
+    }
+
+    indexing_policy = {
+        "indexingMode": "consistent",
+        "includedPaths": [{"path": "/*"}],
+        # the vectors are served by the vector index, range indexing them only costs RU on insert
+        "excludedPaths": [{"path": '/"_etag"/?'}, {"path": f"{VECTOR_PATH}/*"}],
+        "vectorIndexes": [{"path": VECTOR_PATH, "type": index_type}],
+    }
+
+    return vector_embedding_policy, indexing_policy
+
+
+def validate_container(container: ContainerProxy, vector_embedding_policy: Dict[str, Any], indexing_policy: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """Compare the live container with the expected policies.
+
+    Returns the mismatches of the vector embedding policy, which can only be
+    fixed by moving the data to a new container, and those of the indexing
+    policy, which can be replaced in place.
+    """
+    properties = container.read()
+    embedding_problems = []
+    index_problems = []
+
+    expected_embedding = vector_embedding_policy["vectorEmbeddings"][0]
+    live_embeddings = {embedding["path"]: embedding for embedding in properties.get("vectorEmbeddingPolicy", {}).get("vectorEmbeddings", [])}
+    live_embedding = live_embeddings.get(expected_embedding["path"])
+    if not live_embedding:
+        embedding_problems.append(f"No vector embedding policy for {expected_embedding['path']}")
+    else:
+        for key in ("dataType", "distanceFunction", "dimensions"):
+            if live_embedding.get(key) != expected_embedding[key]:
+                embedding_problems.append(f"{key} is {live_embedding.get(key)}, expected {expected_embedding[key]}")
+
+    expected_index = indexing_policy["vectorIndexes"][0]
+    live_indexes = {index["path"]: index for index in properties.get("indexingPolicy", {}).get("vectorIndexes", [])}
+    live_index = live_indexes.get(expected_index["path"])
+    if not live_index:
+        index_problems.append(f"No vector index on {expected_index['path']}, vector queries fall back to full scans")
+    elif live_index.get("type") != expected_index["type"]:
+        index_problems.append(f"Vector index type is {live_index.get('type')}, expected {expected_index['type']}")
+
+    for path in live_indexes:
+        if path != expected_index["path"]:
+            index_problems.append(f"Vector index on {path} does not match any stored vector")
+
+    return embedding_problems, index_problems
+
+
+def replace_indexing_policy(database: DatabaseProxy, container: ContainerProxy, indexing_policy: Dict[str, Any]):
+    properties = container.read()
+    database.replace_container(
+        container,
+        partition_key=PartitionKey(path=properties["partitionKey"]["paths"][0]),
+        indexing_policy=indexing_policy,
+    )
+
+
+def migrate_container(database: DatabaseProxy, source: ContainerProxy, target_name: str, vector_embedding_policy: Dict[str, Any], indexing_policy: Dict[str, Any]) -> int:
+    """Copy every chunk into a new container created with the expected policies.
+
+    The vector embedding policy of a container can't be changed after creation.
+    Chunks whose vectors don't have the expected dimensions are skipped, their
+    documents have to be uploaded again.
+    """
+    properties = source.read()
+    target = database.create_container_if_not_exists(
+        id=target_name,
+        partition_key=PartitionKey(path=properties["partitionKey"]["paths"][0]),
+        indexing_policy=indexing_policy,
+        vector_embedding_policy=vector_embedding_policy,
+    )
+
+    dimensions = vector_embedding_policy["vectorEmbeddings"][0]["dimensions"]
+    vector_key = VECTOR_PATH[1:]
+    copied = 0
+    skipped = 0
+    for item in source.query_items("SELECT * FROM c", enable_cross_partition_query=True):
+        if len(item.get(vector_key) or []) != dimensions:
+            skipped += 1
+            continue
+
+        target.upsert_item({ key: value for key, value in item.items() if not key.startswith("_") })
+        copied += 1
+
+    if skipped:
+        logging.warning(f"Skipped {skipped} chunks whose vectors don't have {dimensions} dimensions, their documents need to be uploaded again")
+
+    return copied
+
+
+if __name__ == "__main__":
+    from Settings import ContentLoadingSettings
+    from Credentials import ContentLoadingCredentials
+    from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Validate, and optionally fix, the vector policies of the document chunk container",
+        epilog="Example: python VectorIndexPolicy.py --expected-chunks 200000 --apply",
+    )
+    parser.add_argument("--expected-chunks", type=int, default=0, help="Expected number of chunks per user partition, picks the vector index type.")
+    parser.add_argument("--index-type", choices=["quantizedFlat", "diskANN"], required=False, help="Use this vector index type instead of choosing one from --expected-chunks.")
+    parser.add_argument("--distance-function", choices=["cosine", "dotproduct", "euclidean"], default=DEFAULT_DISTANCE_FUNCTION)
+    parser.add_argument("--apply", action="store_true", help="Replace the indexing policy in place, or migrate to --target-container when the embedding policy differs.")
+    parser.add_argument("--target-container", required=False, help="New container for the chunks when the vector embedding policy has to change.")
+    args = parser.parse_args()
+
+    config = ContentLoadingSettings()
+    auth = ContentLoadingCredentials(config)
+
+    embed_kwargs = {
+        "model": config.openai.embeddingModelName,
+        "deployment_name": config.openai.embeddingDeploymentName,
+        "azure_endpoint": config.openai.endpoint,
+        "api_version": config.openai.apiVersion,
+    }
+    if config.openai.apiKey:
+        embed_kwargs["api_key"] = config.openai.apiKey
+    else:
+        embed_kwargs["azure_ad_token_provider"] = auth.openai_token_provider
+        embed_kwargs["use_azure_ad"] = True
+
+    dimensions = get_embedding_dimensions(config.openai.embeddingModelName, config.openai.embeddingDimensions, AzureOpenAIEmbedding(**embed_kwargs))
+    index_type = args.index_type or choose_vector_index_type(args.expected_chunks)
+    vector_embedding_policy, indexing_policy = build_vector_policies(dimensions, index_type, args.distance_function)
+    print(f"Expected {index_type} index on {VECTOR_PATH} with {dimensions} dimensions and {args.distance_function} distance")
+
+    database = CosmosClient(config.cosmos.endpoint, auth.cosmos_credential).get_database_client(config.cosmos.database)
+    container = database.get_container_client(config.cosmos.chunkContainer)
+    embedding_problems, index_problems = validate_container(container, vector_embedding_policy, indexing_policy)
+    for problem in embedding_problems + index_problems:
+        print(f"  {problem}")
+
+    if not embedding_problems and not index_problems:
+        print("Container policies match")
+    elif args.apply and embedding_problems:
+        if not args.target_container:
+            raise SystemExit("The vector embedding policy can't be changed in place, pass --target-container")
+        copied = migrate_container(database, container, args.target_container, vector_embedding_policy, indexing_policy)
+        print(f"Copied {copied} chunks to {args.target_container}, point CosmosDBContainer and DOCUMENT_UPLOAD_DOCUMENT_CHUNKS_CONTAINER at it")
+    elif args.apply:
+        replace_indexing_policy(database, container, indexing_policy)
+        print("Indexing policy replaced, the vector index builds in the background")
+    else:
+        raise SystemExit(1)
@@ -1,12 +1,15 @@
-from typing import List
+from typing import Any, Callable, Dict, List
 import azure.functions as func
 import logging
+import os
+import threading
 
 from azure.cosmos import CosmosClient, ContainerProxy, PartitionKey
-from azure.storage.blob import BlobClient
+from azure.storage.blob import BlobClient, BlobServiceClient
+from azure.storage.queue import QueueClient
 from llama_index.llms.azure_openai import AzureOpenAI as LlamaIndexAzureOpenAI
 from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AzureOpenAI
 
 from typing import List
 
@@ -18,84 +21,154 @@ from AzureCosmosDBNoSqlVectorSearch import AzureCosmosDBNoSqlVectorSearch
 from PIIDetection import PIIDetectionError
 from PresidioReaderFilter import PresidioReaderFilter
 from PIIServiceReaderFilter import PIIServiceReaderFilter
-from image_model_reader import ImageModelReader
+from PIIPrefilter import PIIPrefilter
+from image_model_reader import DescriptionCache, ImageModelReader
 from llama_index_service import LlamaIndexService
 from DocumentService import DocumentService
+from VectorIndexPolicy import build_vector_policies, get_embedding_dimensions
+from UserVectorIndex import rebuild_user_index
+from EmbeddingScheduler import EmbeddingScheduler
+from IngestionTelemetry import current_ingestion, track_ingestion
+from IngestionQueue import complete_message, get_message_blob_path, is_last_attempt, keep_invisible, process_blobs, receive_messages
 
 app = func.FunctionApp()
 
-@app.blob_trigger(arg_name="indexBlob", path="documents/{container_name}", connection="DOCUMENT_STORAGE_ACCOUNT")
-def blob_trigger(indexBlob: func.InputStream):
-    logging.info(f"Indexing blob: {indexBlob.name}")
+# Settings, credentials and clients are created by the first invocation on a host
+# and reused by the ones after it, so a burst of uploads doesn't repeat the setup
+# and the management plane calls for every blob
+__shared__: Dict[str, Any] = {}
+__shared_lock__ = threading.RLock()
+
+def __get_shared__(name: str, factory: Callable[[], Any]) -> Any:
+    with __shared_lock__:
+        if name not in __shared__:
+            __shared__[name] = factory()
+        return __shared__[name]
+
+# The triggers are registered when the module is imported, before the settings are loaded.
+# With an ingestion queue, blobs are indexed from the BlobCreated events Event Grid writes
+# to it instead of by the blob trigger, which can take minutes to notice a new blob.
+INGESTION_QUEUE = os.environ.get("StorageAccountIngestionQueue")
+
+if INGESTION_QUEUE:
+    @app.queue_trigger(arg_name="message", queue_name=INGESTION_QUEUE, connection="DOCUMENT_STORAGE_ACCOUNT")
+    def queue_trigger(message: func.QueueMessage):
+        config = __get_shared__("config", ContentLoadingSettings)
+        auth = __get_shared__("auth", lambda: ContentLoadingCredentials(config))
+        queue_client = __get_shared__("ingestion_queue_client", lambda: __create_queue_client__(config.storage, auth, INGESTION_QUEUE))
+
+        trigger_path = get_message_blob_path(message.get_body().decode("utf-8"))
+        # pull more of the waiting notifications, so a burst of uploads is indexed concurrently
+        # by this invocation instead of one blob per invocation
+        messages = receive_messages(queue_client, config.storage.ingestionBatchSize - 1, config.storage.ingestionVisibilityTimeout)
+        message_paths = [get_message_blob_path(received.content) for received in messages]
+        blob_paths = sorted({ path for path in [trigger_path, *message_paths] if path })
+
+        # a blob that fails is kept for the next attempt, and deleted when its message is poisoned
+        dequeue_counts = { path: received.dequeue_count for path, received in zip(message_paths, messages) }
+        dequeue_counts[trigger_path] = message.dequeue_count
+        def process(blob_path: str):
+            process_blob(blob_path, delete_on_failure=is_last_attempt(dequeue_counts[blob_path]))
+
+        logging.info(f"Indexing {len(blob_paths)} blobs from the ingestion queue")
+        # the host extends the visibility of the trigger message, the pulled ones are extended here
+        with keep_invisible(queue_client, messages, config.storage.ingestionVisibilityTimeout):
+            errors = process_blobs(blob_paths, process, config.storage.ingestionMaxConcurrency)
+
+        poison_queue_client = __get_shared__("ingestion_poison_queue_client", lambda: __create_queue_client__(config.storage, auth, f"{INGESTION_QUEUE}-poison"))
+        for received, blob_path in zip(messages, message_paths):
+            complete_message(queue_client, poison_queue_client, received, errors.get(blob_path))
+
+        # the trigger message is retried and moved to the poison queue by the host
+        if errors.get(trigger_path):
+            raise errors[trigger_path]
+else:
+    @app.blob_trigger(arg_name="indexBlob", path="documents/{container_name}", connection="DOCUMENT_STORAGE_ACCOUNT")
+    def blob_trigger(indexBlob: func.InputStream):
+        process_blob(indexBlob.name)
+
+def process_blob(blob_path: str, delete_on_failure: bool = True):
+    """Index the blob at `container/blob`, shared by the blob and the queue trigger.
+    The blob is deleted once indexed, and when indexing fails only if `delete_on_failure`."""
+    # the stages of the pipeline add their timings and counts to the telemetry of the blob
+    with track_ingestion(blob_path) as telemetry:
+        try:
+            __index_blob__(blob_path, delete_on_failure)
+        finally:
+            telemetry.record_metrics()
+
+def __index_blob__(blob_path: str, delete_on_failure: bool = True):
+    logging.info(f"Indexing blob: {blob_path}")
+    completed = False
     
     try:
-        config = ContentLoadingSettings()
-        auth = ContentLoadingCredentials(config)
-
-        blob_name: str = indexBlob.name.split("/")[-1]
-        container_name = ''.join(indexBlob.name.rsplit('/', 1)[:-1])
-        blob_client = __create_blob_client__(container_name, blob_name, config.storage, auth)
-
-        document_status_container_client = __create_status_container_proxy(config.cosmos, auth)
-        document_service: DocumentService = DocumentService(document_status_container_client)
-        vector_store = __create_vector_store__(config.cosmos, auth)
-
-        llm = __create_llm__(config.openai, auth)
-        openai_client = __create_openai_client(config.openai, auth)
-        embed_model = __create_embedding_model__(config.openai, auth)
-        llama_index_service: LlamaIndexService = LlamaIndexService(
+        config = __get_shared__("config", ContentLoadingSettings)
+        auth = __get_shared__("auth", lambda: ContentLoadingCredentials(config))
+        cosmos_client = __get_shared__("cosmos_client", lambda: CosmosClient(config.cosmos.endpoint, auth.cosmos_credential))
+        blob_service_client = __get_shared__("blob_service_client", lambda: __create_blob_service_client__(config.storage, auth))
+
+        blob_name: str = blob_path.split("/")[-1]
+        container_name = ''.join(blob_path.rsplit('/', 1)[:-1])
+        logging.info(f"Creating Blob Client for container {container_name} and blob {blob_name}.")
+        blob_client = blob_service_client.get_blob_client(container_name, blob_name)
+
+        document_service: DocumentService = __get_shared__("document_service", lambda: DocumentService(__create_status_container_proxy(cosmos_client, config.cosmos)))
+        embed_model = __get_shared__("embed_model", lambda: __create_embedding_model__(config.openai, auth))
+        vector_store = __get_shared__("vector_store", lambda: __create_vector_store__(cosmos_client, config.cosmos, config.openai, embed_model))
+
+        openai_client = __get_shared__("openai_client", lambda: __create_openai_client(config.openai, auth))
+        llama_index_service: LlamaIndexService = __get_shared__("llama_index_service", lambda: LlamaIndexService(
             document_service=document_service,
-            llm=llm,
+            llm=__create_llm__(config.openai, auth),
             vector_store=vector_store,
-            embed_model=embed_model
-        )
+            embed_model=embed_model,
+            embedding_scheduler=__create_embedding_scheduler__(config.openai, auth),
+            progress_interval=config.cosmos.progressIntervalSeconds,
+            window_pages=config.storage.ingestionWindowPages
+        ))
         
-        image_file_types: List[str] = config.image.fileTypes.split(",")
-        loader = __create_composite_loader__(blob_client, openai_client, image_file_types, config.pii, auth)
+        image_model_reader = __get_shared__("image_model_reader", lambda: __create_image_model_reader__(openai_client, config.openai, config.image))
+        loader = __create_composite_loader__(blob_client, image_model_reader, config.image, config.pii, config.storage, auth)
         
         llama_index_service.index_documents(loader)
         
     except PIIDetectionError as e:
-        document_service.update_document_status(e.document, "PII Detected")
+        document_service.update_document_status(e.document, "PII Detected", ingestion=current_ingestion().to_status())
         user = e.document.metadata.get("author", "Unknown")
 
         for entity in e.detected_entities:
             logging.error(f"PII Detected in document {blob_name} uploaded by {user}: {entity.category} with confidence {entity.confidence_score}")
+        completed = True
     except Exception as e:
         logging.error(f"Error indexing blob: {e}")
         raise e
     else:
         logging.info(f"Blob {blob_name} indexed successfully.")
+        if config.storage.indexContainer:
+            __rebuild_user_vector_index__(blob_client, cosmos_client, blob_service_client, config)
+        completed = True
     finally:
-        logging.info(f"Deleting blob {blob_name}.")
-        blob_client.delete_blob()
+        if completed or delete_on_failure:
+            logging.info(f"Deleting blob {blob_name}.")
+            blob_client.delete_blob()
+        else:
+            logging.info(f"Keeping blob {blob_name} for the next attempt.")
         blob_client.close()
     
-def __create_vector_store__(cosmosConfig: CosmosSettings, auth: ContentLoadingCredentials) -> AzureCosmosDBNoSqlVectorSearch:
+def __create_vector_store__(client: CosmosClient, cosmosConfig: CosmosSettings, openaiConfig: OpenAISettings, embed_model: AzureOpenAIEmbedding) -> AzureCosmosDBNoSqlVectorSearch:
 
-    # Create the Cosmos client
-
-    client = CosmosClient(cosmosConfig.endpoint, auth.cosmos_credential)
     partition_key = PartitionKey(path="/userId")
     cosmos_database_properties = {}
     cosmos_container_properties = {"partition_key": partition_key}
-    indexing_policy = {
-        "indexingMode": "consistent",
-        "includedPaths": [{"path": "/*"}],
-        "excludedPaths": [{"path": '/"_etag"/?'}],
-        "vectorIndexes": [{"path": "/embedding", "type": "quantizedFlat"}],
-    }
-
-    vector_embedding_policy = {
-        "vectorEmbeddings": [
-            {
-                "path": "/contentVector",
-                "dataType": "float32",
-                "distanceFunction": "euclidean",
-                "dimensions": 1531,
-            }
-        ]
-    }
+
+    # run VectorIndexPolicy.py to check that the live container matches these. Without configured
+    # dimensions the deployment is probed, once per host as the vector store is shared
+    dimensions = get_embedding_dimensions(openaiConfig.embeddingModelName, openaiConfig.embeddingDimensions, embed_model)
+    vector_embedding_policy, indexing_policy = build_vector_policies(
+        dimensions,
+        cosmosConfig.vectorIndexType,
+        cosmosConfig.vectorDistanceFunction
+    )
 
     return AzureCosmosDBNoSqlVectorSearch(
         cosmos_client=client,
@@ -105,23 +178,28 @@ def __create_vector_store__(cosmosConfig: CosmosSettings, auth: ContentLoadingCr
         indexing_policy=indexing_policy,
         cosmos_container_properties=cosmos_container_properties,
         cosmos_database_properties=cosmos_database_properties,
-        create_container=False
+        create_container=False,
+        bulk_batch_size=cosmosConfig.bulkBatchSize,
+        bulk_max_concurrency=cosmosConfig.bulkConcurrency
     )
 
 # Create the Azure Blob Loader
 def __create_composite_loader__(
     blob_client: BlobClient,
-    openai_client: LlamaIndexAzureOpenAI,
-    img_file_types: List[str],
+    image_model_reader: ImageModelReader,
+    imageConfig: ImageSettings,
     piiConfig: PIISettings,
+    stgConfig: StorageSettings,
     auth: ContentLoadingCredentials) -> AzStorageBlobReader:
 
     blob_properties = blob_client.get_blob_properties()
     logging.info(f"Creating Azure Blob Loader for container {blob_properties.container} and blob {blob_properties.name}.")
 
-    image_model_reader = ImageModelReader(openai_client=openai_client)
+    img_file_types: List[str] = imageConfig.fileTypes.split(",")
     readers = dict(map(lambda type: (type, image_model_reader), img_file_types))
-    blob_reader = AzStorageBlobReader(blob_client=blob_client)
+    blob_reader = AzStorageBlobReader(blob_client=blob_client,
+                                      max_concurrency=stgConfig.downloadMaxConcurrency,
+                                      in_memory_max_size=stgConfig.inMemoryMaxMb * 1024 * 1024)
     blob_reader.file_extractor = blob_reader.file_extractor or {}
     blob_reader.file_extractor.update(readers)
     pii_endpoint = piiConfig.endpoint
@@ -137,18 +215,25 @@ def __create_composite_loader__(
     except KeyError:
         min_confidence = DEFAULT_MIN_CONFIDENCE
 
+    prefilter = PIIPrefilter(pii_categories) if piiConfig.enablePrefilter else None
+
     if (piiConfig.detectionSource == "Presidio"):
         pii_filter = PresidioReaderFilter(
             reader=blob_reader, 
             endpoint=pii_endpoint,
             pii_categories=pii_categories, 
-            min_confidence=min_confidence)
+            min_confidence=min_confidence,
+            prefilter=prefilter,
+            window_pages=stgConfig.ingestionWindowPages)
     else:
         pii_filter = PIIServiceReaderFilter(
             reader=blob_reader, 
             endpoint=pii_endpoint,
             pii_categories=pii_categories, 
             min_confidence=min_confidence,
+            max_concurrency=piiConfig.maxConcurrency,
+            prefilter=prefilter,
+            window_pages=stgConfig.ingestionWindowPages,
             credentials=auth)
 
     return pii_filter
@@ -184,6 +269,18 @@ def __create_openai_client(openaiConfig: OpenAISettings, auth: ContentLoadingCre
 
     return AzureOpenAI(**kwargs)
 
+# Create the image reader, its description cache is shared by every invocation on the host
+def __create_image_model_reader__(openai_client: AzureOpenAI, openaiConfig: OpenAISettings, imageConfig: ImageSettings) -> ImageModelReader:
+    return ImageModelReader(
+        openai_client=openai_client,
+        deployment_name=openaiConfig.visionDeploymentName or openaiConfig.deploymentName,
+        max_tokens=openaiConfig.visionMaxTokens,
+        max_concurrency=openaiConfig.visionConcurrency,
+        max_long_side=imageConfig.maxLongSide,
+        max_short_side=imageConfig.maxShortSide,
+        cache=DescriptionCache(imageConfig.descriptionCacheSize)
+    )
+
 # Create the Azure OpenAI Embedding Model
 def __create_embedding_model__(openaiConfig: OpenAISettings, auth: ContentLoadingCredentials) -> AzureOpenAIEmbedding:
     logging.info(f"Creating Azure OpenAI Embedding Model: {openaiConfig.embeddingModelName}")
@@ -202,20 +299,57 @@ def __create_embedding_model__(openaiConfig: OpenAISettings, auth: ContentLoadin
     
     return AzureOpenAIEmbedding(**kwargs)
 
-# Create Blob Client
-def __create_blob_client__(container_name: str, blob_name: str, stgConfig: StorageSettings, auth: ContentLoadingCredentials) -> BlobClient:
-    account_url: str = f"https://{stgConfig.accountName}.blob.core.windows.net"
+# Create the embedding scheduler, its rate limit buckets are shared by every invocation on the host
+def __create_embedding_scheduler__(openaiConfig: OpenAISettings, auth: ContentLoadingCredentials) -> EmbeddingScheduler:
+    kwargs = {
+        "azure_endpoint": openaiConfig.endpoint,
+        "api_version": openaiConfig.apiVersion,
+        # the scheduler retries, 429s so that every batch backs off together and
+        # connection errors, timeouts and 5xx responses with exponential backoff
+        "max_retries": 0 }
+
+    if (openaiConfig.apiKey):
+        kwargs["api_key"] = openaiConfig.apiKey
+    else:
+        kwargs["azure_ad_token_provider"] = auth.openai_token_provider
 
-    logging.info(f"Creating Blob Client for container {container_name} and blob {blob_name}.")
+    return EmbeddingScheduler(
+        client_factory=lambda: AsyncAzureOpenAI(**kwargs),
+        deployment_name=openaiConfig.embeddingDeploymentName,
+        batch_size=openaiConfig.embeddingBatchSize,
+        concurrency=openaiConfig.embeddingConcurrency,
+        tokens_per_minute=openaiConfig.embeddingTokensPerMinute,
+        requests_per_minute=openaiConfig.embeddingRequestsPerMinute
+    )
 
-    return BlobClient(account_url=account_url, 
-                        container_name=container_name, 
-                        blob_name=blob_name, 
-                        credential=auth.storage_credential)
+# Rebuild the vector index file of the uploading user, search falls back to Cosmos DB if this fails
+def __rebuild_user_vector_index__(blob_client: BlobClient, cosmos_client: CosmosClient, blob_service_client: BlobServiceClient, config: ContentLoadingSettings):
+    try:
+        user_id = blob_client.get_blob_properties().metadata.get("user_principal_id")
+        chunk_container = cosmos_client.get_database_client(config.cosmos.database).get_container_client(config.cosmos.chunkContainer)
+        status_container = __create_status_container_proxy(cosmos_client, config.cosmos)
+        index_container = blob_service_client.get_container_client(config.storage.indexContainer)
+        rebuild_user_index(chunk_container, status_container, index_container, user_id, config.storage.indexMinChunks)
+    except Exception as e:
+        logging.error(f"Error rebuilding the vector index: {e}")
+
+# Create Blob Service Client
+def __create_blob_service_client__(stgConfig: StorageSettings, auth: ContentLoadingCredentials) -> BlobServiceClient:
+    account_url: str = stgConfig.blobServiceUri or f"https://{stgConfig.accountName}.blob.core.windows.net"
+
+    logging.info(f"Creating Blob Service Client for {account_url}.")
+
+    return BlobServiceClient(account_url=account_url, credential=auth.storage_credential)
     
-def __create_status_container_proxy(cosmosConfig: CosmosSettings, auth: ContentLoadingCredentials) -> ContainerProxy:
-    # Create the Cosmos client
-    client = CosmosClient(cosmosConfig.endpoint, auth.cosmos_credential)
+# Create a client for a queue of the document storage account
+def __create_queue_client__(stgConfig: StorageSettings, auth: ContentLoadingCredentials, queue_name: str) -> QueueClient:
+    account_url: str = stgConfig.queueServiceUri or f"https://{stgConfig.accountName}.queue.core.windows.net"
+
+    logging.info(f"Creating Queue Client for {account_url} and queue {queue_name}.")
+
+    return QueueClient(account_url=account_url, queue_name=queue_name, credential=auth.storage_credential)
+
+def __create_status_container_proxy(client: CosmosClient, cosmosConfig: CosmosSettings) -> ContainerProxy:
     database_proxy = client.get_database_client(cosmosConfig.database)
     container_proxy = database_proxy.get_container_client(cosmosConfig.statusContainer)
 
@@ -1,17 +1,117 @@
 import base64
+import hashlib
+import io
+import logging
+import threading
 import fsspec as fs
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from mimetypes import guess_type
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 from fsspec import AbstractFileSystem
 from llama_index.core.readers.base import BaseReader
 from llama_index.core.schema import Document, ImageDocument
 from openai import AzureOpenAI
+from PIL import Image, ImageOps
+
+# A high detail image is scaled to fit 2048x2048 and then to 768 pixels on its
+# short side by the model, anything larger is uploaded only to be thrown away
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+JPEG_QUALITY = 85
+EXIF_ORIENTATION = 0x0112
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+PROMPT = """
+        Describe what is in this image as a summary of what you see.
+        Also provide all of the exact text contained within or extracted from the image.
+        Finally, provide a guess at what the image is attempting to communicate, using the information you've gathered.
+        """
+
+def get_target_size(width: int, height: int, max_long_side: int = MAX_LONG_SIDE, max_short_side: int = MAX_SHORT_SIDE) -> Tuple[int, int]:
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def prepare_image(data: bytes, mime_type: Optional[str], max_long_side: int = MAX_LONG_SIDE, max_short_side: int = MAX_SHORT_SIDE) -> Tuple[bytes, str]:
+    """Downscale an image to the resolution the model works at and recompress it.
+
+    Images are rotated upright by their EXIF orientation. Images with
+    transparency stay PNG, the others become JPEG. The original is kept when
+    it is upright, within the resolution and smaller than the result.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        logging.warning(f"Image could not be decoded, uploading it unchanged: {e}")
+        return data, mime_type
+
+    # the orientation of phone photos is only in their EXIF, which is not kept when re-encoding
+    oriented = image.getexif().get(EXIF_ORIENTATION, 1) == 1
+    image = ImageOps.exif_transpose(image)
+
+    target_size = get_target_size(image.width, image.height, max_long_side, max_short_side)
+    resized = target_size != image.size
+    if resized:
+        image = image.resize(target_size, Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.save(output, format="PNG", optimize=True)
+        prepared = output.getvalue(), "image/png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        prepared = output.getvalue(), "image/jpeg"
+
+    if not resized and oriented and len(prepared[0]) >= len(data):
+        return data, mime_type
+    return prepared
+
+class DescriptionCache():
+    """LRU cache of image descriptions keyed by the hash of the image content,
+    shared by every invocation on a host so re-uploaded images aren't described again."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            description = self._entries.get(key)
+            if description is not None:
+                self._entries.move_to_end(key)
+            return description
+
+    def put(self, key: str, description: str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = description
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
 class ImageModelReader(BaseReader):
-    def __init__(self, openai_client: AzureOpenAI):
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        deployment_name: str = "gpt-4o",
+        max_tokens: int = 2000,
+        max_concurrency: int = 4,
+        max_long_side: int = MAX_LONG_SIDE,
+        max_short_side: int = MAX_SHORT_SIDE,
+        cache: Optional[DescriptionCache] = None
+    ):
         self.openai_client = openai_client
+        self.deployment_name = deployment_name
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.max_long_side = max_long_side
+        self.max_short_side = max_short_side
+        self.cache = cache
 
     def _get_image_document(
         self,
@@ -24,9 +124,11 @@ class ImageModelReader(BaseReader):
             file_system = file_fs
 
         with file_system.open(file, "rb") as image_file:
-            base64_encoded_data = base64.b64encode(image_file.read()).decode('utf-8')
+            data = image_file.read()
 
         mime_type, _ = guess_type(file)
+        data, mime_type = prepare_image(data, mime_type, self.max_long_side, self.max_short_side)
+        base64_encoded_data = base64.b64encode(data).decode('utf-8')
 
         return ImageDocument(
             image=base64_encoded_data,
@@ -34,34 +136,23 @@ class ImageModelReader(BaseReader):
             image_mimetype=mime_type
         )
 
-    def load_data(
-        self,
-        file: Path,
-        extra_info: Optional[Dict] = None,
-        file_system: Optional[AbstractFileSystem] = None,
-    ) -> List[Document]:
-        extra_info = extra_info or {}
-        system_prompt = "You are a helpful assistant."
-        prompt= """
-                Describe what is in this image as a summary of what you see.
-                Also provide all of the exact text contained within or extracted from the image.
-                Finally, provide a guess at what the image is attempting to communicate, using the information you've gathered.
-                """
-        image_document = self._get_image_document(
-            file=file,
-            file_system=file_system
-        )
+    def _describe(self, image_document: ImageDocument) -> str:
+        # the deployment and the prompt are part of the key, changing either describes the images again
+        key = hashlib.sha256(f"{self.deployment_name}\n{PROMPT}\n{image_document.image}".encode("utf-8")).hexdigest()
+        if self.cache is not None and (description := self.cache.get(key)) is not None:
+            logging.info("Image description found in cache")
+            return description
 
         completion = self.openai_client.chat.completions.create(
-            model="gpt-4o",
+            model=self.deployment_name,
             messages=[
-                { "role": "system", "content": system_prompt },
-                { 
-                    "role": "user", "content": 
+                { "role": "system", "content": SYSTEM_PROMPT },
+                {
+                    "role": "user", "content":
                     [
                         {
-                            "type": "text", 
-                            "text": prompt 
+                            "type": "text",
+                            "text": PROMPT
                         },
                         {
                             "type": "image_url",
@@ -72,14 +163,42 @@ class ImageModelReader(BaseReader):
                     ]
                 }
             ],
-            max_tokens=2000
+            max_tokens=self.max_tokens
         )
-        
-        return [
-            ImageDocument(
-                text=completion.choices[0].message.content,
+
+        description = completion.choices[0].message.content
+        if self.cache is not None and description:
+            self.cache.put(key, description)
+        return description
+
+    def load_data(
+        self,
+        file: Path,
+        extra_info: Optional[Dict] = None,
+        file_system: Optional[AbstractFileSystem] = None,
+    ) -> List[Document]:
+        return self.load_images([file], extra_info, file_system)
+
+    def load_images(
+        self,
+        files: List[Path],
+        extra_info: Optional[Dict] = None,
+        file_system: Optional[AbstractFileSystem] = None,
+    ) -> List[Document]:
+        """Describe several images, with up to `max_concurrency` requests to the model in flight."""
+        extra_info = extra_info or {}
+
+        def load_image(file: Path) -> Document:
+            image_document = self._get_image_document(file=file, file_system=file_system)
+            return ImageDocument(
+                text=self._describe(image_document),
                 image_path=image_document.image_path,
                 image_url=image_document.image_url,
                 metadata=extra_info,
             )
-        ]
+
+        if len(files) == 1:
+            return [load_image(files[0])]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) as executor:
+            return list(executor.map(load_image, files))
@@ -1,10 +1,18 @@
+import logging
 from llama_index.llms.azure_openai import AzureOpenAI
-from llama_index.core import (StorageContext, VectorStoreIndex)
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from llama_index.core import VectorStoreIndex
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.settings import Settings
-from llama_index.core.vector_stores.types import VectorStore
+from llama_index.core.schema import BaseNode, Document, MetadataMode
 from llama_index.core.readers.base import BaseReader
 from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from DocumentService import DocumentService
+from AzureCosmosDBNoSqlVectorSearch import AzureCosmosDBNoSqlVectorSearch
+from DocumentService import DocumentService, ProgressReporter
+from EmbeddingScheduler import EmbeddingScheduler, estimate_tokens
+from IngestionTelemetry import current_ingestion, ingestion_stage
+from IncrementalIndexing import ChunkOccurrences, assign_chunk_ids, diff_chunks, group_nodes_by_document
+from PIIDetection import iter_windows
 
 class LlamaIndexService:
 
@@ -12,29 +20,108 @@ class LlamaIndexService:
         self, 
         document_service: DocumentService,
         llm: AzureOpenAI, 
-        vector_store: VectorStore,
-        embed_model: AzureOpenAIEmbedding
+        vector_store: AzureCosmosDBNoSqlVectorSearch,
+        embed_model: AzureOpenAIEmbedding,
+        embedding_scheduler: Optional[EmbeddingScheduler] = None,
+        progress_interval: float = 2.0,
+        window_pages: int = 16
     ):
         self.__document_service = document_service
         self.__llm = llm
         self.__vector_store = vector_store
         self.__embed_model = embed_model
+        self.__embedding_scheduler = embedding_scheduler
+        self.__progress_interval = progress_interval
+        self.__window_pages = window_pages
 
     # Index the documents
     # feed in document update service
     def index_documents(self, loader: BaseReader) -> VectorStoreIndex:
-        
-        documents = loader.load_data()
-        self.__document_service.update_documents_status(documents, "Indexing")
-
-        storage_context = StorageContext.from_defaults(vector_store=self.__vector_store)
         Settings.llm = self.__llm
         Settings.embed_model = self.__embed_model
 
-        index = VectorStoreIndex.from_documents(
-            documents, storage_context=storage_context
-        )
+        # The pages are read, chunked, embedded and written a window at a time, so the memory
+        # used doesn't grow with the size of the file. Only the chunk ids are kept for the
+        # whole document, to drop the chunks of a previous version that are gone.
+        master_documents: Dict[Tuple[str, str], Document] = {}
+        existing_ids: Dict[Tuple[str, str], Set[str]] = {}
+        chunk_ids: Dict[Tuple[str, str], Set[str]] = {}
+        added_ids: Dict[Tuple[str, str], List[str]] = {}
+        occurrences: ChunkOccurrences = {}
+        progress = ProgressReporter(self.__document_service, [], 0, self.__progress_interval)
+        page = 0
+
+        try:
+            for window in iter_windows(loader.lazy_load_data(), self.__window_pages):
+                new_documents = []
+                for document in window:
+                    key = (document.metadata['user_principal_id'], document.metadata['master_document_id'])
+                    # the ids of the pages and chunks follow from the file and their text, so a new version
+                    # of a file only embeds and writes the chunks that changed and drops the ones that are gone
+                    document.id_ = f"{key[1]}-{page}"
+                    page += 1
+                    if key not in master_documents:
+                        master_documents[key] = document
+                        new_documents.append(document)
+                        existing_ids[key] = set(self.__vector_store.get_node_ids(key[1], partition_key=key[0]))
+                        chunk_ids[key] = set()
+                        added_ids[key] = []
+
+                if new_documents:
+                    self.__document_service.update_documents_status(new_documents, "Indexing")
+                    progress.documents.extend(new_documents)
+
+                with ingestion_stage("chunk") as counts:
+                    nodes = run_transformations(window, Settings.transformations)
+                    assign_chunk_ids(nodes, occurrences)
+                    counts["chunks"] = len(nodes)
+
+                for key, document_nodes in group_nodes_by_document(nodes).items():
+                    new_nodes, _ = diff_chunks(document_nodes, existing_ids[key])
+                    chunk_ids[key].update(node.node_id for node in document_nodes)
+                    progress.add_total(len(new_nodes))
+                    if not new_nodes:
+                        continue
+
+                    with ingestion_stage("embed") as counts:
+                        self.__embed_nodes(new_nodes, progress.advance)
+                        counts["chunks"] = len(new_nodes)
+                        counts["tokens"] = sum(estimate_tokens(node.get_content(metadata_mode=MetadataMode.EMBED)) for node in new_nodes)
+                    with ingestion_stage("upsert") as counts:
+                        self.__vector_store.add(new_nodes)
+                        added_ids[key].extend(node.node_id for node in new_nodes)
+                        counts["chunks"] = len(new_nodes)
+
+            # removed after the new chunks are written so the document is never without chunks
+            for key, ids in chunk_ids.items():
+                vanished_ids = list(existing_ids[key] - ids)
+                with ingestion_stage("upsert") as counts:
+                    self.__vector_store.delete_nodes(vanished_ids, partition_key=key[0])
+                    counts["deletedChunks"] = len(vanished_ids)
+        except Exception:
+            # PII or an error on a later page, the document keeps only the chunks of its previous version
+            self.__remove_added_chunks(added_ids)
+            raise
+
+        progress.flush()
+        telemetry = current_ingestion()
+        self.__document_service.update_documents_status(list(master_documents.values()), "Indexed", ingestion=telemetry.to_status() if telemetry else None)
+
+        return VectorStoreIndex.from_vector_store(self.__vector_store)
+
+    def __remove_added_chunks(self, added_ids: Dict[Tuple[str, str], List[str]]):
+        for (user_id, master_document_id), ids in added_ids.items():
+            try:
+                self.__vector_store.delete_nodes(ids, partition_key=user_id)
+            except Exception as e:
+                logging.error(f"Error removing the chunks written for document {master_document_id}: {e}")
 
-        self.__document_service.update_documents_status(documents, "Indexed")
+    def __embed_nodes(self, nodes: List[BaseNode], on_progress: Callable[[int], None]):
+        if self.__embedding_scheduler:
+            self.__embedding_scheduler.embed_nodes(nodes, on_progress)
+            return
 
-        return index
\ No newline at end of file
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        for node, embedding in zip(nodes, self.__embed_model.get_text_embedding_batch(texts)):
+            node.embedding = embedding
+        on_progress(len(nodes))
\ No newline at end of file
@@ -59,7 +59,8 @@ export const uploadedDocumentList = async (offset = 0): Promise<UploadedDocument
           id: doc.id,
           fileName: doc.file_name,
           conversationId: doc.conversation_id,
-          status: doc.status
+          status: doc.status,
+          progress: doc.progress ?? undefined
         };
       });
 
@@ -93,7 +94,8 @@ export const getDocumentStatuses = async (documentIds: Array<string>): Promise<U
           id: doc.id,
           fileName: doc.file_name,
           conversationId: doc.conversation_id,
-          status: doc.status
+          status: doc.status,
+          progress: doc.progress ?? undefined
         };
       });
 
@@ -106,6 +108,36 @@ export const getDocumentStatuses = async (documentIds: Array<string>): Promise<U
     return response
 }
 
+export const subscribeToDocumentStatuses = (
+  documentIds: Array<string>,
+  onUpdate: (documents: UploadedDocument[]) => void,
+  onError: () => void
+): (() => void) => {
+  const eventSource = new EventSource(`/documents/statuses/stream?documentIds=${encodeURIComponent(documentIds.join(','))}`)
+
+  eventSource.onmessage = event => {
+    const payload = JSON.parse(event.data)
+    const documents: Array<UploadedDocument> = payload.map((doc: any) => {
+      return {
+        id: doc.id,
+        fileName: doc.file_name,
+        conversationId: doc.conversation_id,
+        status: doc.status,
+        progress: doc.progress ?? undefined
+      };
+    });
+    onUpdate(documents)
+  }
+
+  eventSource.onerror = () => {
+    // the stream is not available (e.g. disabled on the server), let the caller fall back to polling
+    eventSource.close()
+    onError()
+  }
+
+  return () => eventSource.close()
+}
+
 export const historyList = async (offset = 0): Promise<Conversation[] | null> => {
   const response = await fetch(`/history/list?offset=${offset}`, {
     method: 'GET'
@@ -454,8 +486,9 @@ export const generateConversationPlaceholder = async (conversationTitle: string)
 export const uploadFile = async (file: File, conversationId?: string): Promise<UploadResponse> => {
   const formData = new FormData()
 
-  formData.append('file', file)
+  // conversationId has to precede the file, the upload is streamed to storage as it arrives
   formData.append('conversationId', conversationId || '')
+  formData.append('file', file)
 
   const response = await fetch('/upload', {
     method: 'POST',
@@ -61,11 +61,17 @@ export type Conversation = {
   date: string
 }
 
+export type DocumentProgress = {
+  embeddedChunks: number
+  totalChunks: number
+}
+
 export type UploadedDocument = {
   id: string,
   fileName: string,
   conversationId: string
   status: DocumentStatusState
+  progress?: DocumentProgress
 }
 
 export type PendingUploadedDocuments = UploadedDocument & {
@@ -91,6 +97,7 @@ export type ChatResponse = {
     conversation_id: string
     title: string
     date: string
+    persisted?: boolean
   }
   error?: any
 }
@@ -76,7 +76,7 @@ export const DocumentListItem: React.FC<Props> = ({ item, isSelected, onSelect }
                 <Checkbox checked={isSelected} onChange={(e, checked) => onSelect(item.id, checked || false)} disabled={ item.status != DocumentStatusState.Indexed} />
                 <div className={styles.fileDetail}>
                   <h6>{item.fileName}</h6>
-                  <p><span>Status: {item.status}</span></p>
+                  <p><span>Status: {item.status}{item.status == DocumentStatusState.Indexing && item.progress?.totalChunks ? ` (${Math.floor(100 * item.progress.embeddedChunks / item.progress.totalChunks)}%)` : ''}</span></p>
                 </div>
                 {(isSelected || isHovered) && (
                     <Stack horizontal horizontalAlign="end">
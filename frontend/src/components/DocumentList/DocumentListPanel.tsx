@@ -11,7 +11,7 @@ import {
 } from '@fluentui/react'
 
 import { DocumentListItem } from './DocumentListItem'
-import { UploadedDocument, uploadedDocumentList, UploadedDocumentLoadingState, getDocumentStatuses, DocumentStatusState } from '../../api'
+import { UploadedDocument, uploadedDocumentList, UploadedDocumentLoadingState, getDocumentStatuses, DocumentStatusState, subscribeToDocumentStatuses } from '../../api'
 import { AppStateContext } from '../../state/AppProvider'
 import styles from './DocumentListPanel.module.css'
 
@@ -40,6 +40,7 @@ export const DocumentListPanel: React.FC<Props> = ({conversationId}) => {
   const [filteredUploadedDocuments, setFilteredUploadedDocuments] = useState<UploadedDocument[]>([]);
   const [pendingDocumentStatuses, setPendingDocumentStatuses] = useState<Array<UploadedDocument>>([]);
   const [isPollingForStatus, setIsPollingForStatus] = useState<boolean>(false);
+  const [isStatusStreamAvailable, setIsStatusStreamAvailable] = useState<boolean>(true);
 
   const observerTarget = useRef(null)
   const firstRender = useRef(true)
@@ -78,8 +79,24 @@ export const DocumentListPanel: React.FC<Props> = ({conversationId}) => {
     appStateContext?.dispatch({ type: 'UPDATE_PENDING_DOCUMENTS', payload: documentStatusData });
   }, [appStateContext?.state.pendingDocuments]);
 
+  const pendingDocumentIds = appStateContext?.state.pendingDocuments?.map(doc => doc.id).join(',') ?? '';
+
+  useEffect(() => {
+    if (!isStatusStreamAvailable || pendingDocumentIds.length === 0) {
+      return;
+    }
+
+    const documentIds = pendingDocumentIds.split(',');
+    return subscribeToDocumentStatuses(
+      documentIds,
+      // the stream carries every status change of the user, only pick up the documents we are waiting for
+      documents => appStateContext?.dispatch({ type: 'UPDATE_PENDING_DOCUMENTS', payload: documents.filter(document => documentIds.includes(document.id)) }),
+      () => setIsStatusStreamAvailable(false)
+    );
+  }, [isStatusStreamAvailable, pendingDocumentIds]);
+
   useEffect(() => {
-    if (appStateContext?.state.pendingDocuments && appStateContext?.state.pendingDocuments.length > 0) {
+    if (!isStatusStreamAvailable && appStateContext?.state.pendingDocuments && appStateContext?.state.pendingDocuments.length > 0) {
       setIsPollingForStatus(true);
 
       const interval = setInterval(async() => {
@@ -89,7 +106,7 @@ export const DocumentListPanel: React.FC<Props> = ({conversationId}) => {
       return () => clearInterval(interval);
     }
 
-  }, [isPollingForStatus, appStateContext?.state.pendingDocuments, documentPollingStatus]);
+  }, [isStatusStreamAvailable, isPollingForStatus, appStateContext?.state.pendingDocuments, documentPollingStatus]);
 
   useEffect(() => {
     const missingPendingItems = appStateContext?.state.pendingDocuments?.filter(filteredItem => {
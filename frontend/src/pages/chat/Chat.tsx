@@ -57,6 +57,7 @@ const Chat = () => {
   const [isCitationPanelOpen, setIsCitationPanelOpen] = useState<boolean>(false);
   const [isIntentsPanelOpen, setIsIntentsPanelOpen] = useState<boolean>(false);
   const abortFuncs = useRef([] as AbortController[]);
+  const responsePersisted = useRef<boolean>(false);
   const [showAuthMessage, setShowAuthMessage] = useState<boolean | undefined>();
   const [messages, setMessages] = useState<ChatMessage[]>([]);
   const [execResults, setExecResults] = useState<ExecResults[]>([]);
@@ -390,6 +391,7 @@ const Chat = () => {
         const reader = response.body.getReader()
 
         let runningText = ''
+        responsePersisted.current = false
         while (true) {
           setProcessMessages(messageStatus.Processing)
           const { done, value } = await reader.read()
@@ -401,7 +403,14 @@ const Chat = () => {
             try {
               if (obj !== '' && obj !== '{}') {
                 runningText += obj
-                result = JSON.parse(runningText)
+                const parsed = JSON.parse(runningText)
+                if (!parsed.choices && parsed.history_metadata) {
+                  // sent after the stream once the server has stored the messages of this turn
+                  responsePersisted.current = !!parsed.history_metadata.persisted
+                  runningText = ''
+                  return
+                }
+                result = parsed
                 if (!result.choices?.[0]?.messages?.[0].content) {
                   errorResponseMessage = NO_CONTENT_ERROR
                   throw Error()
@@ -433,6 +442,9 @@ const Chat = () => {
           })
         }
 
+        // the server already stored the assistant and tool messages for this turn
+        responsePersisted.current = responsePersisted.current || !!result.history_metadata?.persisted
+
         let resultConversation
         if (conversationId) {
           resultConversation = appStateContext?.state?.chatHistory?.find(conv => conv.id === conversationId)
@@ -662,7 +674,7 @@ const Chat = () => {
         }
         const noContentError = appStateContext.state.currentChat.messages.find(m => m.role === ERROR)
 
-        if (!noContentError) {
+        if (!noContentError && !responsePersisted.current) {
           saveToDB(appStateContext.state.currentChat.messages, appStateContext.state.currentChat.id)
             .then(res => {
               if (!res.ok) {
@@ -697,6 +709,7 @@ const Chat = () => {
         }
       } else {
       }
+      responsePersisted.current = false
       appStateContext?.dispatch({ type: 'UPDATE_CHAT_HISTORY', payload: appStateContext.state.currentChat })
       setMessages(appStateContext.state.currentChat.messages)
       setProcessMessages(messageStatus.NotRunning)
@@ -0,0 +1,130 @@
+import pytest
+from azure.cosmos.partition_key import NonePartitionKeyValue
+
+from backend.context.chunk_vector_cache import ChunkVectorCache, search_document_vectors
+from backend.context.document_chunk_context import DocumentChunkContext
+
+
+def chunk(text, vector, file_name="a.pdf"):
+    return {
+        'file_name': file_name,
+        'text': text,
+        'payload': None,
+        'contentVector': vector,
+    }
+
+
+def test_search_ranks_chunks_across_documents_by_cosine_similarity():
+    cache = ChunkVectorCache()
+    first = cache.put("user-1", "doc-1", [chunk("x", [1.0, 0.0]), chunk("y", [0.0, 2.0])])
+    second = cache.put("user-1", "doc-2", [chunk("xy", [3.0, 3.0], "b.pdf")])
+
+    documents = search_document_vectors([first, second], [1.0, 0.0], top_k=2)
+
+    assert [document['text'] for document in documents] == ["x", "xy"]
+    assert documents[0]['SimilarityScore'] == pytest.approx(1.0)
+    assert documents[1]['SimilarityScore'] == pytest.approx(0.7071, abs=1e-4)
+    assert documents[1]['file_name'] == "b.pdf"
+
+
+def test_search_without_chunks_returns_nothing():
+    cache = ChunkVectorCache()
+    empty = cache.put("user-1", "doc-1", [])
+
+    assert search_document_vectors([empty], [1.0, 0.0]) == []
+
+
+def test_documents_over_the_chunk_limit_are_marked_too_large():
+    cache = ChunkVectorCache(max_chunks_per_document=1)
+
+    entry = cache.put("user-1", "doc-1", [chunk("x", [1.0, 0.0]), chunk("y", [0.0, 1.0])])
+
+    assert entry is ChunkVectorCache.TOO_LARGE
+    assert cache.get("user-1", "doc-1") is ChunkVectorCache.TOO_LARGE
+    assert cache.size_bytes == 0
+
+
+def test_least_recently_used_documents_are_evicted_over_budget():
+    cache = ChunkVectorCache(max_bytes=20)
+    cache.put("user-1", "doc-1", [chunk("", [1.0, 0.0])])
+    cache.put("user-1", "doc-2", [chunk("", [1.0, 0.0])])
+    cache.get("user-1", "doc-1")
+
+    cache.put("user-1", "doc-3", [chunk("", [1.0, 0.0])])
+
+    assert cache.get("user-1", "doc-2") is None
+    assert cache.get("user-1", "doc-1") is not None
+    assert cache.size_bytes == 16
+
+
+def test_expired_entries_are_dropped():
+    cache = ChunkVectorCache(ttl=-1)
+    cache.put("user-1", "doc-1", [chunk("x", [1.0, 0.0])])
+
+    assert cache.get("user-1", "doc-1") is None
+    assert cache.size_bytes == 0
+
+
+def test_expired_too_large_markers_are_dropped():
+    cache = ChunkVectorCache(ttl=-1, max_chunks_per_document=0)
+    cache.put("user-1", "doc-1", [chunk("x", [1.0, 0.0])])
+
+    assert cache.get("user-1", "doc-1") is None
+
+
+class FakeDocumentChunkContext(DocumentChunkContext):
+    def __init__(self, chunks):
+        self.vector_cache = ChunkVectorCache()
+        self.chunks = chunks
+        self.queries = 0
+
+    async def query_user_chunks(self, user_id, query, parameters):
+        self.queries += 1
+        return self.chunks
+
+
+@pytest.mark.asyncio
+async def test_only_indexed_documents_are_cached():
+    context = FakeDocumentChunkContext([chunk("x", [1.0, 0.0])])
+
+    assert await context.get_cached_document_vectors("user-1", ["doc-1"], indexed_document_ids=set()) is None
+    assert context.vector_cache.get("user-1", "doc-1") is None and context.queries == 0
+
+    entries = await context.get_cached_document_vectors("user-1", ["doc-1"], indexed_document_ids={"doc-1"})
+    assert len(entries) == 1 and context.vector_cache.get("user-1", "doc-1") is entries[0]
+
+    ## indexing a new version of the document drops the cached one
+    assert await context.get_cached_document_vectors("user-1", ["doc-1"], indexed_document_ids=set()) is None
+    assert context.vector_cache.get("user-1", "doc-1") is None
+
+
+class FakeChunkContainer:
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.partition_keys = []
+
+    async def query_items(self, query, parameters, partition_key):
+        self.partition_keys.append(partition_key)
+        for item in self.partitions.get(partition_key, []):
+            yield item
+
+
+@pytest.mark.asyncio
+async def test_user_chunks_are_merged_with_chunks_pending_migration():
+    container = FakeChunkContainer({
+        "user-1": [{'id': "a", 'SimilarityScore': 0.5}, {'id': "b", 'SimilarityScore': 0.2}],
+        NonePartitionKeyValue: [{'id': "b", 'SimilarityScore': 0.2}, {'id': "c", 'SimilarityScore': 0.9}],
+    })
+    context = DocumentChunkContext.__new__(DocumentChunkContext)
+    context.client_container = container
+
+    context.legacy_chunks_migration_pending = True
+    documents = await context.query_user_chunks("user-1", "query", [], top=2)
+    assert [document['id'] for document in documents] == ["c", "a"]
+
+    ## once the chunks are migrated only the user partition is read
+    context.legacy_chunks_migration_pending = False
+    container.partition_keys.clear()
+    documents = await context.query_user_chunks("user-1", "query", [])
+    assert [document['id'] for document in documents] == ["a", "b"]
+    assert container.partition_keys == ["user-1"]
@@ -0,0 +1,169 @@
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos import exceptions
+
+from backend.history.conversation_archive import (
+    create_archive_stub,
+    deserialize_archive,
+    get_archive_blob_name,
+    serialize_archive
+)
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+
+def test_archive_round_trip_drops_system_properties():
+    conversation = {'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'title': "hello", '_etag': "1"}
+    messages = [
+        {'id': "1", 'type': "message", 'content': "hi", '_rid': "a"},
+        {'id': "2", 'type': "message", 'content': "how can I help?", '_rid': "b"},
+    ]
+
+    restored_conversation, restored_messages = deserialize_archive(serialize_archive(conversation, messages))
+
+    assert restored_conversation == {'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'title': "hello"}
+    assert [message['id'] for message in restored_messages] == ["1", "2"]
+    assert all('_rid' not in message for message in restored_messages)
+
+
+def test_archive_stub_keeps_listing_fields():
+    conversation = {'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'title': "hello", 'updatedAt': "2024-01-01", 'messageLayout': "bucketed", 'bucketCount': 2, '_etag': "1"}
+    blob_name = get_archive_blob_name("user-1", "conversation-1")
+
+    stub = create_archive_stub(conversation, blob_name, 3, "2024-06-01")
+
+    assert stub['archived'] is True
+    assert stub['archiveBlob'] == "user-1/conversation-1.jsonl.gz"
+    assert stub['title'] == "hello" and stub['updatedAt'] == "2024-01-01"
+    assert 'messageLayout' not in stub and '_etag' not in stub
+
+
+class FakeContainer():
+    def __init__(self, operations, items):
+        self.operations = operations
+        self.items = items
+
+    def store(self, item):
+        item = {**item, '_etag': str(int(self.items.get(item['id'], {}).get('_etag', 0)) + 1)}
+        self.items[item['id']] = item
+        return dict(item)
+
+    async def upsert_item(self, item):
+        self.operations.append(("upsert", item['id']))
+        return self.store(item)
+
+    async def create_item(self, item):
+        if item['id'] in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="exists")
+        self.operations.append(("create", item['id']))
+        return self.store(item)
+
+    async def replace_item(self, item, body, etag, match_condition):
+        if self.items[item]['_etag'] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        self.operations.append(("replace", item))
+        return self.store(body)
+
+    async def read_item(self, item, partition_key):
+        return dict(self.items[item])
+
+
+class FakeDownloader():
+    def __init__(self, data):
+        self.data = data
+
+    async def readall(self):
+        return self.data
+
+
+class FakeArchiveContainer():
+    def __init__(self, operations, blobs):
+        self.operations = operations
+        self.blobs = blobs
+
+    def get_blob_client(self, blob_name):
+        archive = self
+
+        class BlobClient():
+            async def download_blob(self):
+                if blob_name not in archive.blobs:
+                    raise ResourceNotFoundError("not found")
+                return FakeDownloader(archive.blobs[blob_name])
+
+        return BlobClient()
+
+    async def delete_blob(self, blob_name):
+        self.operations.append(("delete", blob_name))
+
+
+class FakeConversationClient(CosmosConversationClient):
+    def __init__(self, blobs):
+        self.operations = []
+        self.items = {}
+        self.enable_message_buckets = False
+        self.write_queue = None
+        self.archive_container_client = FakeArchiveContainer(self.operations, blobs)
+
+    def create_chat_container_client(self):
+        return FakeContainer(self.operations, self.items)
+
+
+def archived_conversation():
+    conversation = {'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'title': "hello"}
+    blob_name = get_archive_blob_name("user-1", "conversation-1")
+    return {**create_archive_stub(conversation, blob_name, 1, "2024-06-01"), '_etag': "1"}, blob_name
+
+
+@pytest.mark.asyncio
+async def test_restore_writes_the_messages_back_before_the_stub_and_the_archive():
+    stub, blob_name = archived_conversation()
+    client = FakeConversationClient({ blob_name: serialize_archive(stub, [{'id': "1", 'type': "message", 'content': "hi"}]) })
+    client.items[stub['id']] = stub
+
+    restored = await client.restore_conversation("user-1", stub)
+
+    assert client.operations == [("create", "1"), ("replace", "conversation-1"), ("delete", blob_name)]
+    assert 'archived' not in restored and stub['archived'] is True
+
+
+@pytest.mark.asyncio
+async def test_restore_without_the_archive_keeps_the_conversation_archived():
+    stub, _ = archived_conversation()
+    client = FakeConversationClient({})
+
+    with pytest.raises(ValueError):
+        await client.restore_conversation("user-1", stub)
+
+    assert client.operations == []
+
+
+@pytest.mark.asyncio
+async def test_a_concurrent_restore_is_not_repeated():
+    stub, blob_name = archived_conversation()
+    client = FakeConversationClient({ blob_name: serialize_archive(stub, [{'id': "1", 'type': "message", 'content': "hi"}]) })
+    client.items[stub['id']] = stub
+    await client.restore_conversation("user-1", stub)
+    client.operations.clear()
+
+    restored = await client.restore_conversation("user-1", stub)
+
+    assert 'archived' not in restored
+    assert client.operations == []
+
+
+@pytest.mark.asyncio
+async def test_a_message_never_overwrites_the_archive_stub():
+    conversation = {'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'title': "hello", 'updatedAt': "2024-01-01"}
+    client = FakeConversationClient({})
+    conversation = await client.create_chat_container_client().upsert_item(conversation)
+
+    ## archived while the message is written
+    blob_name = get_archive_blob_name("user-1", "conversation-1")
+    client.archive_container_client.blobs[blob_name] = serialize_archive(conversation, [{'id': "1", 'type': "message", 'content': "hi"}])
+    client.items["conversation-1"] = {**create_archive_stub(conversation, blob_name, 1, "2024-06-01"), '_etag': "5"}
+    client.operations.clear()
+
+    await client.update_conversation_timestamp("user-1", conversation, {'id': "2", 'type': "message", 'createdAt': "2024-07-01"})
+
+    assert 'archived' not in client.items["conversation-1"]
+    assert client.items["conversation-1"]['updatedAt'] == "2024-07-01"
+    assert [operation for operation in client.operations if operation[0] != "replace"] == [("create", "1"), ("delete", blob_name), ("upsert", "2")]
@@ -0,0 +1,124 @@
+import pytest
+from azure.cosmos import exceptions
+
+from DocumentManifest import MAX_MANIFEST_DOCUMENTS, create_manifest, get_user_manifest_id
+from DocumentService import DocumentService
+from backend.context.document_manifest import get_user_manifest_id as get_backend_user_manifest_id
+from backend.context.document_status_context import DocumentStatusContext
+
+
+def status(id, status="Indexed", **fields):
+    return {'id': id, 'user_principal_id': "user-1", 'conversation_id': "conversation-1", 'file_name': f"{id}.pdf", 'status': status, 'content_hash': f"hash-{id}", **fields}
+
+
+def test_backend_and_content_loading_share_the_manifest_ids():
+    assert get_backend_user_manifest_id("user-1") == get_user_manifest_id("user-1")
+
+
+def test_a_manifest_over_the_limit_is_created_incomplete():
+    documents = [status(str(i)) for i in range(MAX_MANIFEST_DOCUMENTS + 1)]
+
+    manifest = create_manifest(get_user_manifest_id("user-1"), "user-1", documents)
+
+    assert manifest['complete'] is False and manifest['documents'] == {}
+    assert create_manifest(get_user_manifest_id("user-1"), "user-1", documents[:2])['documentCount'] == 2
+
+
+class FakeStatusContainer():
+    def __init__(self, items):
+        self.items = items
+        self.patched = []
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        self.patched.append(item)
+        for operation in patch_operations:
+            path = operation['path'].strip('/').split('/')
+            target = self.items[item]
+            for key in path[:-1]:
+                target = target[key]
+            target[path[-1]] = operation['value']
+        return dict(self.items[item])
+
+    def query_items(self, query, parameters, partition_key):
+        return [dict(item) for item in self.items.values() if 'status' in item]
+
+    def create_item(self, body):
+        if body['id'] in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="exists")
+        self.items[body['id']] = body
+        return body
+
+
+class FakeDocument():
+    def __init__(self, id):
+        self.metadata = {'master_document_id': id, 'user_principal_id': "user-1", 'conversation_id': "conversation-1"}
+
+
+def test_a_status_change_seeds_a_missing_manifest():
+    container = FakeStatusContainer({"doc-1": status("doc-1", "Indexing"), "doc-2": status("doc-2")})
+    document_service = DocumentService(container)
+
+    document_service.update_document_status(FakeDocument("doc-1"), "Indexed")
+
+    manifest = container.items[get_user_manifest_id("user-1")]
+    assert {id: document['status'] for id, document in manifest['documents'].items()} == {"doc-1": "Indexed", "doc-2": "Indexed"}
+
+
+def test_progress_is_not_written_to_the_manifests():
+    container = FakeStatusContainer({"doc-1": status("doc-1", "Indexing")})
+    document_service = DocumentService(container)
+
+    document_service.update_documents_progress([FakeDocument("doc-1")], {'embedded': 1, 'total': 2})
+
+    assert container.patched == ["doc-1"]
+
+
+class FakeAsyncStatusContainer():
+    def __init__(self, items):
+        self.items = items
+        self.queried_ids = None
+
+    async def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return self.items[item]
+
+    async def query_items(self, query, parameters):
+        self.queried_ids = parameters[0]['value']
+        for id in self.queried_ids:
+            yield self.items[id]
+
+
+@pytest.mark.asyncio
+async def test_documents_being_indexed_are_read_from_their_status():
+    items = {
+        "doc-1": status("doc-1"),
+        "doc-2": status("doc-2", "Indexing", progress={'embedded': 1, 'total': 2}),
+    }
+    items[get_user_manifest_id("user-1")] = create_manifest(get_user_manifest_id("user-1"), "user-1", list(items.values()))
+    context = DocumentStatusContext.__new__(DocumentStatusContext)
+    context.client_container = FakeAsyncStatusContainer(items)
+
+    documents = await context.get_documents_statuses("user-1", ["doc-1", "doc-2"])
+
+    assert context.client_container.queried_ids == ["doc-2"]
+    assert [document['id'] for document in documents] == ["doc-1", "doc-2"]
+    assert documents[1]['progress'] == {'embedded': 1, 'total': 2}
+
+
+@pytest.mark.asyncio
+async def test_uploaded_documents_carry_the_progress_of_documents_being_indexed():
+    items = {
+        "doc-1": status("doc-1", createdAt="1"),
+        "doc-2": status("doc-2", "Indexing", createdAt="2", progress={'embedded': 1, 'total': 2}),
+    }
+    items[get_user_manifest_id("user-1")] = create_manifest(get_user_manifest_id("user-1"), "user-1", list(items.values()))
+    context = DocumentStatusContext.__new__(DocumentStatusContext)
+    context.client_container = FakeAsyncStatusContainer(items)
+
+    documents = await context.get_uploaded_documents("user-1", None)
+
+    assert context.client_container.queried_ids == ["doc-2"]
+    assert [document.get('progress') for document in documents] == [None, {'embedded': 1, 'total': 2}]
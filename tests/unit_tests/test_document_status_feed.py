@@ -0,0 +1,45 @@
+import pytest
+from backend.context.document_status_feed import DocumentStatusFeed
+
+
+class FakeChangeFeedContainer:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+        self.client_connection = self
+        self.last_response_headers = {}
+
+    def query_items_change_feed(self, **kwargs):
+        self.calls.append(kwargs)
+        items = self.pages.pop(0)
+        self.last_response_headers = {'etag': f"continuation-{len(self.calls)}"}
+
+        async def changes():
+            for item in items:
+                yield item
+        return changes()
+
+
+def status(id, user_id, value):
+    return {'id': id, 'user_principal_id': user_id, 'conversation_id': "conversation-1", 'file_name': "report.pdf", 'status': value, '_etag': "1"}
+
+
+@pytest.mark.asyncio
+async def test_changes_are_pushed_to_the_owning_user_only():
+    feed = DocumentStatusFeed("https://localhost:8081/", "key", "db", "document_status")
+    feed.client_container = FakeChangeFeedContainer([
+        [status("1", "user-1", "Indexing"), status("2", "user-2", "Indexing")],
+        [status("1", "user-1", "Indexed")]
+    ])
+    queue = feed.subscribe("user-1")
+
+    await feed._read_changes()
+    await feed._read_changes()
+
+    assert [queue.get_nowait()['status'] for _ in range(queue.qsize())] == ["Indexing", "Indexed"]
+    assert 'start_time' in feed.client_container.calls[0]
+    assert feed.client_container.calls[1] == {'continuation': "continuation-1"}
+
+    feed.unsubscribe("user-1", queue)
+    assert not feed._has_subscribers.is_set()
+    await feed.cosmosdb_client.close()
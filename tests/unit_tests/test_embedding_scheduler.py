@@ -0,0 +1,108 @@
+import httpx
+import pytest
+from types import SimpleNamespace
+from openai import APITimeoutError, InternalServerError
+
+from EmbeddingScheduler import MAX_TRANSIENT_RETRY_DELAY, EmbeddingScheduler, TokenBucket, get_backoff, get_retry_after, estimate_tokens
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_without_limit_lets_everything_through():
+    bucket = TokenBucket()
+
+    assert bucket.try_acquire(1_000_000) == 0
+
+
+def test_bucket_refills_at_the_per_minute_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(600, clock=clock)
+
+    assert bucket.try_acquire(600) == 0
+    assert bucket.try_acquire(100) == pytest.approx(10)
+
+    clock.now = 10
+    assert bucket.try_acquire(100) == 0
+
+
+def test_bucket_follows_remaining_tokens_header():
+    clock = FakeClock()
+    bucket = TokenBucket(1000, clock=clock)
+
+    bucket.update(remaining=100)
+
+    assert bucket.try_acquire(200) == pytest.approx(6)
+
+
+def test_bucket_learns_capacity_from_headers():
+    clock = FakeClock()
+    bucket = TokenBucket(clock=clock)
+
+    bucket.update(remaining=120, limit=None)
+
+    assert bucket.capacity == 120
+    assert bucket.try_acquire(120) == 0
+    assert bucket.try_acquire(60) == pytest.approx(30)
+
+
+def test_pause_blocks_until_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(clock=clock)
+
+    bucket.pause(5)
+
+    assert bucket.try_acquire(1) == pytest.approx(5)
+    clock.now = 5
+    assert bucket.try_acquire(1) == 0
+
+
+def test_retry_after_prefers_milliseconds():
+    assert get_retry_after({"retry-after-ms": "1500", "retry-after": "2"}) == 1.5
+    assert get_retry_after({"retry-after": "2"}) == 2
+    assert get_retry_after({}, default=7) == 7
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 1
+    assert estimate_tokens("a" * 400) == 100
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    assert [get_backoff(attempt) for attempt in range(4)] == [1.0, 2.0, 4.0, 8.0]
+    assert get_backoff(10) == MAX_TRANSIENT_RETRY_DELAY
+
+
+class FlakyEmbeddings():
+    def __init__(self, errors):
+        self.errors = errors
+        self.calls = 0
+        self.with_raw_response = self
+
+    async def create(self, input, model):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        data = [SimpleNamespace(index=index, embedding=[float(index)]) for index in range(len(input))]
+        return SimpleNamespace(headers={}, parse=lambda: SimpleNamespace(data=data))
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr("EmbeddingScheduler.TRANSIENT_RETRY_DELAY", 0.0)
+    request = httpx.Request("POST", "https://example.openai.azure.com/embeddings")
+    embeddings = FlakyEmbeddings([
+        APITimeoutError(request),
+        InternalServerError("Internal Server Error", response=httpx.Response(500, request=request), body=None),
+    ])
+    scheduler = EmbeddingScheduler(client_factory=None, deployment_name="embedding")
+
+    result = await scheduler.embed_texts(SimpleNamespace(embeddings=embeddings), ["a", "b"])
+
+    assert result == [[0.0], [1.0]]
+    assert embeddings.calls == 3
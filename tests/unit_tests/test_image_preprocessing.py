@@ -0,0 +1,91 @@
+import io
+
+from PIL import Image
+
+from image_model_reader import DescriptionCache, ImageModelReader, get_target_size, prepare_image
+
+
+def encode(image: Image.Image, format: str) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format=format)
+    return output.getvalue()
+
+
+def test_target_size():
+    assert get_target_size(4000, 3000) == (1024, 768)
+    assert get_target_size(3000, 500) == (2048, 341)
+    assert get_target_size(640, 480) == (640, 480)
+
+
+def test_large_image_is_downscaled_to_jpeg():
+    data = encode(Image.new("RGB", (4000, 3000), "white"), "PNG")
+
+    prepared, mime_type = prepare_image(data, "image/png")
+
+    assert mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(prepared)).size == (1024, 768)
+
+
+def test_transparent_image_stays_png():
+    data = encode(Image.new("RGBA", (3000, 1000), (0, 0, 0, 0)), "PNG")
+
+    prepared, mime_type = prepare_image(data, "image/png")
+
+    assert mime_type == "image/png"
+    assert Image.open(io.BytesIO(prepared)).size == (2048, 683)
+
+
+def test_undecodable_image_is_unchanged():
+    assert prepare_image(b"not an image", "image/png") == (b"not an image", "image/png")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = DescriptionCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+
+    assert cache.get("a") == "A"
+    assert cache.get("b") is None
+
+
+class FakeCompletions():
+    def __init__(self):
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        message = type("Message", (), {"content": "a white square"})
+        return type("Completion", (), {"choices": [type("Choice", (), {"message": message})]})
+
+
+class FakeClient():
+    def __init__(self):
+        self.chat = type("Chat", (), {"completions": FakeCompletions()})
+
+
+def test_identical_images_are_described_once(tmp_path):
+    for name in ["first.png", "second.png"]:
+        Image.new("RGB", (64, 64), "white").save(tmp_path / name)
+    client = FakeClient()
+    reader = ImageModelReader(client, deployment_name="vision", max_tokens=300, max_concurrency=1, cache=DescriptionCache())
+
+    documents = reader.load_images([str(tmp_path / "first.png"), str(tmp_path / "second.png")])
+
+    assert [document.text for document in documents] == ["a white square", "a white square"]
+    assert len(client.chat.completions.calls) == 1
+    assert client.chat.completions.calls[0]["model"] == "vision"
+    assert client.chat.completions.calls[0]["max_tokens"] == 300
+
+
+def test_image_is_rotated_by_its_exif_orientation():
+    image = Image.new("RGB", (200, 100), "white")
+    exif = image.getexif()
+    exif[0x0112] = 6  # rotated 90 degrees clockwise
+    output = io.BytesIO()
+    image.save(output, format="JPEG", exif=exif)
+
+    prepared, _ = prepare_image(output.getvalue(), "image/jpeg")
+
+    assert Image.open(io.BytesIO(prepared)).size == (100, 200)
@@ -0,0 +1,96 @@
+from llama_index.core.schema import TextNode
+
+from AzureCosmosDBNoSqlVectorSearch import AzureCosmosDBNoSqlVectorSearch
+from IncrementalIndexing import assign_chunk_ids, diff_chunks, get_chunk_id, group_nodes_by_document
+from backend.context.document_chunk_context import get_chunk_id as get_backend_chunk_id
+
+
+def node(text, master_document_id="doc-1", user_id="user-1"):
+    return TextNode(text=text, metadata={"master_document_id": master_document_id, "user_principal_id": user_id})
+
+
+def test_chunk_ids_are_stable_across_versions():
+    first = [node("intro"), node("body")]
+    second = [node("intro"), node("changed body")]
+
+    assign_chunk_ids(first)
+    assign_chunk_ids(second)
+
+    assert first[0].node_id == second[0].node_id
+    assert first[1].node_id != second[1].node_id
+
+
+def test_repeated_texts_get_distinct_ids():
+    nodes = [node("header"), node("header")]
+
+    assign_chunk_ids(nodes)
+
+    assert nodes[0].node_id != nodes[1].node_id
+
+
+def test_chunk_ids_depend_on_the_document():
+    nodes = [node("same", "doc-1"), node("same", "doc-2")]
+
+    assign_chunk_ids(nodes)
+
+    assert nodes[0].node_id != nodes[1].node_id
+
+
+def test_backend_clones_use_the_same_ids():
+    assert get_chunk_id("doc-1", "text", 2) == get_backend_chunk_id("doc-1", "text", 2)
+
+
+def test_diff_chunks():
+    old = [node("kept"), node("removed")]
+    new = [node("kept"), node("added")]
+    assign_chunk_ids(old)
+    assign_chunk_ids(new)
+
+    new_nodes, vanished_ids = diff_chunks(new, {n.node_id for n in old})
+
+    assert [n.text for n in new_nodes] == ["added"]
+    assert vanished_ids == [old[1].node_id]
+
+
+def test_group_nodes_by_document():
+    nodes = [node("a", "doc-1"), node("b", "doc-2"), node("c", "doc-1")]
+
+    groups = group_nodes_by_document(nodes)
+
+    assert [n.text for n in groups[("user-1", "doc-1")]] == ["a", "c"]
+    assert [n.text for n in groups[("user-1", "doc-2")]] == ["b"]
+
+
+class FakeChunkContainer():
+    def __init__(self, items):
+        self.items = items
+        self.batches = []
+
+    def get_database_client(self, database_name):
+        return self
+
+    def get_container_client(self, container_name):
+        return self
+
+    def query_items(self, query, parameters, enable_cross_partition_query=False):
+        assert enable_cross_partition_query
+        node_ids = parameters[0]['value']
+        return [{'id': item['id'], 'partitionKey': item['userId']} for item in self.items if item['id'] in node_ids]
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        self.batches.append((partition_key, sorted(node_id for _, (node_id,) in batch_operations)))
+
+
+def test_nodes_are_deleted_from_their_partitions_without_a_partition_key():
+    container = FakeChunkContainer([{'id': "1", 'userId': "user-1"}, {'id': "2", 'userId': "user-2"}, {'id': "3", 'userId': "user-1"}])
+    vector_store = AzureCosmosDBNoSqlVectorSearch(
+        cosmos_client=container,
+        vector_embedding_policy={'vectorEmbeddings': [{'path': "/embedding"}]},
+        indexing_policy={},
+        cosmos_container_properties={'partition_key': {'paths': ["/userId"]}},
+        create_container=False,
+    )
+
+    vector_store.delete_nodes(["1", "2", "3"])
+
+    assert sorted(container.batches) == [("user-1", ["1", "3"]), ("user-2", ["2"])]
@@ -0,0 +1,104 @@
+import base64
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from IngestionQueue import MAX_DEQUEUE_COUNT, complete_message, create_blob_created_event, decode_message, get_blob_path, get_message_blob_path, keep_invisible, process_blobs
+
+
+def test_decode_plain_and_base64_messages():
+    event = {"eventType": "Microsoft.Storage.BlobCreated"}
+
+    assert decode_message(json.dumps(event)) == event
+    assert decode_message(base64.b64encode(json.dumps(event).encode("utf-8")).decode("utf-8")) == event
+
+
+def test_blob_path_of_blob_created_events():
+    assert get_blob_path(create_blob_created_event("https://account.blob.core.windows.net", "documents", "my%20report.pdf")) == "documents/my report.pdf"
+    assert get_blob_path(create_blob_created_event("http://127.0.0.1:10000/devstoreaccount1", "documents", "report.pdf")) == "documents/report.pdf"
+    assert get_blob_path({"type": "Microsoft.Storage.BlobCreated", "data": {"url": "https://account.blob.core.windows.net/documents/report.pdf"}}) == "documents/report.pdf"
+    assert get_blob_path({"eventType": "Microsoft.Storage.BlobDeleted", "data": {"url": "https://account.blob.core.windows.net/documents/report.pdf"}}) is None
+
+
+def test_invalid_messages_are_ignored():
+    assert get_message_blob_path("not an event") is None
+    assert get_message_blob_path(json.dumps({"eventType": "Microsoft.Storage.BlobCreated"})) is None
+
+
+def test_blobs_are_processed_with_bounded_concurrency():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def process(blob_path):
+        with lock:
+            running.append(blob_path)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(blob_path)
+        if blob_path == "documents/bad.pdf":
+            raise ValueError("bad")
+
+    errors = process_blobs([f"documents/{i}.pdf" for i in range(8)] + ["documents/bad.pdf"], process, max_concurrency=3)
+
+    assert max(peak) <= 3
+    assert isinstance(errors.pop("documents/bad.pdf"), ValueError)
+    assert all(error is None for error in errors.values())
+
+
+class FakeQueueClient():
+    def __init__(self):
+        self.deleted = []
+        self.sent = []
+        self.updated = []
+
+    def create_queue(self):
+        pass
+
+    def delete_message(self, message):
+        self.deleted.append(message)
+
+    def send_message(self, content):
+        self.sent.append(content)
+
+    def update_message(self, message, visibility_timeout):
+        self.updated.append((message.pop_receipt, visibility_timeout))
+        return SimpleNamespace(pop_receipt=f"receipt-{len(self.updated)}", next_visible_on=None)
+
+
+class FakeMessage():
+    def __init__(self, dequeue_count):
+        self.id = "1"
+        self.content = "event"
+        self.dequeue_count = dequeue_count
+        self.pop_receipt = "receipt-0"
+
+
+def test_failed_messages_are_retried_then_poisoned():
+    queue_client, poison_queue_client = FakeQueueClient(), FakeQueueClient()
+
+    complete_message(queue_client, poison_queue_client, FakeMessage(1), ValueError())
+    assert queue_client.deleted == [] and poison_queue_client.sent == []
+
+    complete_message(queue_client, poison_queue_client, FakeMessage(MAX_DEQUEUE_COUNT), ValueError())
+    assert len(queue_client.deleted) == 1 and poison_queue_client.sent == ["event"]
+
+    complete_message(queue_client, poison_queue_client, FakeMessage(1), None)
+    assert len(queue_client.deleted) == 2
+
+
+def test_messages_are_kept_invisible_while_processing():
+    queue_client = FakeQueueClient()
+    message = FakeMessage(1)
+
+    with keep_invisible(queue_client, [message], visibility_timeout=0.02):
+        time.sleep(0.1)
+    renewals = len(queue_client.updated)
+    time.sleep(0.05)
+
+    assert renewals >= 2 and len(queue_client.updated) == renewals
+    assert queue_client.updated[0] == ("receipt-0", 0.02)
+    # the message is deleted with the receipt of the last renewal
+    assert message.pop_receipt == f"receipt-{renewals}"
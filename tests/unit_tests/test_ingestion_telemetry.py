@@ -0,0 +1,68 @@
+import pytest
+
+from IngestionTelemetry import IngestionTelemetry, current_ingestion, ingestion_stage, summarize, track_ingestion
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_repeated_stages_accumulate():
+    clock = FakeClock()
+    telemetry = IngestionTelemetry("documents/user/report.PDF", clock=clock)
+
+    for chunks in [3, 5]:
+        with telemetry.stage("embed") as counts:
+            clock.now += 1.5
+            counts["chunks"] = chunks
+
+    status = telemetry.to_status()
+    assert status["fileType"] == ".pdf"
+    assert status["totalSeconds"] == 3.0
+    assert status["stages"] == {"embed": {"seconds": 3.0, "chunks": 8}}
+
+
+def test_failed_stage_is_recorded():
+    clock = FakeClock()
+    telemetry = IngestionTelemetry("report.docx", clock=clock)
+
+    with pytest.raises(ValueError):
+        with telemetry.stage("parse"):
+            clock.now += 2
+            raise ValueError()
+
+    assert telemetry.stages["parse"]["seconds"] == 2
+
+
+def test_stages_are_recorded_on_the_current_ingestion():
+    with ingestion_stage("download") as counts:
+        counts["bytes"] = 10
+    assert current_ingestion() is None
+
+    with track_ingestion("report.pdf") as telemetry:
+        with ingestion_stage("download") as counts:
+            counts["bytes"] = 10
+        assert current_ingestion() is telemetry
+
+    assert current_ingestion() is None
+    assert telemetry.stages["download"]["bytes"] == 10
+
+
+def test_summarize_per_file_type():
+    ingestions = [
+        {"fileType": ".pdf", "totalSeconds": 4.0, "stages": {"download": {"seconds": 1.0, "bytes": 1048576}, "embed": {"seconds": 2.0, "tokens": 100}}},
+        {"fileType": ".pdf", "totalSeconds": 8.0, "stages": {"download": {"seconds": 1.0, "bytes": 3145728}, "embed": {"seconds": 6.0, "tokens": 300}}},
+        {"fileType": ".png", "totalSeconds": 3.0, "stages": {"parse": {"seconds": 3.0}}},
+    ]
+
+    summary = summarize(ingestions)
+
+    assert summary[".pdf"]["total"]["count"] == 2
+    assert summary[".pdf"]["total"]["p95Seconds"] == 8.0
+    assert summary[".pdf"]["download"]["mbPerSecond"] == 2.0
+    assert summary[".pdf"]["embed"]["meanTokens"] == 200
+    assert summary[".png"]["parse"]["p50Seconds"] == 3.0
@@ -0,0 +1,122 @@
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.message_buckets import (
+    create_bucket,
+    get_bucket_id,
+    get_message_size,
+    pack_messages,
+    unpack_buckets
+)
+
+
+def message(id, content="hello"):
+    return {
+        'id': id,
+        'type': 'message',
+        'userId': "user-1",
+        'conversationId': "conversation-1",
+        'role': "user",
+        'content': content,
+    }
+
+
+def test_pack_messages_respects_count_limit():
+    messages = [message(str(i)) for i in range(5)]
+
+    groups = pack_messages(messages, max_messages=2, max_bytes=1024 * 1024)
+
+    assert [[m['id'] for m in group] for group in groups] == [["0", "1"], ["2", "3"], ["4"]]
+
+
+def test_pack_messages_respects_size_limit():
+    messages = [message("0", "x" * 600), message("1"), message("2")]
+    max_bytes = get_message_size(messages[0])
+
+    groups = pack_messages(messages, max_messages=100, max_bytes=max_bytes)
+
+    assert [[m['id'] for m in group] for group in groups] == [["0"], ["1", "2"]]
+
+
+def test_unpack_buckets_orders_by_index_and_keeps_last_copy():
+    first = create_bucket("user-1", "conversation-1", 0, [message("0"), message("1")])
+    second = create_bucket("user-1", "conversation-1", 1, [message("2"), message("1", "retried")])
+
+    messages = unpack_buckets([second, first])
+
+    assert first['id'] == get_bucket_id("conversation-1", 0)
+    assert [m['id'] for m in messages] == ["0", "2", "1"]
+    assert messages[-1]['content'] == "retried"
+
+
+class FakeChatContainer():
+    def __init__(self, items, on_bucket_written=None):
+        self.items = items
+        self.on_bucket_written = on_bucket_written
+
+    def store(self, item):
+        item = {**item, '_etag': str(int(self.items.get(item['id'], {}).get('_etag', 0)) + 1)}
+        self.items[item['id']] = item
+        return dict(item)
+
+    async def query_items(self, query, parameters):
+        for item in list(self.items.values()):
+            if item.get('type') == 'message':
+                yield dict(item)
+
+    async def upsert_item(self, item):
+        stored = self.store(item)
+        if item.get('type') == 'message_bucket' and self.on_bucket_written:
+            self.on_bucket_written(self)
+        return stored
+
+    async def replace_item(self, item, body, etag, match_condition):
+        if self.items[item]['_etag'] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        return self.store(body)
+
+    async def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return dict(self.items[item])
+
+    async def delete_item(self, item, partition_key):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        del self.items[item]
+
+
+class FakeConversationClient(CosmosConversationClient):
+    def __init__(self, container):
+        self.container = container
+        self.write_queue = None
+        self.enable_message_buckets = True
+        self.message_bucket_max_messages = 2
+        self.message_bucket_max_bytes = 512 * 1024
+
+    def create_chat_container_client(self):
+        return self.container
+
+
+@pytest.mark.asyncio
+async def test_migration_starts_over_when_a_message_is_added_meanwhile():
+    items = {}
+    def add_message_once(container):
+        ## a message is added and the conversation updated while the first buckets are written
+        if "3" not in container.items:
+            container.store({**message("3"), 'createdAt': "3"})
+            container.store({**container.items["conversation-1"], 'updatedAt': "3"})
+
+    container = FakeChatContainer(items, add_message_once)
+    client = FakeConversationClient(container)
+    conversation = container.store({'id': "conversation-1", 'type': "conversation", 'userId': "user-1", 'updatedAt': "2"})
+    for id in ("1", "2"):
+        container.store({**message(id), 'createdAt': id})
+
+    assert await client.migrate_conversation_to_buckets("user-1", conversation) == 3
+
+    assert items["conversation-1"]['bucketCount'] == 2 and items["conversation-1"]['updatedAt'] == "3"
+    assert sorted(items) == ["conversation-1", get_bucket_id("conversation-1", 0), get_bucket_id("conversation-1", 1)]
+    buckets = [items[get_bucket_id("conversation-1", index)] for index in range(2)]
+    assert [message['id'] for message in unpack_buckets(buckets)] == ["1", "2", "3"]
@@ -0,0 +1,31 @@
+from PIIDetection import batched, segment_text
+
+
+def test_short_text_is_a_single_segment():
+    assert segment_text("One sentence. Another one.", 100) == ["One sentence. Another one."]
+
+
+def test_segments_are_cut_on_sentence_boundaries():
+    text = "First sentence here. Second sentence here. Third sentence here."
+
+    segments = segment_text(text, 45)
+
+    assert segments == ["First sentence here. Second sentence here.", "Third sentence here."]
+    assert all(len(segment) <= 45 for segment in segments)
+
+
+def test_long_sentences_are_cut_on_whitespace():
+    text = "word " * 30
+
+    segments = segment_text(text.strip(), 20)
+
+    assert all(len(segment) <= 20 for segment in segments)
+    assert " ".join(segments).split() == text.split()
+
+
+def test_empty_text_has_no_segments():
+    assert segment_text("", 100) == []
+
+
+def test_batched():
+    assert batched([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
@@ -0,0 +1,54 @@
+from llama_index.core.schema import Document
+
+from PIIPrefilter import PIIPrefilter, iban_valid, luhn_valid
+
+
+PATTERN_CATEGORIES = ["Email", "PhoneNumber", "CreditCardNumber", "USSocialSecurityNumber", "InternationalBankingAccountNumber"]
+
+
+def test_checksums():
+    assert luhn_valid("4111 1111 1111 1111")
+    assert not luhn_valid("4111 1111 1111 1112")
+    assert iban_valid("GB82 WEST 1234 5698 7654 32")
+    assert not iban_valid("GB82 WEST 1234 5698 7654 33")
+
+
+def test_candidates_of_each_category():
+    prefilter = PIIPrefilter(PATTERN_CATEGORIES)
+
+    assert prefilter.find_candidates("mail jane@example.com") == [("email", "jane@example.com")]
+    # the categories overlap, an SSN or a card number is also a phone candidate
+    assert "card" in [name for name, _ in prefilter.find_candidates("card 4111-1111-1111-1111")]
+    assert "ssn" in [name for name, _ in prefilter.find_candidates("ssn 123-45-6789")]
+    assert "iban" in [name for name, _ in prefilter.find_candidates("iban GB82WEST12345698765432")]
+    assert [name for name, _ in prefilter.find_candidates("call (212) 555-1234")] == ["phone"]
+
+
+def test_invalid_numbers_are_not_candidates():
+    prefilter = PIIPrefilter(["CreditCardNumber", "USSocialSecurityNumber"])
+
+    assert prefilter.find_candidates("ref 4111 1111 1111 1112 and 000-12-3456") == []
+
+
+def test_only_configured_categories_are_searched():
+    prefilter = PIIPrefilter(["Email"])
+
+    assert not prefilter.needs_escalation("call (212) 555-1234")
+    assert prefilter.needs_escalation("mail jane@example.com")
+
+
+def test_categories_that_need_nlp_escalate_every_page():
+    assert PIIPrefilter(["Email", "Person"]).needs_escalation("nothing to see")
+    assert PIIPrefilter(None).needs_escalation("nothing to see")
+
+
+def test_screen_returns_pages_to_escalate():
+    prefilter = PIIPrefilter(PATTERN_CATEGORIES)
+    pages = [Document(text="The quarterly report."), Document(text="Contact jane@example.com")]
+
+    assert [page.text for page in prefilter.screen(pages)] == ["Contact jane@example.com"]
+
+
+def test_span_rejected_by_one_category_is_checked_by_the_others():
+    assert PIIPrefilter(["PhoneNumber", "USSocialSecurityNumber"]).find_candidates("call 912-34-5678") == [("phone", "912-34-5678")]
+    assert PIIPrefilter(["CreditCardNumber", "PhoneNumber"]).needs_escalation("call 4111 1111 1111 1112")
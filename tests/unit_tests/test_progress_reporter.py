@@ -0,0 +1,76 @@
+import threading
+
+from llama_index.core.schema import Document
+
+from DocumentService import ProgressReporter
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDocumentService():
+    def __init__(self):
+        self.progress = []
+
+    def update_documents_progress(self, documents, progress):
+        self.progress.append((progress['embeddedChunks'], progress['totalChunks']))
+
+
+def create_reporter(clock):
+    document_service = FakeDocumentService()
+    documents = [Document(text="page", metadata={'master_document_id': "1", 'user_principal_id': "user-1"})]
+    return document_service, ProgressReporter(document_service, documents, total=100, interval=2.0, clock=clock)
+
+
+def test_updates_within_the_interval_are_coalesced():
+    clock = FakeClock()
+    document_service, reporter = create_reporter(clock)
+
+    reporter.flush()
+    for _ in range(5):
+        clock.now += 0.5
+        reporter.advance(10)
+    reporter.flush()
+
+    assert document_service.progress == [(0, 100), (40, 100), (50, 100)]
+
+
+def test_flush_writes_the_latest_count_once():
+    clock = FakeClock()
+    document_service, reporter = create_reporter(clock)
+
+    reporter.advance(10)
+    reporter.advance(90)
+    reporter.flush()
+    reporter.flush()
+
+    assert document_service.progress == [(10, 100), (100, 100)]
+
+
+class SlowDocumentService(FakeDocumentService):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def update_documents_progress(self, documents, progress):
+        self.release.wait(timeout=5)
+        super().update_documents_progress(documents, progress)
+
+
+def test_progress_is_written_without_blocking_the_caller():
+    document_service = SlowDocumentService()
+    documents = [Document(text="page", metadata={'master_document_id': "1", 'user_principal_id': "user-1"})]
+    reporter = ProgressReporter(document_service, documents, total=100, interval=0.0)
+
+    reporter.advance(10)
+    reporter.advance(20)
+    assert document_service.progress == []
+
+    document_service.release.set()
+    reporter.flush()
+    assert document_service.progress == [(10, 100), (30, 100)]
@@ -0,0 +1,154 @@
+import io
+import pypdf
+import pytest
+from azure.storage.blob import BlobClient
+from azure.storage.blob._models import BlobProperties
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import Document
+
+import AzStorageBlobReader
+from IncrementalIndexing import assign_chunk_ids
+from llama_index_service import LlamaIndexService
+
+
+METADATA = {'user_principal_id': "user-1", 'master_document_id': "doc-1"}
+
+
+class FakeVectorStore():
+    stores_text = True
+
+    def __init__(self, existing_ids=()):
+        self.ids = set(existing_ids)
+        self.added = []
+
+    def get_node_ids(self, ref_doc_id, partition_key=None):
+        return list(self.ids)
+
+    def add(self, nodes):
+        self.added.append(len(nodes))
+        self.ids.update(node.node_id for node in nodes)
+
+    def delete_nodes(self, node_ids, partition_key=None):
+        self.ids.difference_update(node_ids)
+
+
+class FakeDocumentService():
+    def __init__(self):
+        self.statuses = []
+
+    def update_documents_status(self, documents, status, ingestion=None):
+        self.statuses.append(status)
+
+    def update_documents_progress(self, documents, progress):
+        pass
+
+
+class StreamingLoader():
+    def __init__(self, pages, fail_at=None):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.read = 0
+
+    def lazy_load_data(self):
+        for number, text in enumerate(self.pages):
+            if number == self.fail_at:
+                raise ValueError("PII on this page")
+            self.read += 1
+            yield Document(text=text, metadata=dict(METADATA))
+
+
+def create_service(vector_store, window_pages=2):
+    return LlamaIndexService(
+        document_service=FakeDocumentService(),
+        llm=MockLLM(),
+        vector_store=vector_store,
+        embed_model=MockEmbedding(embed_dim=8),
+        window_pages=window_pages
+    )
+
+
+def page_texts(count):
+    return [f"Page {number} of the report." for number in range(count)]
+
+
+def test_pages_are_written_a_window_at_a_time():
+    vector_store = FakeVectorStore()
+
+    create_service(vector_store).index_documents(StreamingLoader(page_texts(5)))
+
+    assert vector_store.added == [2, 2, 1]
+    assert len(vector_store.ids) == 5
+
+
+def test_chunks_of_the_previous_version_that_are_gone_are_deleted():
+    previous = [Document(text=text, metadata=dict(METADATA)) for text in page_texts(3)]
+    assign_chunk_ids(previous)
+    vector_store = FakeVectorStore([node.node_id for node in previous] + ["vanished"])
+
+    create_service(vector_store).index_documents(StreamingLoader(page_texts(4)))
+
+    assert vector_store.added == [1]
+    assert "vanished" not in vector_store.ids
+    assert len(vector_store.ids) == 4
+
+
+def test_chunks_written_before_a_failure_are_removed():
+    vector_store = FakeVectorStore(["previous"])
+
+    with pytest.raises(ValueError):
+        create_service(vector_store).index_documents(StreamingLoader(page_texts(5), fail_at=3))
+
+    assert vector_store.ids == {"previous"}
+
+
+class FakeBlobClient(BlobClient):
+    def __init__(self, content):
+        self.content = content
+
+    def get_blob_properties(self):
+        properties = BlobProperties(name="report.pdf", metadata=dict(METADATA))
+        properties.size = len(self.content)
+        return properties
+
+    def download_blob(self, max_concurrency=1):
+        return FakeDownload(self.content)
+
+
+class FakeDownload():
+    def __init__(self, content):
+        self.content = content
+
+    def readall(self):
+        return self.content
+
+    def readinto(self, stream):
+        return stream.write(self.content)
+
+
+def create_pdf(pages):
+    writer = pypdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def test_small_pdfs_are_read_page_by_page_from_memory(monkeypatch):
+    def no_disk():
+        raise AssertionError("a small PDF was written to disk")
+    monkeypatch.setattr(AzStorageBlobReader.tempfile, "TemporaryDirectory", no_disk)
+
+    reader = AzStorageBlobReader.AzStorageBlobReader(blob_client=FakeBlobClient(create_pdf(3)))
+    documents = list(reader.lazy_load_data())
+
+    assert [document.metadata["page_label"] for document in documents] == ["1", "2", "3"]
+    assert documents[0].metadata["file_name"] == "report.pdf"
+    assert documents[0].metadata["master_document_id"] == "doc-1"
+
+
+def test_large_pdfs_are_read_page_by_page_from_a_temporary_file():
+    reader = AzStorageBlobReader.AzStorageBlobReader(blob_client=FakeBlobClient(create_pdf(2)), in_memory_max_size=0)
+
+    assert [document.metadata["page_label"] for document in reader.lazy_load_data()] == ["1", "2"]
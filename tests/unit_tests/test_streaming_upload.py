@@ -0,0 +1,78 @@
+import hashlib
+import pytest
+from backend.storage.streaming_upload import IncompleteUploadError, StreamingBlockUploader, UploadTooLargeError, iter_multipart
+
+
+class FakeBlobClient:
+    def __init__(self):
+        self.blocks = {}
+        self.committed = None
+        self.metadata = None
+
+    async def stage_block(self, block_id, data, length=None):
+        self.blocks[block_id] = data
+
+    async def commit_block_list(self, block_list, metadata=None):
+        self.committed = b"".join(self.blocks[block_id] for block_id in block_list)
+        self.metadata = metadata
+
+
+async def chunks(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def multipart_body(boundary, conversation_id, file_name, content):
+    return (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="conversationId"\r\n\r\n'
+        f"{conversation_id}\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f"Content-Type: application/pdf\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+
+
+@pytest.mark.asyncio
+async def test_uploader_stages_blocks_in_order_and_hashes_content():
+    blob_client = FakeBlobClient()
+    content = bytes(range(256)) * 40
+    uploader = StreamingBlockUploader(blob_client, block_size=1000, max_concurrency=2, max_size=len(content))
+
+    async for chunk in chunks(content, 333):
+        await uploader.write(chunk)
+    await uploader.commit(metadata={'conversation_id': "conversation-1"})
+
+    assert blob_client.committed == content
+    assert len(blob_client.blocks) == 11
+    assert uploader.content_hash == hashlib.sha256(content).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_uploader_rejects_content_over_max_size():
+    uploader = StreamingBlockUploader(FakeBlobClient(), block_size=1000, max_concurrency=2, max_size=10)
+
+    await uploader.write(b"0123456789")
+    with pytest.raises(UploadTooLargeError):
+        await uploader.write(b"x")
+
+
+@pytest.mark.asyncio
+async def test_iter_multipart_streams_file_data():
+    content = b"%PDF" + b"\x00\r\n--" * 500
+    body = multipart_body("boundary123", "conversation-1", "report.pdf", content)
+
+    events = [event async for event in iter_multipart(chunks(body, 97), "boundary123")]
+
+    assert events[0] == ("field", ("conversationId", "conversation-1"))
+    assert events[1] == ("file", ("file", "report.pdf"))
+    assert b"".join(value for event, value in events[2:] if event == "data") == content
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("length", [300, -20, -10])
+async def test_iter_multipart_rejects_a_truncated_body(length):
+    body = multipart_body("boundary123", "conversation-1", "report.pdf", b"x" * 1000)[:length]
+
+    with pytest.raises(IncompleteUploadError):
+        [event async for event in iter_multipart(chunks(body, 97), "boundary123")]
@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import numpy as np
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+from UserVectorIndex import build_index, rebuild_user_index
+from backend.context.user_vector_index import UserVectorIndex
+
+
+def write_index(tmp_path, vectors, chunk_ids, master_document_ids, nlist=None):
+    path = tmp_path / "user.ann"
+    path.write_bytes(build_index(vectors, chunk_ids, master_document_ids, nlist))
+    return UserVectorIndex(str(path))
+
+
+def test_index_file_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    chunk_ids = [f"chunk-{i}" for i in range(300)]
+    master_document_ids = [f"doc-{i % 3}" for i in range(300)]
+
+    index = write_index(tmp_path, vectors, chunk_ids, master_document_ids)
+
+    assert index.count == 300
+    assert index.dim == 16
+    assert sorted(index.chunk_ids) == sorted(chunk_ids)
+    assert index.has_documents(["doc-0", "doc-2"])
+    assert not index.has_documents(["doc-0", "doc-9"])
+
+
+def test_search_finds_the_nearest_chunk_of_the_requested_documents(tmp_path):
+    rng = np.random.default_rng(2)
+    vectors = rng.normal(size=(200, 32)).astype(np.float32)
+    chunk_ids = [f"chunk-{i}" for i in range(200)]
+    master_document_ids = [f"doc-{i % 2}" for i in range(200)]
+    index = write_index(tmp_path, vectors, chunk_ids, master_document_ids, nlist=4)
+
+    results = index.search(vectors[10], ["doc-0"], top_k=5, nprobe=4)
+
+    assert results[0][0] == "chunk-10"
+    assert abs(results[0][1] - 1.0) < 0.02
+    assert all(int(chunk_id.split("-")[1]) % 2 == 0 for chunk_id, _ in results)
+
+
+def test_search_skips_documents_that_are_not_requested(tmp_path):
+    vectors = np.eye(4, dtype=np.float32)
+    index = write_index(tmp_path, vectors, ["a", "b", "c", "d"], ["doc-1", "doc-1", "doc-2", "doc-2"], nlist=1)
+
+    results = index.search([0, 0, 1, 0], ["doc-1"], top_k=10)
+
+    assert [chunk_id for chunk_id, _ in results] == ["a", "b"]
+    assert index.search([0, 0, 1, 0], ["doc-3"]) == []
+
+
+def test_documents_uploaded_again_are_not_indexed(tmp_path):
+    vectors = np.eye(4, dtype=np.float32)
+    path = tmp_path / "user.ann"
+    path.write_bytes(build_index(vectors, ["a", "b", "c", "d"], ["doc-1", "doc-1", "doc-2", "doc-2"], nlist=1, document_versions={"doc-1": "hash-1", "doc-2": "hash-2"}))
+    index = UserVectorIndex(str(path))
+
+    assert index.has_documents(["doc-1", "doc-2"], {"doc-1": "hash-1", "doc-2": "hash-2"})
+    assert not index.has_documents(["doc-1"], {"doc-1": "hash-3"})
+    ## a document that is being indexed again
+    assert not index.has_documents(["doc-1"], {})
+
+
+class FakeCosmosContainer:
+    def __init__(self, items):
+        self.items = items
+
+    def query_items(self, query, parameters, partition_key):
+        return iter(self.items)
+
+
+class FakeIndexBlob:
+    def __init__(self, conflicts=0):
+        self.conflicts = conflicts
+        self.data = None
+        self.metadata = None
+        self.etag = None
+        self.uploads = 0
+
+    def get_blob_properties(self):
+        if self.data is None:
+            raise ResourceNotFoundError("not found")
+        return SimpleNamespace(etag=self.etag, metadata=self.metadata)
+
+    def upload_blob(self, data, overwrite, metadata, etag=None, match_condition=None):
+        if self.conflicts:
+            ## a concurrent rebuild uploaded its file first
+            self.conflicts -= 1
+            self.data, self.etag = b"other", "etag-other"
+            raise ResourceModifiedError("modified")
+        assert etag == self.etag and (overwrite or self.data is None)
+        self.data, self.metadata, self.etag = data, metadata, f"etag-{self.uploads}"
+        self.uploads += 1
+
+
+def test_rebuild_starts_over_when_the_file_changed_and_skips_documents_being_indexed(tmp_path):
+    chunks = [{"id": f"chunk-{i}", "master_document_id": f"doc-{i % 3}", "contentVector": [float(i), 1.0]} for i in range(30)]
+    statuses = [{"id": "doc-0", "content_hash": "hash-0"}, {"id": "doc-1", "content_hash": "hash-1"}]
+    blob = FakeIndexBlob(conflicts=1)
+    index_container = SimpleNamespace(get_blob_client=lambda name: blob)
+
+    count = rebuild_user_index(FakeCosmosContainer(chunks), FakeCosmosContainer(statuses), index_container, "user-1", min_chunks=1)
+
+    assert count == 20 and blob.uploads == 1
+    path = tmp_path / "user.ann"
+    path.write_bytes(blob.data)
+    index = UserVectorIndex(str(path))
+    assert index.has_documents(["doc-0", "doc-1"], {"doc-0": "hash-0", "doc-1": "hash-1"})
+    assert not index.has_documents(["doc-2"])
+
+    ## nothing changed since, the file is kept as is
+    assert rebuild_user_index(FakeCosmosContainer(chunks), FakeCosmosContainer(statuses), index_container, "user-1", min_chunks=1) == 20
+    assert blob.uploads == 1
@@ -0,0 +1,25 @@
+import pytest
+from llama_index.core.embeddings import MockEmbedding
+
+from VectorIndexPolicy import build_vector_policies, get_embedding_dimensions
+
+
+def test_configured_dimensions_win():
+    assert get_embedding_dimensions("text-embedding-3-large", 256, MockEmbedding(embed_dim=8)) == 256
+
+
+def test_unknown_models_are_probed():
+    assert get_embedding_dimensions("my-embedding-model", None, MockEmbedding(embed_dim=8)) == 8
+
+
+def test_unknown_models_without_a_deployment_to_probe_fail():
+    assert get_embedding_dimensions("text-embedding-3-small") == 1536
+    with pytest.raises(ValueError):
+        get_embedding_dimensions("my-embedding-model")
+
+
+def test_policies_index_the_stored_vectors():
+    vector_embedding_policy, indexing_policy = build_vector_policies(8, "diskANN")
+
+    assert vector_embedding_policy["vectorEmbeddings"][0]["dimensions"] == 8
+    assert indexing_policy["vectorIndexes"] == [{"path": "/contentVector", "type": "diskANN"}]
@@ -0,0 +1,172 @@
+import os
+import pytest
+import json
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from backend.history.write_behind_queue import MAX_BATCH_BYTES, ChatHistoryWriteQueue
+
+
+class FakeContainer:
+    def __init__(self, failures=0, invalid_ids=()):
+        self.failures = failures
+        self.invalid_ids = set(invalid_ids)
+        self.batches = []
+        self.items = {}
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ServiceRequestError("CosmosDB unavailable")
+        if any(item['id'] in self.invalid_ids for _, (item,) in batch_operations):
+            error = HttpResponseError("Bad request")
+            error.status_code = 400
+            raise error
+
+        self.batches.append((partition_key, batch_operations))
+        for _, (item,) in batch_operations:
+            self.items[item['id']] = item
+
+
+def spill_files(directory):
+    return sorted(directory.rglob("*.jsonl"))
+
+
+def message(id, user_id="user-1", conversation_id="conversation-1"):
+    return {
+        'id': id,
+        'type': 'message',
+        'userId': user_id,
+        'conversationId': conversation_id,
+        'createdAt': id,
+    }
+
+
+@pytest.mark.asyncio
+async def test_flush_batches_per_user_partition(tmp_path):
+    container = FakeContainer()
+    queue = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+
+    await queue.enqueue(message("1"))
+    await queue.enqueue(message("2"))
+    await queue.enqueue(message("3", user_id="user-2"))
+    await queue.flush()
+
+    assert sorted((partition_key, len(operations)) for partition_key, operations in container.batches) == [("user-1", 2), ("user-2", 1)]
+    assert not queue.has_pending("user-1")
+
+
+@pytest.mark.asyncio
+async def test_pending_items_are_readable_before_flush(tmp_path):
+    queue = ChatHistoryWriteQueue(FakeContainer(), spill_directory=str(tmp_path))
+
+    await queue.enqueue(message("1"))
+    await queue.enqueue(message("2", conversation_id="conversation-2"))
+
+    pending = await queue.get_items("user-1", lambda item: item['conversationId'] == "conversation-1")
+    assert [item['id'] for item in pending] == ["1"]
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_spill_to_disk_and_replay(tmp_path):
+    container = FakeContainer(failures=10)
+    queue = ChatHistoryWriteQueue(container, max_retries=1, retry_backoff=0, spill_directory=str(tmp_path))
+
+    await queue.enqueue(message("1"))
+    assert not await queue.flush_user("user-1")
+    assert len(spill_files(tmp_path)) == 1
+    assert [item['id'] for item in await queue.get_items("user-1", lambda item: True)] == ["1"]
+
+    ## a new worker picks up the spilled writes of one that exited once CosmosDB is reachable again
+    ## the worker exits without flushing, which releases the lock on its directory
+    queue._worker_lock.close()
+    container.failures = 0
+    restarted_queue = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+    await restarted_queue.start()
+    await restarted_queue.close()
+
+    assert "1" in container.items
+    assert spill_files(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_writes_queued_by_another_worker_are_readable(tmp_path):
+    container = FakeContainer()
+    writer = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+    reader = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+    await reader.start()
+
+    await writer.enqueue(message("1"))
+    await writer.enqueue(message("2", user_id="user-2"))
+    assert [item['id'] for item in await reader.get_items("user-1", lambda item: True)] == ["1"]
+
+    ## once written the items are read from Cosmos
+    await writer.flush()
+    assert await reader.get_items("user-1", lambda item: True) == []
+    assert spill_files(tmp_path) == []
+    await reader.close()
+
+
+@pytest.mark.asyncio
+async def test_spilled_writes_of_a_running_worker_are_not_replayed_by_another(tmp_path):
+    container = FakeContainer(failures=10)
+    queue = ChatHistoryWriteQueue(container, max_retries=0, spill_directory=str(tmp_path))
+    await queue.enqueue(message("1"))
+    assert not await queue.flush_user("user-1")
+
+    container.failures = 0
+    other_queue = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+    await other_queue.start()
+    await other_queue.close()
+
+    assert container.items == {}
+    assert len(spill_files(tmp_path)) == 1
+
+
+@pytest.mark.asyncio
+async def test_batches_are_split_by_size(tmp_path):
+    container = FakeContainer()
+    queue = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+
+    for id in range(4):
+        await queue.enqueue({**message(str(id)), 'content': "x" * (MAX_BATCH_BYTES // 3)})
+    await queue.flush()
+
+    assert [len(operations) for _, operations in container.batches] == [2, 2]
+    assert len(container.items) == 4
+
+
+@pytest.mark.asyncio
+async def test_rejected_writes_are_set_aside_without_losing_the_batch(tmp_path):
+    container = FakeContainer(invalid_ids={"2"})
+    queue = ChatHistoryWriteQueue(container, spill_directory=str(tmp_path))
+
+    for id in range(3):
+        await queue.enqueue(message(str(id)))
+    assert not await queue.flush_user("user-1")
+
+    assert sorted(container.items) == ["0", "1"]
+    assert not queue.has_pending("user-1")
+    ## kept for inspection, but not replayed
+    rejected_files = spill_files(tmp_path / "rejected")
+    assert len(rejected_files) == 1
+    assert [json.loads(line)['id'] for line in rejected_files[0].read_text().splitlines()] == ["2"]
+    assert spill_files(tmp_path) == rejected_files
+
+
+@pytest.mark.asyncio
+async def test_journals_of_other_workers_are_only_reread_when_they_change(tmp_path, monkeypatch):
+    writer = ChatHistoryWriteQueue(FakeContainer(), spill_directory=str(tmp_path))
+    reader = ChatHistoryWriteQueue(FakeContainer(), spill_directory=str(tmp_path))
+    await reader.start()
+    reads = []
+    read_spill_file = reader._read_spill_file
+    monkeypatch.setattr(reader, "_read_spill_file", lambda spill_file: reads.append(spill_file) or read_spill_file(spill_file))
+
+    await writer.enqueue(message("1"))
+    assert [item['id'] for item in await reader.get_items("user-1", lambda item: True)] == ["1"]
+    assert [item['id'] for item in await reader.get_items("user-1", lambda item: True)] == ["1"]
+    assert len(reads) == 1
+
+    await writer.enqueue(message("2"))
+    assert [item['id'] for item in await reader.get_items("user-1", lambda item: True)] == ["1", "2"]
+    assert len(reads) == 2
+    await reader.close()